@@ -0,0 +1,279 @@
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import tracemalloc
+
+from lxml import html
+
+import parsing_tools
+from parsing_tools import (extract_ad_id, extract_property, parse_listing_page, parse_property,
+                           preprocess_properties, preprocess_property)
+
+CORPUS_DIR = 'bench_pages'
+# small anonymized pages shipped with the tests, used when no corpus has been saved
+FIXTURE_CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tests', 'fixtures')
+RESULTS_PATH = 'bench_results.json'
+REPEAT = 3
+# preprocessing is timed over the pages repeated to a batch of the size `stream.py` loads at once
+PREPROCESS_BATCH_SIZE = 1000
+TOLERANCE = 0.2
+DESCRIPTION = 'Benchmark parsing, preprocessing and an offline pipeline run'
+
+# extractor name -> function of the parsed tree
+EXTRACTORS: Dict[str, Callable[[html.HtmlElement], Any]] = {
+    'extract_price': parsing_tools.extract_price,
+    'extract_address': parsing_tools.extract_address,
+    'extract_number': parsing_tools.extract_number,
+    'extract_thumbs': parsing_tools.extract_thumbs,
+    'extract_photos': parsing_tools.extract_photos,
+    'extract_coordinates': parsing_tools.extract_coordinates,
+    'extract_element': lambda tree: parsing_tools.extract_element(tree, 'reservation-strip__text'),
+    'extract_by_id': lambda tree: parsing_tools.extract_by_id(tree, 'collapsedText'),
+    'extract_table': parsing_tools.extract_table,
+    'extract_ad_stats': parsing_tools.extract_ad_stats,
+    'extract_distance_stats': parsing_tools.extract_distance_stats,
+    'extract_heating_est': parsing_tools.extract_heating_est,
+    'extract_pollution_stats': parsing_tools.extract_pollution_stats,
+    'extract_crime_stat': parsing_tools.extract_crime_stat,
+    'extract_is_new_project': parsing_tools.extract_is_new_project,
+}
+
+
+def _read_page(path: str) -> str:
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        return f.read()
+
+
+def load_corpus(directory: str=CORPUS_DIR) -> Tuple[List[str], List[str]]:
+    """Returns the listing and property pages saved under `directory`/listing and `directory`/property."""
+    corpus = []
+    for kind in ['listing', 'property']:
+        kind_dir = os.path.join(directory, kind)
+        names = sorted(os.listdir(kind_dir)) if os.path.isdir(kind_dir) else []
+        corpus.append([_read_page(os.path.join(kind_dir, name)) for name in names
+                       if name.endswith('.html') or name.endswith('.html.gz')])
+    return corpus[0], corpus[1]
+
+
+def save_corpus_from_archive(archive_dir: str, directory: str=CORPUS_DIR, limit: int=200) -> int:
+    """Copies the `limit` most recently archived property pages into the corpus."""
+    from html_archive import HtmlArchive
+
+    archive = HtmlArchive(archive_dir)
+    records = sorted(archive.latest_records(), key=lambda record: record.fetched_at)[-limit:]
+    os.makedirs(os.path.join(directory, 'property'), exist_ok=True)
+    for record, source in archive.iter_pages(records):
+        with gzip.open(os.path.join(directory, 'property', f'{record.ad_id}.html.gz'), 'wt', encoding='utf-8') as f:
+            f.write(source)
+    archive.close()
+    return len(records)
+
+
+def measure(pages: int, func: Callable[[], Any], repeat: int=REPEAT) -> Dict[str, float]:
+    """Times `func`, which processes `pages` pages, and measures its peak traced memory in a separate run."""
+    seconds = float('inf')
+    for _ in range(repeat):
+        started = perf_counter()
+        func()
+        seconds = min(seconds, perf_counter() - started)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'pages': pages,
+        'seconds': round(seconds, 6),
+        'pages_per_second': round(pages / seconds, 2) if seconds > 0 else float('inf'),
+        'peak_kib_per_page': round(peak / 1024 / max(pages, 1), 2),
+    }
+
+
+class FakeSite:
+    """Serves the corpus as if it were the site: listing pages by page number, property pages by ad id."""
+    def __init__(self, listings: List[str], properties: List[str]):
+        self.listings = listings
+        self.properties = properties
+        # the ad id every property page links to, replaced with the requested one when served
+        self.property_ids = [self._linked_id(source) for source in properties]
+
+    @staticmethod
+    def _linked_id(source: str) -> Optional[str]:
+        link = parse_property(source).get('Nuoroda')
+        return extract_ad_id(link) if link else None
+
+    def __call__(self, url: str, save_html: bool=False) -> str:
+        if '/puslapis/' in url:
+            page = int(url.rstrip('/').rsplit('/', 1)[1])
+            return self.listings[(page - 1) % len(self.listings)]
+        ad_id = extract_ad_id(url) or url
+        index = int(hashlib.md5(ad_id.encode()).hexdigest(), 16) % len(self.properties)
+        source, original_id = self.properties[index], self.property_ids[index]
+        return source.replace(original_id, ad_id) if original_id else source
+
+
+class MemoryWriter:
+    """Keeps saved properties in a dictionary, standing in for `BufferedWriter`."""
+    def __init__(self, on_saved: Optional[Callable[[str, List[str]], None]]=None):
+        self.on_saved = on_saved
+        self.properties: Dict[Tuple[str, str], Dict] = {}
+
+    def save(self, property: Dict, ad_type: str, upsert: bool=False, merge: bool=False) -> None:
+        property_id = property.get('_id')
+        self.properties[(ad_type, property_id)] = property
+        if self.on_saved is not None:
+            self.on_saved(ad_type, [property_id])
+
+    def flush(self, ad_type: Optional[str]=None) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+@contextmanager
+def _working_directory(path: str) -> Iterator[None]:
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def run_offline_pipeline(listings: List[str], properties: List[str], **scraper_kwargs: Any) -> int:
+    """
+    Runs one `Scraper` crawl over the corpus with a fake fetcher and an in-memory store, with its
+    local state in a temporary directory. The crawl is not retried, so a failure ends the benchmark
+    rather than waiting out the retries of `Scraper.scrape`. Returns the number of saved properties.
+    """
+    from scraper import Scraper
+    from seen_index import open_seen_index
+
+    writers = []
+
+    def make_writer(on_saved):
+        writers.append(MemoryWriter(on_saved))
+        return writers[-1]
+
+    with tempfile.TemporaryDirectory() as directory, _working_directory(directory):
+        # a complete index is not reconciled with the database
+        index = open_seen_index('butai')
+        index.reconcile([])
+        index.close()
+        scraper = Scraper('butai', fetch_html=FakeSite(listings, properties), make_writer=make_writer,
+                          **scraper_kwargs)
+        scraper.max_page = len(listings)
+        scraper.crawl()
+        scraper.scraped_ids.close()
+        scraper.listing_signals.close()
+    return len(writers[0].properties)
+
+
+def run_benchmarks(listings: List[str], properties: List[str], repeat: int=REPEAT) -> Dict[str, Dict]:
+    results = {}
+    if properties:
+        trees = [html.fromstring(source) for source in properties]
+        results['html.fromstring'] = measure(len(properties), lambda: [html.fromstring(source) for source in properties], repeat)
+        for name, extractor in EXTRACTORS.items():
+            results[name] = measure(len(trees), lambda extractor=extractor: [extractor(tree) for tree in trees], repeat)
+        results['extract_property'] = measure(len(trees), lambda: [extract_property(tree) for tree in trees], repeat)
+        results['parse_property'] = measure(len(properties), lambda: [parse_property(source) for source in properties], repeat)
+
+        parsed = [parse_property(source) for source in properties]
+        batch = (parsed * -(-PREPROCESS_BATCH_SIZE // len(parsed)))[:PREPROCESS_BATCH_SIZE]
+
+        def preprocess_each():
+            for property in batch:
+                try:
+                    preprocess_property(dict(property))
+                except Exception:
+                    pass
+
+        results['preprocess_property'] = measure(len(batch), preprocess_each, repeat)
+        results['preprocess_properties'] = measure(len(batch), lambda: preprocess_properties(batch), repeat)
+
+    if listings:
+        results['parse_listing_page'] = measure(len(listings), lambda: [parse_listing_page(source) for source in listings], repeat)
+
+    if listings and properties:
+        saved = run_offline_pipeline(listings, properties)
+        results['offline_pipeline'] = measure(saved, lambda: run_offline_pipeline(listings, properties), repeat)
+    return results
+
+
+def compare(results: Dict[str, Dict], baseline: Dict[str, Dict], tolerance: float=TOLERANCE) -> List[str]:
+    """Returns a description of every benchmark whose throughput dropped by more than `tolerance`."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before, after = baseline[name]['pages_per_second'], result['pages_per_second']
+        if after < before * (1 - tolerance):
+            regressions.append(f'{name}: {after} pages/s, baseline {before} pages/s ({after / before - 1:+.0%})')
+    return regressions
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--corpus', default=CORPUS_DIR,
+                        help='directory with listing/ and property/ pages, the test fixtures if the default one is empty')
+    parser.add_argument('--from-archive', metavar='ARCHIVE_DIR', help='copy recent property pages from an archive into the corpus first')
+    parser.add_argument('--limit', type=int, default=200, help='number of pages to copy from the archive')
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--output', default=RESULTS_PATH, help='where to write the results')
+    parser.add_argument('--baseline', help='results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='allowed relative drop in throughput')
+
+
+def main(args: argparse.Namespace) -> None:
+    """Runs the benchmarks as given on the command line and exits with 1 on a regression."""
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.WARNING)
+    if args.from_archive:
+        save_corpus_from_archive(args.from_archive, args.corpus, args.limit)
+    listings, properties = load_corpus(args.corpus)
+    if not listings and not properties and args.corpus == CORPUS_DIR:
+        logging.warning(f'No pages found in {args.corpus}, benchmarking the test fixtures instead')
+        listings, properties = load_corpus(FIXTURE_CORPUS_DIR)
+    if not listings and not properties:
+        sys.exit(f'No pages found in {args.corpus}')
+
+    # extractors log every failure, which would dominate the timings
+    logging.disable(logging.CRITICAL)
+    results = run_benchmarks(listings, properties, args.repeat)
+    logging.disable(logging.NOTSET)
+
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'listing_pages': len(listings),
+        'property_pages': len(properties),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    for name, result in results.items():
+        print(f'{name:28} {result["pages_per_second"]:>12} pages/s {result["peak_kib_per_page"]:>10} KiB/page')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)['results'], args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    add_arguments(parser)
+    main(parser.parse_args())
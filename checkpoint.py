@@ -0,0 +1,70 @@
+from typing import Any, Dict
+import json
+import os
+
+CHECKPOINT_DIR = 'checkpoints'
+
+
+class Checkpoint:
+    """
+    The crawl position of one category: the listing page, the position within it and the ads
+    that were handed out but not saved yet, together with their keyword arguments. Ads that failed
+    keep their number of failed attempts, and ads that were given up on are kept with their last error
+    so they are not handed out again during the same crawl.
+
+    Every `save` replaces the state file atomically, so a crash leaves either the old or the new state.
+    Callers that share a checkpoint between threads must not modify it while it is being saved.
+    """
+    def __init__(self, path: str, ad_type: str):
+        self.path = path
+        self.ad_type = ad_type
+        self.page = 1
+        self.position = 0
+        self.in_flight: Dict[str, Dict[str, Any]] = {}
+        self.attempts: Dict[str, int] = {}
+        self.failed: Dict[str, str] = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            if state['ad_type'] != ad_type:
+                raise ValueError(f'Checkpoint {path} belongs to {state["ad_type"]}, not {ad_type}')
+            self.page = state['page']
+            self.position = state['position']
+            self.in_flight = state['in_flight']
+            self.attempts = state.get('attempts', {})
+            self.failed = state.get('failed', {})
+
+    @property
+    def resumed(self) -> bool:
+        return self.page > 1 or self.position > 0 or bool(self.in_flight)
+
+    def save(self) -> None:
+        state = {
+            'ad_type': self.ad_type,
+            'page': self.page,
+            'position': self.position,
+            'in_flight': self.in_flight,
+            'attempts': self.attempts,
+            'failed': self.failed,
+        }
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def clear(self) -> None:
+        """Resets the position to the start and removes the state file."""
+        self.page = 1
+        self.position = 0
+        self.in_flight = {}
+        self.attempts = {}
+        self.failed = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def load_checkpoint(ad_type: str, directory: str=CHECKPOINT_DIR) -> Checkpoint:
+    return Checkpoint(os.path.join(directory, f'{ad_type}.json'), ad_type)
@@ -0,0 +1,36 @@
+from typing import Any, List, Optional
+import argparse
+import importlib
+import sys
+
+# command -> (module providing add_arguments and main, summary); a module is only imported when its command runs
+COMMANDS = {
+    'crawl': ('scraper', 'scrape listings into the property storage'),
+    'reparse': ('reparse', 'import saved .html files, parse archived pages again and upsert the results'),
+    'export': ('export', 'export scraped properties into a partitioned Parquet dataset'),
+    'images': ('images', 'download property photos into a content-addressed image store'),
+    'history': ('history', 'revisit active ads and record how they change over time'),
+    'spatial': ('spatial', 'update the spatial grid index and per-cell price aggregates'),
+    'dedup': ('dedup', 'index every stored ad and mark the ones that repost another'),
+    'ndjson': ('stream', 'export a category to, or load it from, a newline-delimited JSON file'),
+    'bench': ('bench', 'benchmark parsing, preprocessing and an offline pipeline run'),
+}
+
+
+def main(argv: Optional[List[str]]=None) -> Any:
+    parser = argparse.ArgumentParser(prog='aruodas', description='aruodas.lt scraper')
+    subparsers = parser.add_subparsers(dest='command', metavar='command', required=True)
+    for name, (_, summary) in COMMANDS.items():
+        # options are parsed below by the command's own parser, which also handles --help
+        subparsers.add_parser(name, help=summary, add_help=False)
+    args, rest = parser.parse_known_args(argv)
+
+    module_name, _ = COMMANDS[args.command]
+    module = importlib.import_module(module_name)
+    command_parser = argparse.ArgumentParser(prog=f'{parser.prog} {args.command}', description=module.DESCRIPTION)
+    module.add_arguments(command_parser)
+    return module.main(command_parser.parse_args(rest))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,32 +1,228 @@
-from pymongo.mongo_client import MongoClient
-from pymongo.server_api import ServerApi
+from datetime import timedelta
+from time import monotonic
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set
+import atexit
 import logging
-import pickle
-from typing import Dict, Set
+import threading
 
-TYPES = ['butai', 'butu-nuoma', 'namai', 'namu-nuoma', 'patalpos', 'patalpu-nuoma']
-PATH_TO_CREDENTIALS = '/Users/mariusarlauskas/Desktop/GitHub/Super-Secrets/Personal/scraping_mongo'
+from metrics import timed, timer
+from storage import DEFAULT_STORAGE, INSERT, MERGE, REPLACE, Storage, WriteError, get_client, open_storage
+from utils import TYPES
+import metrics
 
-with open(PATH_TO_CREDENTIALS, 'rb') as f:
-    URI = pickle.load(f)
+WRITE_BATCH_SIZE = 100
+WRITE_FLUSH_INTERVAL = 5.0
+# documents are buffered before they reach the database, so jobs picking up documents by when they
+# were scraped stay this far behind and leave the newest ones to their next run
+WRITE_LAG = timedelta(hours=1)
 
-def save_property(property: Dict, ad_type: str) -> None:
+_storage: Optional[Storage] = None
+_storage_url = DEFAULT_STORAGE
+_storage_lock = threading.Lock()
+_dedup_index = None
+
+
+def configure_storage(url: str) -> None:
+    """Selects where properties are stored, 'mongo' or 'sqlite:<path>', before the first access."""
+    global _storage, _storage_url
+    with _storage_lock:
+        if _storage is not None:
+            _storage.close()
+        _storage, _storage_url = None, url
+
+
+def get_storage() -> Storage:
+    """Returns this process' storage backend, opening it on first use."""
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            _storage = open_storage(_storage_url)
+            atexit.register(_storage.close)
+        return _storage
+
+
+def configure_dedup(path: Optional[str]) -> None:
+    """
+    Checks new properties against the dedup index at `path` before they are saved and indexes them
+    once they are, None turns it off.
+    """
+    global _dedup_index
+    with _storage_lock:
+        if _dedup_index is not None:
+            _dedup_index.close()
+        _dedup_index = None
+        if path is not None:
+            from dedup import DedupIndex
+            _dedup_index = DedupIndex(path)
+            atexit.register(_dedup_index.close)
+
+
+def flag_duplicates(property: Dict, ad_type: str) -> None:
+    """Lists the indexed ads a new property reposts in its `Possible_duplicates`, if dedup is configured."""
+    if _dedup_index is None:
+        return
+    with timer('dedup'):
+        duplicates = _dedup_index.query(ad_type, property)
+    if duplicates:
+        property['Possible_duplicates'] = [duplicate.duplicate_of for duplicate in duplicates]
+        logging.info(f'Property {property["_id"]} looks like a repost of {property["Possible_duplicates"]}')
+        metrics.inc('scraper_duplicates_total', ad_type=ad_type)
+
+
+def index_duplicates(properties: List[Dict], ad_type: str) -> None:
+    """Adds properties to the dedup index once they are stored, so the ones saved later are checked against them."""
+    if _dedup_index is None:
+        return
+    with timer('dedup'):
+        for property in properties:
+            _dedup_index.add(ad_type, property)
+
+
+def _check_type(ad_type: str) -> None:
     if ad_type not in TYPES:
         raise ValueError(f'Invalid ad_type: {ad_type}')
-    # Upload to MongoDB
-    client = MongoClient(URI, server_api=ServerApi('1'))
-    db = client['Scraping']
-    collection = db[f'aruodas/{ad_type}']
 
+
+def get_collection(ad_type: str) -> Any:
+    """Returns the MongoDB collection of a category, regardless of the configured storage."""
+    _check_type(ad_type)
+    return get_client()['Scraping'][f'aruodas/{ad_type}']
+
+
+@timed()
+def save_property(property: Dict, ad_type: str) -> None:
+    _check_type(ad_type)
+    flag_duplicates(property, ad_type)
     # insert and use Ad_id as the primary key
-    collection.insert_one(property)
-    logging.info(f'Inserted property {property["_id"]} into {collection.name}')
+    _, errors = get_storage().write(ad_type, [(property['_id'], INSERT, property)])
+    if errors:
+        raise WriteError(errors)
+    index_duplicates([property], ad_type)
+    logging.info(f'Inserted property {property["_id"]} into {ad_type}')
+
+
+def iter_scraped_ids(ad_type: str) -> Iterator[str]:
+    # Stream all _ids from the storage
+    _check_type(ad_type)
+    yield from get_storage().iter_ids(ad_type)
+
+
+def iter_properties(ad_type: str, query: Optional[Dict]=None, batch_size: int=1000) -> Iterator[Dict]:
+    """Streams the documents of a collection matching `query`, fetching `batch_size` at a time."""
+    _check_type(ad_type)
+    yield from get_storage().iter_properties(ad_type, query, batch_size)
+
+
+def ensure_index(ad_type: str, field: str) -> None:
+    _check_type(ad_type)
+    get_storage().ensure_index(ad_type, field)
 
 
 def get_scraped_properties(ad_type: str) -> Set:
-    # Get all _ids from MongoDB
-    client = MongoClient(URI, server_api=ServerApi('1'))
-    db = client['Scraping']
-    collection = db[f'aruodas/{ad_type}']
-    
-    return set([property['_id'] for property in collection.find({}, {'_id': 1})])
\ No newline at end of file
+    return set(iter_scraped_ids(ad_type))
+
+
+class BufferedWriter:
+    """
+    Buffers properties and writes them to the storage in batches.
+
+    A collection's buffer is flushed when it holds `batch_size` properties, when the oldest buffered
+    property is `flush_interval` seconds old and on `close`, which also runs at interpreter exit.
+    Properties that already exist are logged and skipped without failing the rest of the batch.
+    `on_saved(ad_type, ids)` is called with the ids that are stored after each flush.
+    """
+    def __init__(self, batch_size: int=WRITE_BATCH_SIZE, flush_interval: float=WRITE_FLUSH_INTERVAL,
+                 on_saved: Optional[Callable[[str, List[str]], None]]=None, storage: Optional[Storage]=None):
+        self.storage = storage
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_saved = on_saved
+        self._buffers: Dict[str, List] = {}
+        self._first_buffered: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._background_error: Optional[Exception] = None
+        self._flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+        self._flusher.start()
+        atexit.register(self.close)
+
+    def save(self, property: Dict, ad_type: str, upsert: bool=False, merge: bool=False) -> None:
+        """
+        Buffers a property, replacing an existing one with the same `_id` if `upsert` is set.
+        With `merge` the fields of an existing property are updated and fields missing from `property` kept.
+        """
+        if ad_type not in TYPES:
+            raise ValueError(f'Invalid ad_type: {ad_type}')
+        if self._closed.is_set():
+            raise RuntimeError('Writer is closed')
+        mode = MERGE if merge else REPLACE if upsert else INSERT
+        if mode != MERGE:
+            flag_duplicates(property, ad_type)
+        with self._lock:
+            buffer = self._buffers.setdefault(ad_type, [])
+            if not buffer:
+                self._first_buffered[ad_type] = monotonic()
+            buffer.append((property['_id'], mode, property))
+            full = len(buffer) >= self.batch_size
+        if full:
+            self.flush(ad_type)
+
+    def _take(self, ad_type: str) -> List:
+        with self._lock:
+            self._first_buffered.pop(ad_type, None)
+            return self._buffers.pop(ad_type, [])
+
+    def _write(self, ad_type: str, items: List) -> None:
+        with timer('bulk_write'):
+            saved_ids, errors = (self.storage or get_storage()).write(ad_type, items)
+        for property_id, error in errors.items():
+            logging.error(f'Failed to write property {property_id}: {error}')
+
+        logging.info(f'Wrote {len(saved_ids)} properties into {ad_type}')
+        metrics.inc('scraper_saved_properties_total', len(saved_ids), ad_type=ad_type)
+        metrics.inc('scraper_failed_writes_total', len(errors), ad_type=ad_type)
+        saved = set(saved_ids)
+        index_duplicates([property for property_id, mode, property in items
+                          if mode != MERGE and property_id in saved], ad_type)
+        if self.on_saved is not None and saved_ids:
+            self.on_saved(ad_type, saved_ids)
+        if errors:
+            raise WriteError(errors)
+
+    def _flush(self, ad_types: List[str]) -> None:
+        with self._flush_lock:
+            for ad_type in ad_types:
+                items = self._take(ad_type)
+                if items:
+                    self._write(ad_type, items)
+
+    def flush(self, ad_type: Optional[str]=None) -> None:
+        """
+        Writes the buffered properties of `ad_type`, or of every collection if it is None.
+        Re-raises the last error of a periodic flush, if there was one.
+        """
+        self._flush([ad_type] if ad_type is not None else list(self._buffers))
+        error, self._background_error = self._background_error, None
+        if error is not None:
+            raise error
+
+    def _flush_periodically(self) -> None:
+        while not self._closed.wait(self.flush_interval / 2):
+            now = monotonic()
+            with self._lock:
+                due = [ad_type for ad_type, first in self._first_buffered.items()
+                       if now - first >= self.flush_interval]
+            for ad_type in due:
+                try:
+                    self._flush([ad_type])
+                except Exception as e:
+                    logging.error(f'Exception while flushing {ad_type}: {e}')
+                    self._background_error = e
+
+    def close(self) -> None:
+        """Stops the periodic flushing and writes everything that is still buffered."""
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self.flush()
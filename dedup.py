@@ -0,0 +1,309 @@
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set
+import argparse
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+from utils import TYPES, batches, choice_of
+
+DEDUP_PATH = os.path.join('dedup', 'dedup.db')
+# ads collide in at least one of 32 bands of 4 rows with probability 1 - (1 - s^4)^32: over 99.9%
+# at a Jaccard similarity s of 0.7, and 50% at about 0.42, well below the similarity threshold
+NUM_BANDS = 32
+ROWS_PER_BAND = 4
+NUM_PERMUTATIONS = NUM_BANDS * ROWS_PER_BAND
+SIMILARITY_THRESHOLD = 0.7
+SHINGLE_SIZE = 3
+# ads with fewer shingles than this carry too little text and photos to compare
+MIN_SHINGLES = 5
+BATCH_SIZE = 1000
+# the hashes and permutations live below a Mersenne prime, so a * x + b fits into 64 bits
+_PRIME = (1 << 31) - 1
+_SEED = 20240101
+_WORDS = re.compile(r'\w+')
+DESCRIPTION = 'Find reposted ads with MinHash signatures of their descriptions, photos and addresses'
+
+
+@dataclass
+class Duplicate:
+    ad_id: str
+    duplicate_of: str
+    similarity: float
+
+
+def _hash(token: str) -> int:
+    return int.from_bytes(hashlib.blake2b(token.encode(), digest_size=8).digest(), 'little') % _PRIME
+
+
+def shingles(property: Dict) -> Set[str]:
+    """
+    The features two postings of the same flat share: word shingles of the description, the photos,
+    by content hash where they were downloaded and by URL otherwise, and the address.
+    """
+    features = set()
+    words = _WORDS.findall((property.get('Description') or '').lower())
+    for i in range(max(0, len(words) - SHINGLE_SIZE + 1)):
+        features.add(' '.join(words[i:i + SHINGLE_SIZE]))
+    hashes = property.get('Photo_hashes') or []
+    for i, url in enumerate(property.get('Photos') or []):
+        sha256 = hashes[i] if i < len(hashes) else None
+        features.add(f'photo:{sha256 or url}')
+    if property.get('Address'):
+        features.add(f'address:{" ".join(_WORDS.findall(property["Address"].lower()))}')
+    return features
+
+
+class MinHasher:
+    """MinHash signatures of `num_permutations` universal hash functions, computed with numpy."""
+    def __init__(self, num_permutations: int=NUM_PERMUTATIONS, seed: int=_SEED):
+        import numpy as np
+
+        generator = np.random.default_rng(seed)
+        self.num_permutations = num_permutations
+        self._a = generator.integers(1, _PRIME, num_permutations, dtype=np.uint64)
+        self._b = generator.integers(0, _PRIME, num_permutations, dtype=np.uint64)
+
+    def signature(self, features: Iterable[str]) -> Any:
+        import numpy as np
+
+        values = np.fromiter((_hash(feature) for feature in features), dtype=np.uint64)
+        if not len(values):
+            raise ValueError('Cannot compute the signature of an empty set')
+        return ((np.outer(self._a, values) + self._b[:, None]) % _PRIME).min(axis=1).astype(np.uint32)
+
+
+def similarity(signature: Any, other: Any) -> float:
+    """Estimated Jaccard similarity of the sets behind two signatures."""
+    return float((signature == other).mean())
+
+
+def _band_keys(signature: Any) -> List[int]:
+    keys = []
+    for band in range(NUM_BANDS):
+        digest = hashlib.blake2b(signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND].tobytes(), digest_size=8)
+        keys.append(int.from_bytes(digest.digest(), 'little', signed=True))
+    return keys
+
+
+class DedupIndex:
+    """
+    A persisted locality-sensitive hashing index of ad signatures.
+
+    Every signature is cut into `NUM_BANDS` bands, and ads sharing any band bucket are candidates.
+    Only candidates are compared, so checking an ad costs a handful of indexed lookups instead of
+    a pass over the collection. Signatures, band buckets and the duplicates found live in a SQLite
+    database in WAL mode, which scraper processes share.
+    """
+    def __init__(self, path: str=DEDUP_PATH, threshold: float=SIMILARITY_THRESHOLD):
+        self.path = path
+        self.threshold = threshold
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.hasher = MinHasher()
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript('''
+            CREATE TABLE IF NOT EXISTS signatures (
+                ad_type TEXT NOT NULL, ad_id TEXT NOT NULL, signature BLOB NOT NULL, PRIMARY KEY (ad_type, ad_id));
+            CREATE TABLE IF NOT EXISTS bands (
+                ad_type TEXT NOT NULL, band INTEGER NOT NULL, bucket INTEGER NOT NULL, ad_id TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS bands_bucket ON bands (ad_type, band, bucket);
+            CREATE INDEX IF NOT EXISTS bands_ad ON bands (ad_type, ad_id);
+            CREATE TABLE IF NOT EXISTS duplicates (
+                ad_type TEXT NOT NULL, ad_id TEXT NOT NULL, duplicate_of TEXT NOT NULL, similarity REAL NOT NULL,
+                found_at TEXT NOT NULL, PRIMARY KEY (ad_type, ad_id, duplicate_of));
+            CREATE INDEX IF NOT EXISTS duplicates_of ON duplicates (ad_type, duplicate_of);
+            CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT NOT NULL);
+        ''')
+        # indexes built before the band layout was recorded used 16 bands of 8 rows
+        layout = f'{NUM_BANDS}x{ROWS_PER_BAND}'
+        row = self._connection.execute("SELECT value FROM settings WHERE name = 'bands'").fetchone()
+        has_signatures = self._connection.execute('SELECT 1 FROM signatures LIMIT 1').fetchone() is not None
+        stored = row[0] if row is not None else '16x8' if has_signatures else layout
+        if stored != layout:
+            logging.info(f'Rebuilding the band buckets of {path} from {stored} to {layout} bands')
+            self._rebuild_bands()
+        self._connection.execute("INSERT OR REPLACE INTO settings (name, value) VALUES ('bands', ?)", (layout,))
+
+    def _rebuild_bands(self) -> None:
+        cursor = self._connection.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            cursor.execute('DELETE FROM bands')
+            rows = self._connection.execute('SELECT ad_type, ad_id, signature FROM signatures').fetchall()
+            cursor.executemany('INSERT INTO bands (ad_type, band, bucket, ad_id) VALUES (?, ?, ?, ?)',
+                               [(ad_type, band, key, ad_id) for ad_type, ad_id, blob in rows
+                                for band, key in enumerate(_band_keys(self._signature(blob)))])
+        except BaseException:
+            cursor.execute('ROLLBACK')
+            raise
+        cursor.execute('COMMIT')
+
+    def _signature(self, blob: bytes) -> Any:
+        import numpy as np
+
+        return np.frombuffer(blob, dtype=np.uint32)
+
+    def _candidates(self, cursor: sqlite3.Cursor, ad_type: str, ad_id: str, keys: List[int]) -> Set[str]:
+        condition = ' OR '.join(['(band = ? AND bucket = ?)'] * len(keys))
+        parameters = [ad_type, ad_id, *(value for band, key in enumerate(keys) for value in (band, key))]
+        rows = cursor.execute(f'SELECT DISTINCT ad_id FROM bands WHERE ad_type = ? AND ad_id != ? AND ({condition})',
+                              parameters)
+        return {row[0] for row in rows}
+
+    def add(self, ad_type: str, property: Dict) -> List[Duplicate]:
+        """
+        Indexes an ad, replacing its previous signature, and returns the indexed ads it duplicates,
+        the most similar first. Only ads indexed before it count, so an ad that is added again, e.g.
+        when a category is indexed once more, is never flagged as a duplicate of its own reposts.
+        Ads with too little to compare are neither indexed nor checked.
+        """
+        features = shingles(property)
+        if len(features) < MIN_SHINGLES:
+            return []
+        ad_id = property['_id']
+        signature = self.hasher.signature(features)
+        keys = _band_keys(signature)
+        duplicates = []
+        with self._lock:
+            cursor = self._connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                # the rowid of a signature is its insertion order, kept when the signature is replaced
+                indexed = cursor.execute('SELECT rowid FROM signatures WHERE ad_type = ? AND ad_id = ?',
+                                         (ad_type, ad_id)).fetchone()
+                candidates = sorted(self._candidates(cursor, ad_type, ad_id, keys))
+                for start in range(0, len(candidates), 500):
+                    chunk = candidates[start:start + 500]
+                    rows = cursor.execute(f'SELECT rowid, ad_id, signature FROM signatures WHERE ad_type = ? '
+                                          f'AND ad_id IN ({",".join("?" * len(chunk))})', [ad_type, *chunk])
+                    for rowid, other_id, blob in rows:
+                        if indexed is not None and rowid > indexed[0]:
+                            continue
+                        score = similarity(signature, self._signature(blob))
+                        if score >= self.threshold:
+                            duplicates.append(Duplicate(ad_id, other_id, score))
+                cursor.execute('DELETE FROM bands WHERE ad_type = ? AND ad_id = ?', (ad_type, ad_id))
+                cursor.execute('INSERT INTO signatures (ad_type, ad_id, signature) VALUES (?, ?, ?) '
+                               'ON CONFLICT (ad_type, ad_id) DO UPDATE SET signature = excluded.signature',
+                               (ad_type, ad_id, signature.tobytes()))
+                cursor.executemany('INSERT INTO bands (ad_type, band, bucket, ad_id) VALUES (?, ?, ?, ?)',
+                                   [(ad_type, band, key, ad_id) for band, key in enumerate(keys)])
+                found_at = datetime.now().isoformat()
+                cursor.executemany('INSERT OR REPLACE INTO duplicates (ad_type, ad_id, duplicate_of, similarity, '
+                                   'found_at) VALUES (?, ?, ?, ?, ?)',
+                                   [(ad_type, duplicate.ad_id, duplicate.duplicate_of, duplicate.similarity, found_at)
+                                    for duplicate in duplicates])
+            except BaseException:
+                cursor.execute('ROLLBACK')
+                raise
+            cursor.execute('COMMIT')
+        return sorted(duplicates, key=lambda duplicate: -duplicate.similarity)
+
+    def query(self, ad_type: str, property: Dict) -> List[Duplicate]:
+        """
+        Returns the indexed ads a property duplicates, without indexing it. As with `add`, only ads
+        indexed before it count if the property is indexed already.
+        """
+        features = shingles(property)
+        if len(features) < MIN_SHINGLES:
+            return []
+        ad_id = property.get('_id', '')
+        signature = self.hasher.signature(features)
+        duplicates = []
+        with self._lock:
+            cursor = self._connection.cursor()
+            indexed = cursor.execute('SELECT rowid FROM signatures WHERE ad_type = ? AND ad_id = ?',
+                                     (ad_type, ad_id)).fetchone()
+            for other_id in self._candidates(cursor, ad_type, ad_id, _band_keys(signature)):
+                rowid, blob = cursor.execute('SELECT rowid, signature FROM signatures WHERE ad_type = ? AND ad_id = ?',
+                                             (ad_type, other_id)).fetchone()
+                if indexed is not None and rowid > indexed[0]:
+                    continue
+                score = similarity(signature, self._signature(blob))
+                if score >= self.threshold:
+                    duplicates.append(Duplicate(property.get('_id'), other_id, score))
+        return sorted(duplicates, key=lambda duplicate: -duplicate.similarity)
+
+    def duplicates(self, ad_type: str, ad_id: Optional[str]=None) -> Iterator[Duplicate]:
+        """Yields the duplicates found in a category, or the ones involving `ad_id` in either direction."""
+        sql = 'SELECT ad_id, duplicate_of, similarity FROM duplicates WHERE ad_type = ?'
+        parameters = [ad_type]
+        if ad_id is not None:
+            sql += ' AND (ad_id = ? OR duplicate_of = ?)'
+            parameters.extend([ad_id, ad_id])
+        with self._lock:
+            rows = self._connection.execute(sql, parameters).fetchall()
+        for row in rows:
+            yield Duplicate(*row)
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+def dedup_category(ad_type: str, index: DedupIndex, writer: Any=None) -> Dict[str, int]:
+    """
+    Indexes every property of a category and, with a `writer`, stores the ids of the indexed
+    properties each one duplicates as its `Possible_duplicates`.
+    """
+    from db_tools import iter_properties
+
+    stats = {'properties': 0, 'duplicates': 0}
+    for batch in batches(iter_properties(ad_type), BATCH_SIZE):
+        for document in batch:
+            duplicates = index.add(ad_type, document)
+            if duplicates:
+                stats['duplicates'] += 1
+                if writer is not None:
+                    writer.save({'_id': document['_id'],
+                                 'Possible_duplicates': [duplicate.duplicate_of for duplicate in duplicates]},
+                                ad_type, merge=True)
+        stats['properties'] += len(batch)
+        logging.info(f'{ad_type}: {stats["properties"]} properties indexed, {stats["duplicates"]} duplicates')
+    if writer is not None:
+        writer.flush()
+    return stats
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    from storage import DEFAULT_STORAGE
+
+    parser.add_argument('ad_types', nargs='*', type=choice_of(TYPES), default=TYPES, metavar='ad_type')
+    parser.add_argument('--index', dest='index_path', default=DEDUP_PATH, help='dedup index database')
+    parser.add_argument('--threshold', type=float, default=SIMILARITY_THRESHOLD,
+                        help='minimum estimated Jaccard similarity of a duplicate')
+    parser.add_argument('--dry-run', action='store_true', help='only index and report, without marking the properties')
+    parser.add_argument('--storage', default=DEFAULT_STORAGE, help="where properties are stored: 'mongo' or 'sqlite:<path>'")
+
+
+def main(args: argparse.Namespace) -> Dict[str, Dict[str, int]]:
+    """Indexes the categories given on the command line and marks their duplicates."""
+    from db_tools import BufferedWriter, configure_storage
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+    configure_storage(args.storage)
+    index = DedupIndex(args.index_path, args.threshold)
+    writer = None if args.dry_run else BufferedWriter()
+    summaries = {}
+    try:
+        for ad_type in args.ad_types:
+            summaries[ad_type] = dedup_category(ad_type, index, writer)
+            logging.info(f'{ad_type}: {summaries[ad_type]}')
+    finally:
+        if writer is not None:
+            writer.close()
+        index.close()
+    return summaries
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    add_arguments(parser)
+    main(parser.parse_args())
@@ -0,0 +1,236 @@
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+import argparse
+import json
+import logging
+import os
+import shutil
+import uuid
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from db_tools import WRITE_LAG
+from utils import TYPES, batches, choice_of
+
+EXPORT_DIR = 'analytics'
+STATE_FILENAME = '_export_state.json'
+BATCH_SIZE = 50000
+EXPORT_LAG = WRITE_LAG
+DESCRIPTION = 'Export scraped properties into a partitioned Parquet dataset'
+
+_STRING_LIST = pa.list_(pa.string())
+
+# the typed columns of the exported dataset, matching what preprocess_property produces
+PROPERTY_SCHEMA = pa.schema([
+    ('_id', pa.string()),
+    ('Price', pa.int64()),
+    ('Area', pa.float64()),
+    ('Number_of_rooms', pa.int64()),
+    ('Floor', pa.int64()),
+    ('Number_of_floors', pa.int64()),
+    ('Year', pa.int64()),
+    ('Renovation_year', pa.int64()),
+    ('Address', pa.string()),
+    ('City', pa.string()),
+    ('Latitude', pa.float64()),
+    ('Longitude', pa.float64()),
+    ('House_number', pa.string()),
+    ('Building_type', pa.string()),
+    ('House_type', pa.string()),
+    ('Heating', pa.string()),
+    ('Furnishing', pa.string()),
+    ('Energy_consumption_class', pa.string()),
+    ('Plot_area', pa.string()),
+    ('Nearest_water_reservoir', pa.string()),
+    ('Distance_to_water_reservoir', pa.int64()),
+    ('Phone', pa.string()),
+    ('Broker', pa.bool_()),
+    ('Reserved', pa.bool_()),
+    ('Description', pa.string()),
+    ('Link', pa.string()),
+    ('Thumbnail', pa.string()),
+    ('Photos', _STRING_LIST),
+    ('Misc', _STRING_LIST),
+    ('Uploaded', pa.timestamp('us')),
+    ('Edited', pa.timestamp('us')),
+    ('Active_until', pa.timestamp('us')),
+    ('Date_scraped', pa.timestamp('us')),
+    ('Date_modified', pa.timestamp('us')),
+    ('Viewed', pa.int64()),
+    ('Saved', pa.int64()),
+    ('Heating_est', pa.string()),
+    ('Crimes_last_month', pa.int64()),
+    ('NO2', pa.string()),
+    ('KD10', pa.string()),
+    ('Kindergardens', _STRING_LIST),
+    ('Kindergardens_dist', _STRING_LIST),
+    ('Schools', _STRING_LIST),
+    ('Schools_dist', _STRING_LIST),
+    ('Supermarkets', _STRING_LIST),
+    ('Supermarkets_dist', _STRING_LIST),
+    ('Stop_names', _STRING_LIST),
+    ('Stop_dist', _STRING_LIST),
+    ('Buses', pa.list_(_STRING_LIST)),
+    # every field that has no column of its own, as a JSON object
+    ('Extra', pa.string()),
+    ('ad_type', pa.string()),
+    ('scrape_date', pa.string()),
+])
+PARTITION_COLUMNS = ['ad_type', 'scrape_date']
+
+
+def _coerce(value: Any, data_type: pa.DataType) -> Any:
+    """Returns the value if it fits the column type, None otherwise."""
+    if value is None:
+        return None
+    if pa.types.is_int64(data_type):
+        return value if isinstance(value, int) and not isinstance(value, bool) else None
+    if pa.types.is_float64(data_type):
+        return float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+    if pa.types.is_boolean(data_type):
+        return value if isinstance(value, bool) else None
+    if pa.types.is_timestamp(data_type):
+        return value if isinstance(value, datetime) else None
+    if pa.types.is_string(data_type):
+        return value if isinstance(value, str) else str(value)
+    if pa.types.is_list(data_type):
+        if not isinstance(value, (list, tuple)):
+            return None
+        return [_coerce(item, data_type.value_type) for item in value]
+    return value
+
+
+def to_row(document: Dict[str, Any], ad_type: str) -> Dict[str, Any]:
+    """Converts a stored property into a row of `PROPERTY_SCHEMA`."""
+    document = dict(document)
+    coordinates = document.pop('Coordinates', None)
+    row = {}
+    if isinstance(coordinates, (list, tuple)) and len(coordinates) == 2:
+        row['Latitude'], row['Longitude'] = _coerce(coordinates[0], pa.float64()), _coerce(coordinates[1], pa.float64())
+
+    for field in PROPERTY_SCHEMA:
+        if field.name in document:
+            value = _coerce(document[field.name], field.type)
+            # values that do not fit their column, e.g. an unconverted floor, stay in Extra
+            if value is not None or document[field.name] is None:
+                row[field.name] = value
+                del document[field.name]
+
+    row['Extra'] = json.dumps(document, default=str, ensure_ascii=False) if document else None
+    row['ad_type'] = ad_type
+    date_scraped = row.get('Date_scraped')
+    row['scrape_date'] = date_scraped.strftime('%Y-%m-%d') if date_scraped is not None else 'unknown'
+    return row
+
+
+def write_rows(rows: List[Dict[str, Any]], root: str, run_id: str) -> None:
+    """Appends rows to the dataset, one new file per partition they fall into."""
+    table = pa.Table.from_pylist(rows, schema=PROPERTY_SCHEMA)
+    pq.write_to_dataset(table, root, partition_cols=PARTITION_COLUMNS,
+                        basename_template=f'part-{run_id}-{{i}}.parquet',
+                        existing_data_behavior='overwrite_or_ignore')
+
+
+def load_state(root: str) -> Dict[str, str]:
+    path = os.path.join(root, STATE_FILENAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(root: str, state: Dict[str, str]) -> None:
+    path = os.path.join(root, STATE_FILENAME)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _partition_dir(root: str, ad_type: str) -> str:
+    return os.path.join(root, f'ad_type={ad_type}')
+
+
+def export_category(ad_type: str, root: str=EXPORT_DIR, full: bool=False, batch_size: int=BATCH_SIZE,
+                    lag: timedelta=EXPORT_LAG) -> int:
+    """
+    Appends the documents of a category written since the last export to the Parquet dataset in `root`,
+    partitioned by ad type and scrape date. Documents are picked by their `Date_modified`, so an ad that
+    was scraped again or updated in place, e.g. by the image, dedup or reparse jobs, is appended again
+    and its latest state is its row with the latest `Date_modified`. Documents stored before writes were
+    stamped have no `Date_modified` and are only exported by a `full` export, which rebuilds the
+    category's partition from scratch and swaps it in once complete. Every export stops at the same
+    cutoff, so the next one exports a document once. Returns the number of exported rows.
+    """
+    from db_tools import ensure_index, iter_properties
+    from storage import MODIFIED_FIELD
+
+    os.makedirs(root, exist_ok=True)
+    cutoff = datetime.now() - lag
+    query: Dict[str, Any] = {}
+    if not full:
+        query[MODIFIED_FIELD] = {'$lte': cutoff}
+        state = load_state(root)
+        if ad_type in state:
+            query[MODIFIED_FIELD]['$gt'] = datetime.fromisoformat(state[ad_type])
+        ensure_index(ad_type, MODIFIED_FIELD)
+    # a full export is written next to the dataset, where readers do not see it, hidden by its leading dot
+    target = os.path.join(root, f'.{ad_type}.full') if full else root
+    if full and os.path.exists(target):
+        shutil.rmtree(target)
+
+    run_id = f'{cutoff.strftime("%Y%m%d%H%M%S")}-{uuid.uuid4().hex[:8]}'
+    exported = 0
+    documents = iter_properties(ad_type, query, batch_size=1000)
+    if full:
+        # the query cannot keep the unstamped documents and drop the newest ones, which the next run exports
+        documents = (document for document in documents
+                     if document.get(MODIFIED_FIELD) is None or document[MODIFIED_FIELD] <= cutoff)
+    for i, batch in enumerate(batches(documents, batch_size)):
+        write_rows([to_row(document, ad_type) for document in batch], target, f'{run_id}-{i}')
+        exported += len(batch)
+        logging.info(f'Exported {exported} {ad_type} properties')
+
+    if full:
+        shutil.rmtree(_partition_dir(root, ad_type), ignore_errors=True)
+        if exported:
+            os.replace(_partition_dir(target, ad_type), _partition_dir(root, ad_type))
+        shutil.rmtree(target, ignore_errors=True)
+    state = load_state(root)
+    state[ad_type] = cutoff.isoformat()
+    save_state(root, state)
+    return exported
+
+
+def read_dataset(root: str=EXPORT_DIR, columns: Optional[List[str]]=None, filters: Optional[List]=None) -> Any:
+    """Reads the dataset into a pandas DataFrame, pushing column selection and filters down to Parquet."""
+    return pq.read_table(root, columns=columns, filters=filters,
+                         schema=PROPERTY_SCHEMA, partitioning='hive').to_pandas()
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    from storage import DEFAULT_STORAGE
+
+    parser.add_argument('ad_types', nargs='*', type=choice_of(TYPES), default=TYPES, metavar='ad_type')
+    parser.add_argument('--root', default=EXPORT_DIR)
+    parser.add_argument('--full', action='store_true', help='replace the exported categories with everything stored, not only what changed since the last run')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--storage', default=DEFAULT_STORAGE, help="where properties are stored: 'mongo' or 'sqlite:<path>'")
+
+
+def main(args: argparse.Namespace) -> None:
+    """Exports the categories given on the command line."""
+    from db_tools import configure_storage
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+    configure_storage(args.storage)
+    for ad_type in args.ad_types:
+        exported = export_category(ad_type, args.root, args.full, args.batch_size)
+        logging.info(f'{ad_type}: exported {exported} properties')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    add_arguments(parser)
+    main(parser.parse_args())
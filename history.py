@@ -0,0 +1,370 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from db_tools import WRITE_LAG
+from storage import MODIFIED_FIELD, iter_rows
+from utils import TYPES, batches, choice_of, dumps_document, loads_document
+import metrics
+
+HISTORY_PATH = os.path.join('history', 'history.db')
+BASE_URL = 'https://www.aruodas.lt'
+REVISIT_INTERVAL = timedelta(days=1)
+REVISIT_WORKERS = 4
+# a full snapshot is stored after this many deltas, so rebuilding a state replays a bounded number of them
+KEYFRAME_INTERVAL = 20
+# an ad is no longer revisited after this many visits in a row that could not be parsed
+MAX_FAILED_VISITS = 3
+# responses that mean the ad was taken down
+GONE_STATUS_CODES = {404, 410}
+SEED_LAG = WRITE_LAG
+SEED_BATCH_SIZE = 500
+# fields that change on every visit or do not come from the ad page, which are not tracked
+UNTRACKED_FIELDS = {'Date_scraped', MODIFIED_FIELD, 'Thumbnail', 'Photo_hashes', 'Thumbnail_hash',
+                    'Possible_duplicates'}
+DESCRIPTION = 'Revisit active ads and record how their price and counters change over time'
+
+
+@dataclass
+class PriceChange:
+    ad_type: str
+    ad_id: str
+    changed_at: datetime
+    old_price: Any
+    new_price: Any
+
+
+def diff(old: Dict, new: Dict) -> Tuple[Dict, List[str]]:
+    """Returns the tracked fields of `new` that differ from `old` and the fields `new` no longer has."""
+    changes = {key: value for key, value in new.items()
+               if key not in UNTRACKED_FIELDS and (key not in old or old[key] != value)}
+    removed = [key for key in old if key not in new and key not in UNTRACKED_FIELDS]
+    return changes, removed
+
+
+def _apply(state: Dict, changes: Dict, removed: Optional[List[str]]) -> Dict:
+    state.update(changes)
+    for key in removed or []:
+        state.pop(key, None)
+    return state
+
+
+class HistoryStore:
+    """
+    The history of every tracked ad as field-level deltas against its previous snapshot.
+
+    The first snapshot of an ad, and every `keyframe_interval`-th one after it, holds the whole
+    document, the ones in between only the fields that changed. The latest state of every ad is
+    kept next to them to diff new visits against and to schedule the next one, and price changes
+    are copied into a table indexed by time. Everything lives in one SQLite database in WAL mode,
+    so queries can run while ads are being revisited.
+    """
+    def __init__(self, path: str=HISTORY_PATH, keyframe_interval: int=KEYFRAME_INTERVAL):
+        self.path = path
+        self.keyframe_interval = keyframe_interval
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = self._connect()
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.executescript('''
+            CREATE TABLE IF NOT EXISTS heads (
+                ad_type TEXT NOT NULL, ad_id TEXT NOT NULL, state TEXT NOT NULL, last_visit TEXT NOT NULL,
+                next_visit TEXT NOT NULL, ended_at TEXT, failures INTEGER NOT NULL DEFAULT 0,
+                since_keyframe INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (ad_type, ad_id));
+            CREATE INDEX IF NOT EXISTS heads_next_visit ON heads (ad_type, next_visit) WHERE ended_at IS NULL;
+            CREATE TABLE IF NOT EXISTS snapshots (
+                ad_type TEXT NOT NULL, ad_id TEXT NOT NULL, taken_at TEXT NOT NULL,
+                keyframe INTEGER NOT NULL, changes TEXT NOT NULL, removed TEXT);
+            CREATE INDEX IF NOT EXISTS snapshots_ad ON snapshots (ad_type, ad_id, taken_at);
+            CREATE TABLE IF NOT EXISTS price_changes (
+                ad_type TEXT NOT NULL, ad_id TEXT NOT NULL, changed_at TEXT NOT NULL, old_price, new_price);
+            CREATE INDEX IF NOT EXISTS price_changes_changed_at ON price_changes (changed_at);
+            CREATE TABLE IF NOT EXISTS seeded (ad_type TEXT PRIMARY KEY, until TEXT NOT NULL);
+        ''')
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def record(self, ad_type: str, property: Dict, taken_at: Optional[datetime]=None,
+               revisit_interval: timedelta=REVISIT_INTERVAL) -> Optional[Dict]:
+        """
+        Records a visit of an ad and schedules the next one `revisit_interval` later.
+        Returns the fields that changed since the last visit, with None for the removed ones,
+        all of them for a new ad and None if nothing changed.
+        """
+        ad_id = property['_id']
+        taken_at = taken_at or datetime.now()
+        with self._lock:
+            cursor = self._connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                head = cursor.execute('SELECT state, since_keyframe FROM heads WHERE ad_type = ? AND ad_id = ?',
+                                      (ad_type, ad_id)).fetchone()
+                if head is None:
+                    changes, removed, keyframe, since_keyframe = dict(property), [], True, 0
+                else:
+                    old = loads_document(head[0])
+                    changes, removed = diff(old, property)
+                    if not changes and not removed:
+                        keyframe, since_keyframe = False, head[1]
+                    else:
+                        keyframe = head[1] + 1 >= self.keyframe_interval
+                        since_keyframe = 0 if keyframe else head[1] + 1
+                    if 'Price' in changes and old.get('Price') is not None:
+                        cursor.execute('INSERT INTO price_changes (ad_type, ad_id, changed_at, old_price, new_price) '
+                                       'VALUES (?, ?, ?, ?, ?)',
+                                       (ad_type, ad_id, taken_at.isoformat(), old['Price'], property['Price']))
+                        metrics.inc('scraper_price_changes_total', ad_type=ad_type)
+                if changes or removed or keyframe:
+                    stored_changes, stored_removed = (dict(property), []) if keyframe else (changes, removed)
+                    cursor.execute('INSERT INTO snapshots (ad_type, ad_id, taken_at, keyframe, changes, removed) '
+                                   'VALUES (?, ?, ?, ?, ?, ?)',
+                                   (ad_type, ad_id, taken_at.isoformat(), int(keyframe),
+                                    dumps_document(stored_changes), json.dumps(stored_removed) if stored_removed else None))
+                cursor.execute(
+                    'INSERT OR REPLACE INTO heads (ad_type, ad_id, state, last_visit, next_visit, ended_at, failures, '
+                    'since_keyframe) VALUES (?, ?, ?, ?, ?, NULL, 0, ?)',
+                    (ad_type, ad_id, dumps_document(property), taken_at.isoformat(),
+                     (taken_at + revisit_interval).isoformat(), since_keyframe))
+            except BaseException:
+                cursor.execute('ROLLBACK')
+                raise
+            cursor.execute('COMMIT')
+        if not changes and not removed:
+            return None
+        return {**changes, **dict.fromkeys(removed)}
+
+    def record_failure(self, ad_type: str, ad_id: str, at: Optional[datetime]=None,
+                       revisit_interval: timedelta=REVISIT_INTERVAL, max_failures: int=MAX_FAILED_VISITS) -> None:
+        """Schedules another visit of an ad that could not be parsed, or ends it after `max_failures` in a row."""
+        at = at or datetime.now()
+        with self._lock:
+            self._connection.execute(
+                'UPDATE heads SET failures = failures + 1, next_visit = ?, '
+                'ended_at = CASE WHEN failures + 1 >= ? THEN ? ELSE ended_at END WHERE ad_type = ? AND ad_id = ?',
+                ((at + revisit_interval).isoformat(), max_failures, at.isoformat(), ad_type, ad_id))
+
+    def end(self, ad_type: str, ad_id: str, at: Optional[datetime]=None) -> None:
+        """Marks an ad as taken down, so it is not revisited anymore."""
+        with self._lock:
+            self._connection.execute('UPDATE heads SET ended_at = ? WHERE ad_type = ? AND ad_id = ?',
+                                     ((at or datetime.now()).isoformat(), ad_type, ad_id))
+
+    def due(self, ad_type: str, now: Optional[datetime]=None, limit: Optional[int]=None) -> List[str]:
+        """Returns the ids of the active ads whose next visit is due, the longest overdue first."""
+        sql = ('SELECT ad_id FROM heads WHERE ad_type = ? AND ended_at IS NULL AND next_visit <= ? '
+               'ORDER BY next_visit')
+        parameters: List[Any] = [ad_type, (now or datetime.now()).isoformat()]
+        if limit is not None:
+            sql += ' LIMIT ?'
+            parameters.append(limit)
+        with self._lock:
+            return [row[0] for row in self._connection.execute(sql, parameters)]
+
+    def tracked(self, ad_type: str, ad_ids: Iterable[str]) -> List[str]:
+        """Returns which of the given ads are tracked already."""
+        ad_ids = list(ad_ids)
+        found = []
+        with self._lock:
+            for start in range(0, len(ad_ids), 500):
+                chunk = ad_ids[start:start + 500]
+                rows = self._connection.execute(
+                    f'SELECT ad_id FROM heads WHERE ad_type = ? AND ad_id IN ({",".join("?" * len(chunk))})',
+                    [ad_type, *chunk])
+                found.extend(row[0] for row in rows)
+        return found
+
+    def seeded_until(self, ad_type: str) -> Optional[datetime]:
+        with self._lock:
+            row = self._connection.execute('SELECT until FROM seeded WHERE ad_type = ?', (ad_type,)).fetchone()
+        return datetime.fromisoformat(row[0]) if row is not None else None
+
+    def set_seeded_until(self, ad_type: str, until: datetime) -> None:
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO seeded (ad_type, until) VALUES (?, ?)',
+                                     (ad_type, until.isoformat()))
+
+    def state_at(self, ad_type: str, ad_id: str, at: Optional[datetime]=None) -> Optional[Dict]:
+        """Rebuilds an ad as it was at `at`, now by default, from its last keyframe before then and the deltas after it."""
+        at = (at or datetime.now()).isoformat()
+        rows = iter_rows(
+            self._connect,
+            'SELECT changes, removed FROM snapshots WHERE ad_type = ? AND ad_id = ? AND taken_at <= ? '
+            'AND taken_at >= (SELECT MAX(taken_at) FROM snapshots '
+            'WHERE ad_type = ? AND ad_id = ? AND taken_at <= ? AND keyframe = 1) ORDER BY taken_at, rowid',
+            [ad_type, ad_id, at, ad_type, ad_id, at])
+        state = None
+        for changes, removed in rows:
+            state = _apply(state or {}, loads_document(changes), json.loads(removed) if removed else None)
+        return state
+
+    def snapshots(self, ad_type: str, ad_id: str) -> Iterator[Tuple[datetime, Dict, List[str]]]:
+        """Yields (time, changed fields, removed fields) of every snapshot of an ad, oldest first."""
+        rows = iter_rows(self._connect, 'SELECT taken_at, changes, removed FROM snapshots '
+                         'WHERE ad_type = ? AND ad_id = ? ORDER BY taken_at, rowid', [ad_type, ad_id])
+        for taken_at, changes, removed in rows:
+            yield datetime.fromisoformat(taken_at), loads_document(changes), json.loads(removed) if removed else []
+
+    def price_changes(self, start: datetime, end: datetime, ad_type: Optional[str]=None,
+                      batch_size: int=1000) -> Iterator[PriceChange]:
+        """Streams the price changes seen in [start, end), ordered by time."""
+        sql = 'SELECT ad_type, ad_id, changed_at, old_price, new_price FROM price_changes ' \
+              'WHERE changed_at >= ? AND changed_at < ?'
+        parameters = [start.isoformat(), end.isoformat()]
+        if ad_type is not None:
+            sql += ' AND ad_type = ?'
+            parameters.append(ad_type)
+        rows = iter_rows(self._connect, f'{sql} ORDER BY changed_at', parameters, batch_size)
+        for ad_type, ad_id, changed_at, old_price, new_price in rows:
+            yield PriceChange(ad_type, ad_id, datetime.fromisoformat(changed_at), old_price, new_price)
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+def seed(ad_type: str, history: HistoryStore, lag: timedelta=SEED_LAG,
+         revisit_interval: timedelta=REVISIT_INTERVAL) -> int:
+    """
+    Starts tracking the ads of a category scraped since the last run, with the stored document as
+    their first snapshot taken when it was scraped. Returns the number of ads that are tracked now.
+    """
+    from db_tools import ensure_index, iter_properties
+
+    cutoff = datetime.now() - lag
+    query: Dict[str, Any] = {'Date_scraped': {'$lte': cutoff}}
+    since = history.seeded_until(ad_type)
+    if since is not None:
+        query['Date_scraped']['$gt'] = since
+    ensure_index(ad_type, 'Date_scraped')
+
+    seeded = 0
+    for batch in batches(iter_properties(ad_type, query), SEED_BATCH_SIZE):
+        tracked = set(history.tracked(ad_type, (document['_id'] for document in batch)))
+        for document in batch:
+            if document['_id'] not in tracked:
+                # Mongo returns the coordinates as a list, which would differ from those of every parsed page
+                if isinstance(document.get('Coordinates'), list):
+                    document['Coordinates'] = tuple(document['Coordinates'])
+                history.record(ad_type, document, document.get('Date_scraped'), revisit_interval)
+                seeded += 1
+    history.set_seeded_until(ad_type, cutoff)
+    return seeded
+
+
+class AdGone(Exception):
+    """The page of an ad no longer shows it, e.g. it shows no price or redirects to another ad."""
+
+
+def _is_gone(e: Exception) -> bool:
+    if isinstance(e, AdGone):
+        return True
+    response = getattr(e, 'response', None)
+    return getattr(response, 'status_code', None) in GONE_STATUS_CODES
+
+
+def revisit(ad_type: str, history: HistoryStore, fetch_html: Optional[Callable[..., str]]=None,
+            base_url: str=BASE_URL, workers: int=REVISIT_WORKERS, limit: Optional[int]=None,
+            revisit_interval: timedelta=REVISIT_INTERVAL) -> Dict[str, int]:
+    """
+    Scrapes the ads of a category that are due again and records what changed. Ads whose page is
+    gone are no longer revisited: pages that are not found, and, as the Chrome backend renders error
+    pages without raising, pages without a price or an ad id and pages of another ad the site
+    redirected to. Pages are fetched with `fetch_html`, `get_html` by default.
+    """
+    from parsing_tools import extract_ad_id, parse_property, preprocess_property
+
+    if fetch_html is None:
+        from scraping_tools import get_html as fetch_html
+
+    def visit(ad_id: str) -> Tuple[str, Optional[Dict], Optional[Exception]]:
+        try:
+            property = parse_property(fetch_html(f'{base_url.rstrip("/")}/{ad_id}/'))
+            linked_id = extract_ad_id(property.get('Nuoroda') or '')
+            if linked_id is None or not property.get('Price'):
+                raise AdGone('the page shows no ad id or price')
+            if linked_id != ad_id:
+                raise AdGone(f'the page shows {linked_id}')
+            return ad_id, preprocess_property(property), None
+        except Exception as e:
+            return ad_id, None, e
+
+    stats = {'visited': 0, 'changed': 0, 'unchanged': 0, 'gone': 0, 'failed': 0}
+    ad_ids = history.due(ad_type, limit=limit)
+    logging.info(f'{ad_type}: revisiting {len(ad_ids)} ads')
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='history') as executor:
+        for ad_id, property, error in executor.map(visit, ad_ids):
+            stats['visited'] += 1
+            if error is not None:
+                if _is_gone(error):
+                    logging.info(f'Property {ad_id} is gone: {error}')
+                    history.end(ad_type, ad_id)
+                    stats['gone'] += 1
+                else:
+                    logging.error(f'Could not revisit property {ad_id}: {error}')
+                    history.record_failure(ad_type, ad_id, revisit_interval=revisit_interval)
+                    stats['failed'] += 1
+                continue
+            changes = history.record(ad_type, property, revisit_interval=revisit_interval)
+            stats['changed' if changes else 'unchanged'] += 1
+            if changes:
+                logging.info(f'Property {ad_id} changed: {", ".join(sorted(changes))}')
+    return stats
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    from scraping_tools import FETCH_BACKENDS
+    from storage import DEFAULT_STORAGE
+
+    parser.add_argument('ad_types', nargs='*', type=choice_of(TYPES), default=TYPES, metavar='ad_type')
+    parser.add_argument('--history', dest='history_path', default=HISTORY_PATH, help='history database')
+    parser.add_argument('--interval-hours', type=float, default=REVISIT_INTERVAL.total_seconds() / 3600,
+                        help='time between two visits of an active ad')
+    parser.add_argument('--workers', type=int, default=REVISIT_WORKERS, help='concurrent page fetches')
+    parser.add_argument('--limit', type=int, help='maximum number of ads revisited per category')
+    parser.add_argument('--no-seed', dest='seed', action='store_false',
+                        help='do not start tracking ads scraped since the last run')
+    parser.add_argument('--backend', choices=FETCH_BACKENDS, default='chrome',
+                        help='fetch pages with headless Chrome or plain HTTP with Chrome fallback')
+    parser.add_argument('--rate', type=float, help='maximum page loads per second to the site')
+    parser.add_argument('--base-url', default=BASE_URL, help='site to scrape, e.g. a local mirror')
+    parser.add_argument('--storage', default=DEFAULT_STORAGE, help="where properties are stored: 'mongo' or 'sqlite:<path>'")
+
+
+def main(args: argparse.Namespace) -> Dict[str, Dict[str, int]]:
+    """Seeds and revisits the categories given on the command line."""
+    from db_tools import configure_storage
+    from scraping_tools import configure_driver_pool, configure_rate_limit, set_fetch_backend
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+    configure_storage(args.storage)
+    set_fetch_backend(args.backend)
+    configure_driver_pool(size=args.workers)
+    configure_rate_limit(args.rate)
+    interval = timedelta(hours=args.interval_hours)
+    history = HistoryStore(args.history_path)
+    summaries = {}
+    try:
+        for ad_type in args.ad_types:
+            seeded = seed(ad_type, history, revisit_interval=interval) if args.seed else 0
+            summaries[ad_type] = dict(revisit(ad_type, history, base_url=args.base_url, workers=args.workers,
+                                              limit=args.limit, revisit_interval=interval), seeded=seeded)
+            logging.info(f'{ad_type}: {summaries[ad_type]}')
+    finally:
+        history.close()
+    return summaries
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    add_arguments(parser)
+    main(parser.parse_args())
@@ -0,0 +1,192 @@
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Iterator, List, Optional, Tuple
+import gzip
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+from parsing_tools import extract_ad_id
+
+ARCHIVE_DIR = 'raw_html'
+INDEX_FILENAME = 'index.sqlite'
+SEGMENT_SIZE = 256 * 1024 * 1024
+COMPRESSION_LEVEL = 6
+
+
+@dataclass
+class ArchiveRecord:
+    """Where a single archived page is stored."""
+    ad_id: Optional[str]
+    url: str
+    fetched_at: datetime
+    segment: str
+    offset: int
+    length: int
+
+
+class HtmlArchive:
+    """
+    An append-only archive of raw HTML pages.
+
+    Every page is compressed into its own gzip member and appended to a segment file, so a page
+    can be read back with a single seek. Segments are rotated at `segment_size` bytes and belong
+    to a single process, while the SQLite index (in WAL mode) is shared, which makes appending
+    from several threads and processes at the same time safe.
+    """
+    def __init__(self, root: str=ARCHIVE_DIR, segment_size: int=SEGMENT_SIZE):
+        self.root = root
+        self.segment_size = segment_size
+        self.pid = os.getpid()
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._segment_file = None
+        self._segment_name = None
+        self._segment_number = 0
+        self._db = sqlite3.connect(os.path.join(root, INDEX_FILENAME), timeout=60, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('''
+            CREATE TABLE IF NOT EXISTS pages (
+                id INTEGER PRIMARY KEY,
+                ad_id TEXT,
+                url TEXT NOT NULL,
+                fetched_at TEXT NOT NULL,
+                segment TEXT NOT NULL,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL
+            )''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS pages_ad_id ON pages (ad_id, fetched_at)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS pages_url ON pages (url, fetched_at)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS pages_fetched_at ON pages (fetched_at)')
+        self._db.commit()
+
+    def _open_segment(self) -> None:
+        if self._segment_file is not None:
+            self._segment_file.close()
+        self._segment_number += 1
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        self._segment_name = f'segment_{timestamp}_{self.pid}_{self._segment_number:04d}.gz'
+        self._segment_file = open(os.path.join(self.root, self._segment_name), 'ab')
+
+    def append(self, url: str, html_content: str, fetched_at: Optional[datetime]=None) -> ArchiveRecord:
+        """Compresses and appends a page, then indexes it by ad id, URL and fetch time."""
+        fetched_at = fetched_at or datetime.now()
+        data = gzip.compress(html_content.encode('utf-8'), compresslevel=COMPRESSION_LEVEL)
+        with self._lock:
+            if self._segment_file is None or self._segment_file.tell() + len(data) > self.segment_size:
+                self._open_segment()
+            offset = self._segment_file.tell()
+            self._segment_file.write(data)
+            self._segment_file.flush()
+            record = ArchiveRecord(extract_ad_id(url), url, fetched_at, self._segment_name, offset, len(data))
+            self._db.execute(
+                'INSERT INTO pages (ad_id, url, fetched_at, segment, offset, length) VALUES (?, ?, ?, ?, ?, ?)',
+                (record.ad_id, record.url, record.fetched_at.isoformat(), record.segment, record.offset,
+                 record.length))
+            self._db.commit()
+        return record
+
+    @staticmethod
+    def read_segment(root: str, record: ArchiveRecord) -> str:
+        """Reads a record from the segments in `root` without opening the index."""
+        with open(os.path.join(root, record.segment), 'rb') as f:
+            f.seek(record.offset)
+            return gzip.decompress(f.read(record.length)).decode('utf-8')
+
+    def read_record(self, record: ArchiveRecord) -> str:
+        return self.read_segment(self.root, record)
+
+    def _query(self, where: str='', parameters: Tuple=()) -> List[ArchiveRecord]:
+        with self._lock:
+            rows = self._db.execute(
+                f'SELECT ad_id, url, fetched_at, segment, offset, length FROM pages {where}', parameters).fetchall()
+        return [ArchiveRecord(ad_id, url, datetime.fromisoformat(fetched_at), segment, offset, length)
+                for ad_id, url, fetched_at, segment, offset, length in rows]
+
+    def find(self, ad_id: Optional[str]=None, url: Optional[str]=None) -> Optional[ArchiveRecord]:
+        """Returns the most recent record of the given ad id or URL."""
+        if ad_id is not None:
+            records = self._query('WHERE ad_id = ? ORDER BY fetched_at DESC LIMIT 1', (ad_id,))
+        elif url is not None:
+            records = self._query('WHERE url = ? ORDER BY fetched_at DESC LIMIT 1', (url,))
+        else:
+            raise ValueError('Either ad_id or url is required')
+        return records[0] if records else None
+
+    def read(self, ad_id: Optional[str]=None, url: Optional[str]=None) -> Optional[str]:
+        """Returns the most recently archived HTML of the given ad id or URL."""
+        record = self.find(ad_id, url)
+        return self.read_record(record) if record is not None else None
+
+    def records(self, since: Optional[datetime]=None, until: Optional[datetime]=None) -> List[ArchiveRecord]:
+        """Returns the records fetched in the given time range, ordered by segment and offset."""
+        conditions, parameters = [], []
+        if since is not None:
+            conditions.append('fetched_at >= ?')
+            parameters.append(since.isoformat())
+        if until is not None:
+            conditions.append('fetched_at < ?')
+            parameters.append(until.isoformat())
+        where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+        return self._query(f'{where} ORDER BY segment, offset', tuple(parameters))
+
+    def latest_records(self) -> List[ArchiveRecord]:
+        """Returns the most recent record of every ad, ordered by segment and offset."""
+        return self._query('''
+            WHERE id IN (
+                SELECT id FROM pages AS latest
+                WHERE ad_id IS NOT NULL AND fetched_at = (
+                    SELECT MAX(fetched_at) FROM pages WHERE ad_id = latest.ad_id)
+                GROUP BY ad_id)
+            ORDER BY segment, offset''')
+
+    def iter_pages(self, records: Optional[List[ArchiveRecord]]=None) -> Iterator[Tuple[ArchiveRecord, str]]:
+        """Yields the given records, all of them by default, together with their HTML."""
+        records = self.records() if records is None else records
+        segment_file, segment = None, None
+        try:
+            for record in records:
+                if record.segment != segment:
+                    if segment_file is not None:
+                        segment_file.close()
+                    segment = record.segment
+                    segment_file = open(os.path.join(self.root, segment), 'rb')
+                segment_file.seek(record.offset)
+                yield record, gzip.decompress(segment_file.read(record.length)).decode('utf-8')
+        finally:
+            if segment_file is not None:
+                segment_file.close()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._segment_file is not None:
+                self._segment_file.close()
+                self._segment_file = None
+            self._db.close()
+
+
+_LEGACY_FILENAME = re.compile(r'(?P<base>.+)_(?P<timestamp>\d{8}_\d{6})\.html')
+
+
+def import_html_files(archive: HtmlArchive, directory: str, remove: bool=False) -> int:
+    """
+    Moves pages saved as separate `.html` files by older versions of `get_html` into the archive.
+    The URL and fetch time are recovered from the file name. Returns the number of imported files.
+    """
+    imported = 0
+    for entry in os.scandir(directory):
+        match = _LEGACY_FILENAME.fullmatch(entry.name)
+        if match is None or not entry.is_file():
+            continue
+        url = 'https://www.' + match.group('base').replace('_', '/') + '/'
+        fetched_at = datetime.strptime(match.group('timestamp'), '%Y%m%d_%H%M%S')
+        with open(entry.path) as f:
+            archive.append(url, f.read(), fetched_at)
+        if remove:
+            os.remove(entry.path)
+        imported += 1
+        if imported % 1000 == 0:
+            logging.info(f'Imported {imported} files from {directory}')
+    return imported
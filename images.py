@@ -0,0 +1,315 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlsplit
+import argparse
+import hashlib
+import itertools
+import logging
+import mimetypes
+import os
+import sqlite3
+import tempfile
+import threading
+
+from metrics import timed
+from utils import TYPES, FatalError, batches, choice_of, retry
+import metrics
+
+IMAGE_DIR = 'images'
+INDEX_FILENAME = 'index.db'
+IMAGE_WORKERS = 16
+PER_HOST_LIMIT = 4
+IMAGE_TIMEOUT = 30
+MAX_IMAGE_BYTES = 20 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+BATCH_SIZE = 50
+MAX_IMAGE_RETRIES = 3
+IMAGE_RETRY_WAIT_TIME = 2
+# responses that mean the image is gone for good
+DEAD_STATUS_CODES = {404, 410}
+# content types that say nothing about the content, so the image format is told by its leading bytes
+GENERIC_CONTENT_TYPES = {None, 'application/octet-stream', 'binary/octet-stream', 'application/binary'}
+IMAGE_SIGNATURES = [(b'\xff\xd8\xff', 'image/jpeg'), (b'\x89PNG\r\n\x1a\n', 'image/png'),
+                    (b'GIF87a', 'image/gif'), (b'GIF89a', 'image/gif'), (b'BM', 'image/bmp')]
+# what a download that failed for now, e.g. on a timeout, resolves to, unlike the None of a dead link
+_UNRESOLVED = object()
+DESCRIPTION = 'Download property photos and thumbnails into a content-addressed image store'
+
+
+class DeadLink(FatalError):
+    """The image is gone, so it is not retried and recorded as dead."""
+
+
+class NotAnImage(Exception):
+    """The response is not an image, e.g. an error page served with status 200, so it is tried again later."""
+
+
+def sniff_image_type(content: bytes) -> Optional[str]:
+    """Returns the content type of an image from its leading bytes, None if it is not a known format."""
+    if content[:4] == b'RIFF' and content[8:12] == b'WEBP':
+        return 'image/webp'
+    for signature, content_type in IMAGE_SIGNATURES:
+        if content.startswith(signature):
+            return content_type
+    return None
+
+
+class ImageStore:
+    """
+    Images stored once per content under `root`/ab/cd/<sha256><ext>, with an index of every
+    downloaded URL and the hash of its content, so reposted photos take no extra space and
+    URLs that were already downloaded, or found dead, are not fetched again.
+    """
+    def __init__(self, root: str=IMAGE_DIR):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(os.path.join(root, INDEX_FILENAME), timeout=60,
+                                           isolation_level=None, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('''CREATE TABLE IF NOT EXISTS urls (
+            url TEXT PRIMARY KEY, sha256 TEXT, size INTEGER, content_type TEXT,
+            fetched_at TEXT NOT NULL, dead INTEGER NOT NULL DEFAULT 0, error TEXT)''')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS urls_sha256 ON urls (sha256)')
+
+    def path(self, sha256: str, extension: str='') -> str:
+        return os.path.join(self.root, sha256[:2], sha256[2:4], f'{sha256}{extension}')
+
+    def lookup(self, urls: Iterable[str]) -> Dict[str, Tuple[Optional[str], bool]]:
+        """Returns (hash, dead) of the given URLs that are in the index."""
+        urls = list(urls)
+        found = {}
+        with self._lock:
+            for start in range(0, len(urls), 500):
+                chunk = urls[start:start + 500]
+                rows = self._connection.execute(
+                    f'SELECT url, sha256, dead FROM urls WHERE url IN ({",".join("?" * len(chunk))})', chunk)
+                found.update((url, (sha256, bool(dead))) for url, sha256, dead in rows)
+        return found
+
+    def add(self, url: str, temp_path: str, sha256: str, size: int, content_type: Optional[str]) -> bool:
+        """Moves a downloaded file into the store, unless its content is there already. Returns if it was new."""
+        extension = mimetypes.guess_extension(content_type or '') or os.path.splitext(urlsplit(url).path)[1]
+        path = self.path(sha256, extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        new = not os.path.exists(path)
+        if new:
+            os.replace(temp_path, path)
+        else:
+            os.remove(temp_path)
+        self._record(url, sha256, size, content_type, dead=False, error=None)
+        return new
+
+    def mark_dead(self, url: str, error: str) -> None:
+        self._record(url, None, None, None, dead=True, error=error)
+
+    def _record(self, url: str, sha256: Optional[str], size: Optional[int], content_type: Optional[str],
+                dead: bool, error: Optional[str]) -> None:
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO urls (url, sha256, size, content_type, fetched_at, dead, error) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (url, sha256, size, content_type, datetime.now().isoformat(), int(dead), error))
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+class ImageDownloader:
+    """
+    Downloads images concurrently over pooled keep-alive connections,
+    with at most `per_host` downloads from any one host at a time.
+    """
+    def __init__(self, store: ImageStore, workers: int=IMAGE_WORKERS, per_host: int=PER_HOST_LIMIT,
+                 session: Any=None):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.store = store
+        self.workers = workers
+        self.per_host = per_host
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='images')
+        self._host_slots: Dict[str, threading.BoundedSemaphore] = {}
+        self._host_lock = threading.Lock()
+
+    def _slot(self, url: str) -> threading.BoundedSemaphore:
+        host = urlsplit(url).netloc
+        with self._host_lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.per_host)
+            return self._host_slots[host]
+
+    @timed('fetch_image')
+    @retry(max_retries=MAX_IMAGE_RETRIES, wait_time=IMAGE_RETRY_WAIT_TIME, random_wait=True, max_wait=60)
+    def fetch(self, url: str) -> str:
+        """Downloads one image into the store and returns its hash."""
+        with self._slot(url):
+            response = self.session.get(url, stream=True, timeout=IMAGE_TIMEOUT)
+            try:
+                if response.status_code in DEAD_STATUS_CODES:
+                    raise DeadLink(f'HTTP {response.status_code}')
+                response.raise_for_status()
+                content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower() or None
+                chunks = response.iter_content(CHUNK_SIZE)
+                if content_type not in GENERIC_CONTENT_TYPES and not content_type.startswith('image/'):
+                    raise NotAnImage(f'not an image: {content_type}')
+                if content_type in GENERIC_CONTENT_TYPES:
+                    first = next(chunks, b'')
+                    content_type = sniff_image_type(first)
+                    if content_type is None:
+                        raise NotAnImage(f'not an image: {first[:16]!r}')
+                    chunks = itertools.chain([first], chunks)
+                digest, size = hashlib.sha256(), 0
+                # hashed while streaming to a temporary file in the store, so the final move is atomic
+                with tempfile.NamedTemporaryFile(dir=self.store.root, suffix='.part', delete=False) as f:
+                    try:
+                        for chunk in chunks:
+                            size += len(chunk)
+                            if size > MAX_IMAGE_BYTES:
+                                raise DeadLink(f'larger than {MAX_IMAGE_BYTES} bytes')
+                            digest.update(chunk)
+                            f.write(chunk)
+                    except BaseException:
+                        f.close()
+                        os.remove(f.name)
+                        raise
+            finally:
+                response.close()
+        sha256 = digest.hexdigest()
+        new = self.store.add(url, f.name, sha256, size, content_type)
+        metrics.inc('scraper_images_downloaded_total')
+        metrics.inc('scraper_image_bytes_total', size)
+        if not new:
+            metrics.inc('scraper_images_deduplicated_total')
+        return sha256
+
+    def _fetch_or_unresolved(self, url: str) -> Any:
+        try:
+            return self.fetch(url)
+        except DeadLink as e:
+            logging.info(f'Image {url} is dead: {e}')
+            self.store.mark_dead(url, str(e))
+            return None
+        except Exception as e:
+            logging.error(f'Could not download image {url}: {e}')
+            return _UNRESOLVED
+
+    def download(self, urls: Iterable[str], retry_dead: bool=False) -> Dict[str, Optional[str]]:
+        """
+        Returns the hash of every URL that is resolved, None for dead links. URLs that failed for now,
+        e.g. on a timeout, are left out so they can be tried again. URLs in the index are not
+        downloaded again, and dead ones are only tried again with `retry_dead`.
+        """
+        urls = list(dict.fromkeys(url for url in urls if url))
+        hashes = {}
+        known = self.store.lookup(urls)
+        missing = []
+        for url in urls:
+            sha256, dead = known.get(url, (None, False))
+            if sha256 is not None or (dead and not retry_dead):
+                hashes[url] = sha256
+            else:
+                missing.append(url)
+        for url, sha256 in zip(missing, self._executor.map(self._fetch_or_unresolved, missing)):
+            if sha256 is not _UNRESOLVED:
+                hashes[url] = sha256
+        return hashes
+
+    def close(self) -> None:
+        self._executor.shutdown()
+        self.session.close()
+
+
+def image_urls(property: Dict) -> List[str]:
+    return [url for url in [*(property.get('Photos') or []), property.get('Thumbnail')] if url]
+
+
+def download_category(ad_type: str, downloader: ImageDownloader, writer: Any, retry_failed: bool=False,
+                      limit: Optional[int]=None) -> Dict[str, int]:
+    """
+    Downloads the images of the properties of a category that have none recorded yet and stores
+    their hashes on the properties as `Photo_hashes`, aligned with `Photos`, and `Thumbnail_hash`,
+    with None for dead links. A property is only updated once every one of its images is downloaded
+    or dead, so images that failed for now are tried again by the next run.
+    With `retry_failed` properties with dead links are tried again as well.
+    """
+    from db_tools import iter_properties
+
+    query = None if retry_failed else {'Photo_hashes': {'$exists': False}}
+    stats = {'properties': 0, 'images': 0, 'missing': 0, 'deferred': 0}
+    documents = iter_properties(ad_type, query)
+    if retry_failed:
+        documents = (document for document in documents
+                     if 'Photo_hashes' not in document or None in document['Photo_hashes']
+                     or (document.get('Thumbnail') and document.get('Thumbnail_hash') is None))
+    for batch in batches(documents, BATCH_SIZE):
+        if limit is not None:
+            batch = batch[:max(0, limit - stats['properties'])]
+            if not batch:
+                break
+        hashes = downloader.download((url for document in batch for url in image_urls(document)),
+                                     retry_dead=retry_failed)
+        for document in batch:
+            urls = image_urls(document)
+            if any(url not in hashes for url in urls):
+                stats['deferred'] += 1
+                continue
+            update = {'_id': document['_id'],
+                      'Photo_hashes': [hashes.get(url) for url in document.get('Photos') or []]}
+            if document.get('Thumbnail'):
+                update['Thumbnail_hash'] = hashes[document['Thumbnail']]
+            writer.save(update, ad_type, merge=True)
+            stats['images'] += len(urls)
+            stats['missing'] += sum(hashes[url] is None for url in urls)
+        stats['properties'] += len(batch)
+        logging.info(f'{ad_type}: images of {stats["properties"]} properties, {stats["missing"]} dead, '
+                     f'{stats["deferred"]} properties left for the next run')
+    writer.flush()
+    return stats
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    from storage import DEFAULT_STORAGE
+
+    parser.add_argument('ad_types', nargs='*', type=choice_of(TYPES), default=TYPES, metavar='ad_type')
+    parser.add_argument('--image-dir', default=IMAGE_DIR)
+    parser.add_argument('--workers', type=int, default=IMAGE_WORKERS, help='concurrent downloads')
+    parser.add_argument('--per-host', type=int, default=PER_HOST_LIMIT, help='concurrent downloads from one host')
+    parser.add_argument('--retry-failed', action='store_true', help='try dead images again')
+    parser.add_argument('--limit', type=int, help='maximum number of properties per category')
+    parser.add_argument('--storage', default=DEFAULT_STORAGE, help="where properties are stored: 'mongo' or 'sqlite:<path>'")
+
+
+def main(args: argparse.Namespace) -> Dict[str, Dict[str, int]]:
+    """Downloads the images of the categories given on the command line."""
+    from db_tools import BufferedWriter, configure_storage
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+    configure_storage(args.storage)
+    store = ImageStore(args.image_dir)
+    downloader = ImageDownloader(store, args.workers, args.per_host)
+    writer = BufferedWriter()
+    summaries = {}
+    try:
+        for ad_type in args.ad_types:
+            summaries[ad_type] = download_category(ad_type, downloader, writer, args.retry_failed, args.limit)
+            logging.info(f'{ad_type}: {summaries[ad_type]}')
+    finally:
+        writer.close()
+        downloader.close()
+        store.close()
+    return summaries
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    add_arguments(parser)
+    main(parser.parse_args())
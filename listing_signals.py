@@ -0,0 +1,42 @@
+from typing import Optional
+import dbm
+import os
+
+LISTING_SIGNALS_DIR = 'listing_signals'
+
+
+class ListingSignals:
+    """
+    The last listing-level signal (the price shown on the listing page) of every scraped ad,
+    kept in an on-disk key-value store so it does not have to be loaded into memory.
+    Not thread-safe, callers sharing it between threads have to lock around it.
+    """
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self._db = dbm.open(path, 'c')
+
+    def get(self, ad_id: str) -> Optional[str]:
+        value = self._db.get(ad_id.encode())
+        return value.decode() if value is not None else None
+
+    def set(self, ad_id: str, signal: str) -> None:
+        self._db[ad_id.encode()] = signal.encode()
+
+    def changed(self, ad_id: str, signal: Optional[str]) -> bool:
+        """Returns True if a signal was stored before and differs from the given one."""
+        if signal is None:
+            return False
+        previous = self.get(ad_id)
+        return previous is not None and previous != signal
+
+    def sync(self) -> None:
+        if hasattr(self._db, 'sync'):
+            self._db.sync()
+
+    def close(self) -> None:
+        self._db.close()
+
+
+def open_listing_signals(ad_type: str, directory: str=LISTING_SIGNALS_DIR) -> ListingSignals:
+    return ListingSignals(os.path.join(directory, ad_type))
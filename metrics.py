@@ -0,0 +1,295 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, List, Optional, Tuple
+import glob
+import json
+import logging
+import os
+import threading
+
+METRICS_DIR = 'metrics'
+DUMP_INTERVAL = 15
+# latency bucket upper bounds in seconds, from single extractors up to Chrome page loads
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+STAGE_SECONDS = 'scraper_stage_seconds'
+STAGE_ERRORS = 'scraper_stage_errors_total'
+
+if TYPE_CHECKING:
+    from http.server import ThreadingHTTPServer
+
+Labels = Tuple[Tuple[str, str], ...]
+
+_enabled = os.environ.get('SCRAPER_METRICS', '') not in ('', '0')
+
+
+def enable(enabled: bool=True) -> None:
+    """Turns metric recording on or off for this process."""
+    global _enabled
+    _enabled = enabled
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def _labels(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram in the Prometheus sense."""
+    def __init__(self, buckets: Tuple[float, ...]=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'buckets': list(self.buckets), 'counts': list(self.counts), 'sum': self.sum, 'count': self.count}
+
+
+class Registry:
+    """Thread-safe store of counters and histograms keyed by metric name and labels."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = {}
+
+    def inc(self, name: str, value: float=1, **labels: Any) -> None:
+        key = (name, _labels(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        key = (name, _labels(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def snapshot(self) -> Dict[str, List[Dict[str, Any]]]:
+        """Returns a JSON-serializable copy of every metric."""
+        with self._lock:
+            return {
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in self.counters.items()],
+                'histograms': [{'name': name, 'labels': dict(labels), **histogram.to_dict()}
+                               for (name, labels), histogram in self.histograms.items()],
+            }
+
+
+REGISTRY = Registry()
+
+
+def inc(name: str, value: float=1, **labels: Any) -> None:
+    if _enabled:
+        REGISTRY.inc(name, value, **labels)
+
+
+def observe(name: str, value: float, **labels: Any) -> None:
+    if _enabled:
+        REGISTRY.observe(name, value, **labels)
+
+
+@contextmanager
+def timer(stage: str) -> Iterator[None]:
+    """Records the duration of the block as `stage`, counting raised exceptions as stage errors."""
+    if not _enabled:
+        yield
+        return
+    started = perf_counter()
+    try:
+        yield
+    except Exception:
+        REGISTRY.inc(STAGE_ERRORS, stage=stage)
+        raise
+    finally:
+        REGISTRY.observe(STAGE_SECONDS, perf_counter() - started, stage=stage)
+
+
+def timed(stage: Optional[str]=None) -> Callable:
+    """Decorator version of `timer`; the stage defaults to the function name."""
+    def decorator(func: Callable) -> Callable:
+        name = stage or func.__name__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            started = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                REGISTRY.inc(STAGE_ERRORS, stage=name)
+                raise
+            finally:
+                REGISTRY.observe(STAGE_SECONDS, perf_counter() - started, stage=name)
+        return wrapper
+    return decorator
+
+
+def merge_snapshots(snapshots: List[Dict[str, List[Dict[str, Any]]]]) -> Dict[str, List[Dict[str, Any]]]:
+    """Sums counters and histograms with the same name and labels, e.g. across worker processes."""
+    counters: Dict[Tuple[str, Labels], Dict[str, Any]] = {}
+    histograms: Dict[Tuple[str, Labels], Dict[str, Any]] = {}
+    for snapshot in snapshots:
+        for counter in snapshot.get('counters', []):
+            key = (counter['name'], _labels(counter['labels']))
+            if key in counters:
+                counters[key]['value'] += counter['value']
+            else:
+                counters[key] = dict(counter)
+        for histogram in snapshot.get('histograms', []):
+            key = (histogram['name'], _labels(histogram['labels']))
+            merged = histograms.get(key)
+            if merged is None:
+                histograms[key] = dict(histogram, counts=list(histogram['counts']))
+            elif merged['buckets'] != histogram['buckets']:
+                logging.warning(f'Skipping {histogram["name"]} with different buckets')
+            else:
+                merged['counts'] = [a + b for a, b in zip(merged['counts'], histogram['counts'])]
+                merged['sum'] += histogram['sum']
+                merged['count'] += histogram['count']
+    return {'counters': list(counters.values()), 'histograms': list(histograms.values())}
+
+
+def _format_labels(labels: Dict[str, str], **extra: str) -> str:
+    labels = {**labels, **extra}
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
+
+
+def render_prometheus(snapshot: Optional[Dict[str, List[Dict[str, Any]]]]=None) -> str:
+    """Renders a snapshot, this process' metrics by default, in the Prometheus text format."""
+    snapshot = snapshot if snapshot is not None else REGISTRY.snapshot()
+    lines = []
+    typed = set()
+    for counter in sorted(snapshot['counters'], key=lambda c: (c['name'], sorted(c['labels'].items()))):
+        if counter['name'] not in typed:
+            lines.append(f'# TYPE {counter["name"]} counter')
+            typed.add(counter['name'])
+        lines.append(f'{counter["name"]}{_format_labels(counter["labels"])} {counter["value"]}')
+    for histogram in sorted(snapshot['histograms'], key=lambda h: (h['name'], sorted(h['labels'].items()))):
+        name, labels = histogram['name'], histogram['labels']
+        if name not in typed:
+            lines.append(f'# TYPE {name} histogram')
+            typed.add(name)
+        cumulative = 0
+        for bound, count in zip(histogram['buckets'], histogram['counts']):
+            cumulative += count
+            lines.append(f'{name}_bucket{_format_labels(labels, le=repr(float(bound)))} {cumulative}')
+        lines.append(f'{name}_bucket{_format_labels(labels, le="+Inf")} {histogram["count"]}')
+        lines.append(f'{name}_sum{_format_labels(labels)} {histogram["sum"]}')
+        lines.append(f'{name}_count{_format_labels(labels)} {histogram["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+def _write_atomic(path: str, content: str) -> None:
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def dump(directory: str=METRICS_DIR) -> str:
+    """Writes this process' metrics to `<directory>/<pid>.json` and returns the path."""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{os.getpid()}.json')
+    _write_atomic(path, json.dumps(REGISTRY.snapshot()))
+    return path
+
+
+def collect(directory: str=METRICS_DIR) -> Dict[str, List[Dict[str, Any]]]:
+    """Merges this process' metrics with every per-process dump in `directory`."""
+    snapshots = [REGISTRY.snapshot()]
+    own_path = os.path.join(directory, f'{os.getpid()}.json')
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        if path == own_path:
+            continue
+        try:
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError) as e:
+            logging.warning(f'Could not read metrics from {path}: {e}')
+    return merge_snapshots(snapshots)
+
+
+def write_prometheus(directory: str=METRICS_DIR) -> str:
+    """Writes the merged metrics of all processes to `<directory>/metrics.prom` and returns the path."""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, 'metrics.prom')
+    _write_atomic(path, render_prometheus(collect(directory)))
+    return path
+
+
+class Dumper:
+    """Background thread dumping this process' metrics every `interval` seconds until stopped."""
+    def __init__(self, directory: str=METRICS_DIR, interval: float=DUMP_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='metrics-dumper', daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self._dump()
+
+    def _dump(self) -> None:
+        try:
+            dump(self.directory)
+        except OSError as e:
+            logging.error(f'Could not dump metrics: {e}')
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+        self._dump()
+
+
+def serve(port: int, host: str='127.0.0.1', directory: str=METRICS_DIR) -> 'ThreadingHTTPServer':
+    """
+    Serves the merged metrics of all processes on a background thread:
+    Prometheus text at /metrics and JSON at /metrics.json.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body, content_type = render_prometheus(collect(directory)), 'text/plain; version=0.0.4'
+            elif self.path == '/metrics.json':
+                body, content_type = json.dumps(collect(directory)), 'application/json'
+            else:
+                self.send_error(404)
+                return
+            payload = body.encode()
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    logging.info(f'Serving metrics on http://{host}:{port}/metrics')
+    return server
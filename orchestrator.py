@@ -0,0 +1,138 @@
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from multiprocessing import Manager
+from time import time
+from typing import Any, Dict, List, Optional
+import glob
+import logging
+import os
+
+from db_tools import configure_dedup, configure_storage
+from queue_worker import QueueWorker
+from scraper import LOG_FORMAT, TYPES, Scraper
+from scraping_tools import configure_driver_pool, configure_rate_limit, set_fetch_backend
+from storage import DEFAULT_STORAGE
+import metrics
+
+MAX_PARALLEL_CATEGORIES = 3
+PROGRESS_INTERVAL = 60
+
+_metrics_dumper: Optional[metrics.Dumper] = None
+
+
+def _init_worker(backend: str, fetch_workers: int, storage: str, rate: Optional[float]=None,
+                 metrics_dir: Optional[str]=None, metrics_interval: float=metrics.DUMP_INTERVAL,
+                 dedup: Optional[str]=None) -> None:
+    global _metrics_dumper
+    logging.basicConfig(format=f'%(processName)s - {LOG_FORMAT}', level=logging.INFO)
+    logging.getLogger('undetected_chromedriver').setLevel(logging.WARNING)
+    set_fetch_backend(backend)
+    configure_driver_pool(size=fetch_workers)
+    configure_rate_limit(rate)
+    configure_storage(storage)
+    configure_dedup(dedup)
+    if metrics_dir is not None:
+        metrics.enable()
+        _metrics_dumper = metrics.Dumper(metrics_dir, metrics_interval)
+
+
+def scrape_category(ad_type: str, progress: Dict, **scraper_kwargs: Any) -> Dict[str, Any]:
+    """
+    Scrapes one category and returns its summary.
+    Exceptions are caught and reported in the summary so they never reach the other categories.
+    With a `queue_url` in the keyword arguments the category is scraped from that work queue.
+    """
+    def on_progress(stats: Dict) -> None:
+        progress[ad_type] = stats
+
+    started = time()
+    summary = {'ad_type': ad_type, 'ok': False, 'error': None}
+    scraper = None
+    try:
+        if scraper_kwargs.get('queue_url'):
+            scraper = QueueWorker(ad_type, on_progress=on_progress, **scraper_kwargs)
+        else:
+            scraper = Scraper(ad_type, on_progress=on_progress, **scraper_kwargs)
+        scraper.scrape()
+        summary['ok'] = True
+    except Exception as e:
+        logging.error(f'Category {ad_type} failed: {e}')
+        summary['error'] = repr(e)
+    if scraper is not None:
+        summary.update(scraper.stats, max_page=scraper.max_page)
+    if _metrics_dumper is not None:
+        # the dumper thread dies with the pool, so make sure the last numbers are on disk
+        metrics.dump(_metrics_dumper.directory)
+    summary['duration'] = round(time() - started, 1)
+    return summary
+
+
+def log_progress(progress: Dict) -> None:
+    for ad_type, stats in sorted(progress.items()):
+        logging.info(f'[{ad_type}] page {stats["page"]}/{stats["max_page"]}, '
+                     f'{stats["scraped"]} scraped, {stats["skipped"]} skipped, '
+                     f'{stats["failed_attempts"]} failed attempts')
+
+
+def run_categories(ad_types: List[str]=TYPES, max_parallel: int=MAX_PARALLEL_CATEGORIES,
+                   backend: str='chrome', progress_interval: float=PROGRESS_INTERVAL, rate: Optional[float]=None,
+                   storage: str=DEFAULT_STORAGE,
+                   metrics_dir: Optional[str]=None, metrics_port: Optional[int]=None,
+                   metrics_interval: float=metrics.DUMP_INTERVAL, dedup: Optional[str]=None,
+                   **scraper_kwargs: Any) -> List[Dict[str, Any]]:
+    """
+    Scrapes the given categories in separate worker processes, at most `max_parallel` at a time.
+    Logs per-category progress every `progress_interval` seconds and returns one summary per category.
+    Properties are written to `storage`, 'mongo' or 'sqlite:<path>'.
+    `rate` caps the page loads per second to the site, split evenly between the worker processes.
+
+    With `metrics_dir` set, every worker dumps its stage metrics there and the merged
+    Prometheus text is written to `<metrics_dir>/metrics.prom`, and served on `metrics_port` if given.
+    With `dedup` new properties are checked for reposts against the dedup index at that path.
+    """
+    for ad_type in ad_types:
+        if ad_type not in TYPES:
+            raise ValueError(f'Invalid ad_type: {ad_type}')
+
+    server = None
+    if metrics_dir is not None:
+        # dumps of earlier runs would otherwise be merged into this one
+        for path in glob.glob(os.path.join(metrics_dir, '*.json')):
+            os.remove(path)
+        metrics.enable()
+        if metrics_port is not None:
+            server = metrics.serve(metrics_port, directory=metrics_dir)
+
+    fetch_workers = scraper_kwargs.get('fetch_workers', 1)
+    worker_rate = rate / min(max_parallel, len(ad_types)) if rate is not None else None
+    summaries = []
+    with Manager() as manager:
+        progress = manager.dict()
+        with ProcessPoolExecutor(max_workers=max_parallel, initializer=_init_worker,
+                                 initargs=(backend, fetch_workers, storage, worker_rate,
+                                           metrics_dir, metrics_interval, dedup)) as executor:
+            futures: Dict[Future, str] = {
+                executor.submit(scrape_category, ad_type, progress, **scraper_kwargs): ad_type
+                for ad_type in ad_types
+            }
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, timeout=progress_interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        summary = future.result()
+                    except Exception as e:
+                        # the worker process itself died
+                        summary = {'ad_type': futures[future], 'ok': False, 'error': repr(e)}
+                    logging.info(f'Category {summary["ad_type"]} finished: {summary}')
+                    summaries.append(summary)
+                log_progress(dict(progress))
+                if metrics_dir is not None:
+                    metrics.write_prometheus(metrics_dir)
+
+    if server is not None:
+        server.shutdown()
+    for summary in summaries:
+        status = 'ok' if summary['ok'] else f'failed ({summary["error"]})'
+        logging.info(f'{summary["ad_type"]}: {status}, {summary.get("scraped", 0)} scraped '
+                     f'in {summary.get("duration", 0)} s')
+    return summaries
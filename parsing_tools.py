@@ -1,12 +1,13 @@
+from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Any, Dict, List, Tuple
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 import logging
 import re
 
-from lxml import html
-from bs4 import BeautifulSoup
-import undetected_chromedriver as uc
+from lxml import etree, html
 
+from metrics import timed, timer
 from utils import exception_handler
 
 def filter_links(links: List[str]) -> List[str]:
@@ -31,53 +32,78 @@ def text_strip_list(element_list: List[html.HtmlElement]) -> List[str]:
     """Returns a list of text content stripped from the given list of HTML elements."""
     return [element.text_content().strip() for element in element_list]
 
+def _has_class(class_name: str) -> str:
+    """Returns an XPath predicate matching elements with the given class, same as `find_class`."""
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {class_name} ')"
+
+
+@lru_cache(maxsize=None)
+def _class_xpath(class_name: str) -> etree.XPath:
+    return etree.XPath(f"//*[{_has_class(class_name)}]")
+
+
+@lru_cache(maxsize=None)
+def _body_class_xpath(class_name: str) -> etree.XPath:
+    """Same as `tree.body.find_class`, so elements in <head> sharing the class are never matched."""
+    return etree.XPath(f"//body/descendant-or-self::*[{_has_class(class_name)}]")
+
+
+_OBJ_DETAILS = _body_class_xpath('obj-details')
+_OBJ_STATS_SIMPLE = _class_xpath('obj-stats simple')
+_OBJ_STATS = _class_xpath('obj-stats')
+_OBJ_HEADER = _class_xpath('obj-header-text')
+_THUMB_HREFS = etree.XPath(f"//*[{_has_class('link-obj-thumb')}]/@href")
+_SPECIAL_COMMA = _body_class_xpath('special-comma')
+_STAT_VALUES = etree.XPath(f"//td[{_has_class('stat-col-first')}]")
+_STAT_NAMES = etree.XPath(f"//td[{_has_class('stat-col-second')}]")
+_STOP_NAMES = etree.XPath(f"//span[{_has_class('stop-name')}]")
+_HEATING_EST = etree.XPath(f"//span[{_has_class('cell-data--small')}]")
+_POLLUTION = etree.XPath(f"//div[{_has_class('air-pollution__title')}]")
+_FIRST_SPAN = etree.XPath('(.//span)[1]')
+_CRIME_PARENT = etree.XPath(f"(//div[{_has_class('icon-crime-gray')}])[1]/ancestor::div[1]")
+_NEW_PROJECT = etree.XPath("//div[@id='advertProjectHolder']")
+_COORDINATES = re.compile(r'\d{2}\.\d+')
+_BUS_NUMBERS = re.compile(r'\d+[A-Z]+|\d+')
+_ROOMS_SUFFIX = re.compile(r', \d+ kamb')
+
+# table rows that are dropped from the property dictionary
+IGNORED_FIELDS = ['Ypatybės:', 'Papildomos patalpos:', 'Papildoma įranga:', 'Apsauga:']
+
+
 @exception_handler
+@timed()
 def extract_element(tree: html.HtmlElement, class_name: str, index: int = 0) -> str:
     """
     Extracts the text content of an HTML element with the given class name.
     Returns an empty string if the element does not exist.
     """
-    elements = tree.body.find_class(class_name)
+    elements = _body_class_xpath(class_name)(tree)
     if elements:
         return elements[index].text.strip()
     else:
         return ""
     
 @exception_handler
+@timed()
 def extract_by_id(tree: html.HtmlElement, div_id: str) -> str:
     desc = tree.get_element_by_id(div_id)
     return desc.text_content()
     
 @exception_handler
-def extract_table(tree: html.HtmlElement) -> Dict[str, str]:
-    """
-    Extracts the table information from the HTML tree.
-    Returns a dictionary containing the table information.
-    """
-    table_dict = {}
-    table_elements = tree.body.find_class('obj-details')[0].findall('dd')
-    table_names = text_strip_list(tree.body.find_class('obj-details')[0].findall('dt'))
-    table_names = [name for name in table_names if name != '']
-    for i, name in enumerate(table_names):
-        table_dict[name] = table_elements[i].text.strip()
-    return table_dict
-
-@exception_handler
+@timed()
 def extract_thumbs(tree: html.HtmlElement) -> List[str]:
-    """Extracts and returns a list of URLs for the thumbnail images in the given HTML tree."""
-    thumbs = tree.find_class('link-obj-thumb')
-    thumbs = [thumb.get('href') for thumb in thumbs]
-    thumbs = set(thumbs)
-    thumbs.discard(None)
-    return thumbs
+    """Extracts and returns a list of unique URLs for the thumbnail images in the given HTML tree."""
+    return list(dict.fromkeys(_THUMB_HREFS(tree)))
 
 @exception_handler
-def extract_photos(tree: html.HtmlElement) -> List[str]:
+@timed()
+def extract_photos(tree: html.HtmlElement, thumbs: Optional[List[str]] = None) -> List[str]:
     """
     Extracts and returns a list of URLs for the photos in the given HTML tree.
     Filters out URLs that do not contain 'img.dgn'.
+    Already extracted `thumbs` can be passed in to avoid searching the tree again.
     """
-    urls = extract_thumbs(tree)
+    urls = extract_thumbs(tree) if thumbs is None else thumbs
     photos = []
     for url in urls:
         if 'img.dgn' in url:
@@ -85,19 +111,21 @@ def extract_photos(tree: html.HtmlElement) -> List[str]:
     return photos
 
 @exception_handler
-def extract_coordinates(tree: html.HtmlElement) -> Tuple[float, float]:
+@timed()
+def extract_coordinates(tree: html.HtmlElement, thumbs: Optional[List[str]] = None) -> Tuple[float, float]:
     '''
     Extracts and returns the coordinates of the property from the given HTML tree.
+    Already extracted `thumbs` can be passed in to avoid searching the tree again.
     '''
-    urls = extract_thumbs(tree)
-    pattern = r'\d{2}\.\d+'
+    urls = extract_thumbs(tree) if thumbs is None else thumbs
     for url in urls:
         if 'maps' in url:
-            match = re.findall(pattern, url)
+            match = _COORDINATES.findall(url)
             return (float(match[0]), float(match[1]))
     return None
 
 @exception_handler
+@timed()
 def extract_number(tree: html.HtmlElement) -> Tuple[str, bool]:
     """
     Extracts the phone number and broker status from the HTML tree.
@@ -106,35 +134,39 @@ def extract_number(tree: html.HtmlElement) -> Tuple[str, bool]:
         phone = extract_element(tree, 'phone_item_0')
         broker = True
     except Exception as e:
-        print(e)
+        logging.debug(f'No broker phone number: {e}')
         phone = extract_element(tree, 'phone')
         broker = False
     return phone, broker
 
 @exception_handler
+@timed()
 def extract_address(tree: html.HtmlElement) -> str:
     """
     Extracts the address of the property from the HTML tree.
     """
-    address = tree.find_class('obj-header-text')[0].text_content().strip()
-    address = re.split(', \d+ kamb', address)[0]
+    address = _OBJ_HEADER(tree)[0].text_content().strip()
+    address = _ROOMS_SUFFIX.split(address)[0]
     return address
 
 @exception_handler
+@timed()
 def extract_table(tree: html.HtmlElement) -> Dict[str, str]:
     """
     Extract the table information from the HTML tree.
     Returns a dictionary containing the table information.
     """
     table_dict = {}
-    table_elements = tree.body.find_class('obj-details')[0].findall('dd')
-    table_names = text_strip_list(tree.body.find_class('obj-details')[0].findall('dt'))
+    details = _OBJ_DETAILS(tree)[0]
+    table_elements = details.findall('dd')
+    table_names = text_strip_list(details.findall('dt'))
     table_names = [name for name in table_names if name != '']
     for i, name in enumerate(table_names):
         table_dict[name] = table_elements[i].text.strip()
     return table_dict
 
 @exception_handler
+@timed()
 def extract_ad_stats(tree: html.HtmlElement) -> Dict[str, str]:
     """
     Extract the ad stats information from the HTML tree.
@@ -142,23 +174,22 @@ def extract_ad_stats(tree: html.HtmlElement) -> Dict[str, str]:
     """
     ad_stats_dict = {}
 
-    try:
-        ad_stats_names = text_strip_list(tree.find_class('obj-stats simple')[0].find('dl').findall('dt'))
-        ad_stats_values = text_strip_list(tree.find_class('obj-stats simple')[0].find('dl').findall('dd'))
-    except IndexError:
-        try:
-            ad_stats_names = text_strip_list(tree.find_class('obj-stats')[0].find('dl').findall('dt'))
-            ad_stats_values = text_strip_list(tree.find_class('obj-stats')[0].find('dl').findall('dd'))
-        except IndexError:
-            ad_stats_dict['Nuoroda'] = extract_element(tree, 'project__advert-info__value')
+    stats = _OBJ_STATS_SIMPLE(tree) or _OBJ_STATS(tree)
+    if stats:
+        stats_list = stats[0].find('dl')
+        ad_stats_names = text_strip_list(stats_list.findall('dt'))
+        ad_stats_values = text_strip_list(stats_list.findall('dd'))
+    else:
+        ad_stats_dict['Nuoroda'] = extract_element(tree, 'project__advert-info__value')
 
-            ad_stats_names = []
-            ad_stats_values = []
+        ad_stats_names = []
+        ad_stats_values = []
     for i, name in enumerate(ad_stats_names):
             ad_stats_dict[name] = ad_stats_values[i]
     return ad_stats_dict
 
 @exception_handler
+@timed()
 def extract_price(tree: html.HtmlElement) -> str:
     """
     Extracts the price of the property from the HTML tree.
@@ -167,18 +198,13 @@ def extract_price(tree: html.HtmlElement) -> str:
     return extract_element(tree, 'price-eur') # for easier error handlin later on
 
 @exception_handler
-def extract_distance_stats(soup: BeautifulSoup) -> Dict[str, Any]:
+@timed()
+def extract_distance_stats(tree: html.HtmlElement) -> Dict[str, Any]:
     '''
-    Extracts the distance stats such as kindergardens and schools from soup
+    Extracts the distance stats such as kindergardens and schools from the HTML tree
     Returns a dictionary containing the distance stats'''
-    stat_value_class = 'stat-col-first'
-    stat_name_class = 'stat-col-second'
-
-    stat_value_elements = soup.find_all('td', class_=stat_value_class)
-    stat_name_elements = soup.find_all('td', class_=stat_name_class)
-
-    stat_values = [element.text.strip() for element in stat_value_elements]
-    stat_names = [element.text.strip() for element in stat_name_elements]
+    stat_values = [element.text_content().strip() for element in _STAT_VALUES(tree)]
+    stat_names = [element.text_content().strip() for element in _STAT_NAMES(tree)]
 
     #remove excess whitespace and \n
     stat_values = [value.replace('\n', '') for value in stat_values]
@@ -195,12 +221,10 @@ def extract_distance_stats(soup: BeautifulSoup) -> Dict[str, Any]:
     supermarkets = stat_names[6:9]
     supermarkets_dist = stat_values[6:9]
 
-    stop_names_class = 'stop-name'
-    stop_names = soup.find_all('span', class_=stop_names_class)
-    stop_names = [name.text.strip() for name in stop_names]
+    stop_names = [name.text_content().strip() for name in _STOP_NAMES(tree)]
     stop_dist = stat_values[9:12]
 
-    buses = [re.findall(r'\d+[A-Z]+|\d+', name) for name in stat_names[-3:]]
+    buses = [_BUS_NUMBERS.findall(name) for name in stat_names[-3:]]
 
     # create a dict with same keys as variable names
     dist_stats = {
@@ -217,31 +241,30 @@ def extract_distance_stats(soup: BeautifulSoup) -> Dict[str, Any]:
     return dist_stats
 
 @exception_handler
-def extract_heating_est(soup: BeautifulSoup) -> str:
+@timed()
+def extract_heating_est(tree: html.HtmlElement) -> str:
     '''
-    Extracts the heating estimation from soup
+    Extracts the heating estimation from the HTML tree
     Returns a string containing the heating estimation,
     preprocessing is not applied, because of different unit possibilities
     '''
-    heating_est_class = 'cell-data--small'
-    heating_est = soup.find('span', class_=heating_est_class).text
-    return heating_est
+    return _HEATING_EST(tree)[0].text_content()
 
 @exception_handler
-def extract_pollution_stats(soup: BeautifulSoup) -> Dict[str, str]:
+@timed()
+def extract_pollution_stats(tree: html.HtmlElement) -> Dict[str, str]:
     '''
-    Extracts the pollution stats from soup
+    Extracts the pollution stats from the HTML tree
     Returns a dictionary containing the pollution stats,
     no preprocessing is applied, because of different unit possibilities
     '''
-    pollution_class = 'air-pollution__title'
-    pollution = soup.find_all('div', class_=pollution_class)
+    pollution = _POLLUTION(tree)
 
     # get contents of span inside
-    pollution_values = [p.find('span').text for p in pollution]
+    pollution_values = [_FIRST_SPAN(p)[0].text_content() for p in pollution]
 
     # get text of div only
-    pollution_names = [p.text for p in pollution]
+    pollution_names = [p.text_content() for p in pollution]
     pollution_names = [p.split('(')[0].strip() for p in pollution_names]
 
     # replace 'Azoto dioksidas' with 'NO2', 'Kietos daleles' with KD10
@@ -251,26 +274,163 @@ def extract_pollution_stats(soup: BeautifulSoup) -> Dict[str, str]:
     return pollution
 
 @exception_handler
-def extract_crime_stat(soup: BeautifulSoup) -> int:
+@timed()
+def extract_crime_stat(tree: html.HtmlElement) -> int:
     '''
-    Extracts the crime stat from soup
+    Extracts the crime stat from the HTML tree
     Returns an integer containing the crime stat
     '''
-    crime_class = 'icon-crime-gray'
-    crime = soup.find('div', class_=crime_class)
-    crime_stat = crime.find_parent('div').text.strip()
+    crime_stat = _CRIME_PARENT(tree)[0].text_content().strip()
     return int(crime_stat)
 
 @exception_handler
-def extract_is_new_project(soup: BeautifulSoup) -> bool:
+@timed()
+def extract_is_new_project(tree: html.HtmlElement) -> bool:
     '''
-    Extracts whether the property is a new project from soup
+    Extracts whether the property is a new project from the HTML tree
     Returns a boolean
     '''
-    new_project_id = 'advertProjectHolder'
-    new_project = soup.find('div', id=new_project_id)
-    new_project = new_project is not None
-    return new_project
+    return len(_NEW_PROJECT(tree)) > 0
+
+@timed()
+def extract_property(tree: html.HtmlElement) -> Dict[str, Any]:
+    """
+    Extracts all property information from the HTML tree of a property listing page.
+    Every region of the page is searched once, shared results are passed between extractors.
+    """
+    thumbs = extract_thumbs(tree)
+    phone_and_broker = extract_number(tree)
+
+    property_info = {
+        'Price': extract_price(tree),
+        'Address': extract_address(tree),
+        'Phone': phone_and_broker[0],
+        'Broker': phone_and_broker[1],
+        'Coordinates': extract_coordinates(tree, thumbs),
+        'Reserved': extract_element(tree, 'reservation-strip__text'),
+        'Date_scraped': datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
+        'Description': extract_by_id(tree, 'collapsedText'),
+        'Misc': text_strip_list(_SPECIAL_COMMA(tree)),
+        'Photos': extract_photos(tree, thumbs),
+        'Heating_est': extract_heating_est(tree),
+        'Crimes_last_month': extract_crime_stat(tree),
+        #'Is_new_project': extract_is_new_project(tree), # TODO: fix, always returns True
+    }
+
+    ad_table = extract_table(tree)
+    ad_stats = extract_ad_stats(tree)
+    dist_stats = extract_distance_stats(tree)
+    pollution_stats = extract_pollution_stats(tree)
+
+    for table in [ad_table, ad_stats, dist_stats, pollution_stats]:
+        if table:
+            property_info.update(table)
+
+    for name in IGNORED_FIELDS:
+        property_info.pop(name, None)
+    return {key.replace(':', '').replace(' ', '_'): value for key, value in property_info.items()}
+
+@timed()
+def parse_property(source: str, **kwargs: Any) -> Dict[str, Any]:
+    """
+    Extracts information about a property from the HTML of a property listing page.
+    Keyword arguments are added to the returned dictionary as is.
+    """
+    with timer('parse_html'):
+        tree = html.fromstring(source)
+    property_info = extract_property(tree)
+
+    for key, value in kwargs.items():
+        property_info[key] = value
+    return property_info
+
+@dataclass
+class ListingPage:
+    """Ad ids, their thumbnails and prices and the number of pages parsed from a single listing page."""
+    ad_ids: List[str] = field(default_factory=list)
+    thumbnails: Dict[str, str] = field(default_factory=dict)
+    prices: Dict[str, str] = field(default_factory=dict)
+    max_page: int = 1
+
+
+_LINK_HREFS = etree.XPath('//a/@href')
+_LISTING_PHOTOS = etree.XPath(f"//div[{_has_class('list-photo-v2')}]")
+_LISTING_ROW = etree.XPath(f"ancestor::div[{_has_class('list-row-v2')}][1]")
+_LISTING_ROWS = etree.XPath(f"//div[{_has_class('list-row-v2')}]")
+_ROW_PRICE = etree.XPath(f".//*[{_has_class('list-item-price-v2')}]")
+_PAGE_BUTTONS = etree.XPath(f"//a[{_has_class('page-bt')}]")
+_INNER_HREFS = etree.XPath('.//a/@href')
+_INNER_IMG_SRC = etree.XPath('.//img/@src')
+
+
+def _find_ad_id(hrefs: List[str]) -> str:
+    for href in hrefs:
+        ad_id = extract_ad_id(href)
+        if ad_id:
+            return ad_id
+    return None
+
+
+def extract_listing_ad_ids(tree: html.HtmlElement) -> List[str]:
+    """Returns the ids of the ads linked from a listing page, in page order and without duplicates."""
+    links = [link for link in _LINK_HREFS(tree) if 'aruodas.lt' in link]
+    ad_ids = [extract_ad_id(link) for link in filter_links(links)]
+    return list(dict.fromkeys(ad_ids))
+
+
+def extract_listing_thumbnails(tree: html.HtmlElement) -> Dict[str, str]:
+    """
+    Returns a dictionary of ad id to thumbnail URL.
+    Each thumbnail is paired with the ad linked from the same photo block or listing row.
+    """
+    thumbnails = {}
+    for photo in _LISTING_PHOTOS(tree):
+        srcs = _INNER_IMG_SRC(photo)
+        if not srcs:
+            continue
+        ad_id = _find_ad_id(_INNER_HREFS(photo))
+        if ad_id is None:
+            rows = _LISTING_ROW(photo)
+            if rows:
+                ad_id = _find_ad_id(_INNER_HREFS(rows[0]))
+        if ad_id is not None and ad_id not in thumbnails:
+            thumbnails[ad_id] = srcs[0]
+    return thumbnails
+
+
+def extract_listing_prices(tree: html.HtmlElement) -> Dict[str, str]:
+    """
+    Returns a dictionary of ad id to the price shown in its listing row, with whitespace collapsed.
+    Used as a cheap signal of whether an already scraped ad has changed.
+    """
+    prices = {}
+    for row in _LISTING_ROWS(tree):
+        ad_id = _find_ad_id(_INNER_HREFS(row))
+        price = _ROW_PRICE(row)
+        if ad_id is not None and price and ad_id not in prices:
+            prices[ad_id] = ' '.join(price[0].text_content().split())
+    return prices
+
+
+def extract_max_page(tree: html.HtmlElement) -> int:
+    """Returns the highest page number found in the pagination buttons, 1 if there are none."""
+    button_texts = [button.text_content() for button in _PAGE_BUTTONS(tree)]
+    pages = [int(text) for text in button_texts if re.fullmatch(r'\s*\d+\s*', text)]
+    return max(pages, default=1)
+
+
+@timed()
+def parse_listing_page(source: str) -> ListingPage:
+    """Parses a listing page once and returns its ad ids, thumbnails, prices and max page."""
+    with timer('parse_listing_html'):
+        tree = html.fromstring(source)
+    return ListingPage(
+        ad_ids=extract_listing_ad_ids(tree),
+        thumbnails=extract_listing_thumbnails(tree),
+        prices=extract_listing_prices(tree),
+        max_page=extract_max_page(tree),
+    )
+
 
 def extract_ad_id(string: str) -> str:
     pattern = r"\d-\d{7}"
@@ -280,30 +440,34 @@ def extract_ad_id(string: str) -> str:
     else:
         return None
     
+RENAME_DICT = {
+    'Namo_numeris': 'House_number',
+    'Plotas': 'Area',
+    'Kambarių_sk.': 'Number_of_rooms',
+    'Aukštas': 'Floor',
+    'Aukštų_sk.': 'Number_of_floors',
+    'Metai': 'Year',
+    'Pastato_tipas': 'Building_type',
+    'Šildymas': 'Heating',
+    'Įrengimas': 'Furnishing',
+    'Pastato_energijos_suvartojimo_klasė': 'Energy_consumption_class',
+    'Nuoroda': 'Link',
+    'Įdėtas': 'Uploaded',
+    'Redaguotas': 'Edited',
+    'Aktyvus_iki': 'Active_until',
+    'Įsiminė': 'Saved',
+    'Peržiūrėjo': 'Viewed',
+    'Sklypo_plotas': 'Plot_area',
+    'Namo_tipas': 'House_type',
+    'Artimiausias_vandens_telkinys': 'Nearest_water_reservoir',
+    'Iki_vandens_telkinio_(m)': 'Distance_to_water_reservoir', 
+    
+}
+
+
+@timed()
 def preprocess_property(property: Dict) -> Dict:
-    rename_dict = {
-        'Namo_numeris': 'House_number',
-        'Plotas': 'Area',
-        'Kambarių_sk.': 'Number_of_rooms',
-        'Aukštas': 'Floor',
-        'Aukštų_sk.': 'Number_of_floors',
-        'Metai': 'Year',
-        'Pastato_tipas': 'Building_type',
-        'Šildymas': 'Heating',
-        'Įrengimas': 'Furnishing',
-        'Pastato_energijos_suvartojimo_klasė': 'Energy_consumption_class',
-        'Nuoroda': 'Link',
-        'Įdėtas': 'Uploaded',
-        'Redaguotas': 'Edited',
-        'Aktyvus_iki': 'Active_until',
-        'Įsiminė': 'Saved',
-        'Peržiūrėjo': 'Viewed',
-        'Sklypo_plotas': 'Plot_area',
-        'Namo_tipas': 'House_type',
-        'Artimiausias_vandens_telkinys': 'Nearest_water_reservoir',
-        'Iki_vandens_telkinio_(m)': 'Distance_to_water_reservoir', 
-        
-    }
+    rename_dict = RENAME_DICT
     # renamee keys if in rename_dict else keep the same
     property = {rename_dict[key] if key in rename_dict else key: property[key] for key in property.keys()}
 
@@ -366,4 +530,205 @@ def preprocess_property(property: Dict) -> Dict:
         except Exception as e:
             logging.error(f'Error converting floor to int: {e}')
 
-    return property
\ No newline at end of file
+    return property
+
+# the values the vectorized conversions take, which RE2 matches on ASCII characters only;
+# int64 takes 18 digits, and int() also accepts a sign and underscores, which are left to it
+_INT = r'^\s*-?\d{1,18}\s*$'
+_FLOAT = r'^\s*-?\d{1,15}(\.\d{1,15})?\s*$'
+_TWO_YEARS = r'^(?P<first>\d{4})[^\d_]+?(?P<second>\d{4})'
+_DATE = r'^[1-9]\d{3}-\d{2}-\d{2}$'
+_DATE_SCRAPED = r'^(\d{2})/(\d{2})/([1-9]\d{3}) (\d{2}:\d{2}:\d{2})$'
+_AD_ID = r'(?P<ad_id>\d-\d{7})'
+
+
+def _split_years(value: str) -> Tuple[int, int]:
+    try:
+        return int(value), None
+    except ValueError:
+        years = re.findall(r'\d{4}', value)
+        return int(years[0]), int(years[1])
+
+
+# the per-record conversions, used for the rows the vectorized conversions do not cover
+_SCALAR_CONVERSIONS = {
+    'Price': lambda value: int(value.replace(' €', '').replace(' ', '')),
+    'Area': lambda value: float(value.replace(' m²', '').replace(',', '.')),
+    'Number_of_floors': int,
+    'Number_of_rooms': int,
+    'Year': _split_years,
+    'Viewed': lambda value: int(value.split('/')[0]),
+    'Saved': int,
+    'Uploaded': lambda value: datetime.strptime(value, '%Y-%m-%d'),
+    'Edited': lambda value: datetime.strptime(value, '%Y-%m-%d'),
+    'Active_until': lambda value: datetime.strptime(value, '%Y-%m-%d'),
+    'Date_scraped': lambda value: datetime.strptime(value, '%d/%m/%Y %H:%M:%S'),
+    'Address': lambda value: value.split(',')[0],
+    'Reserved': lambda value: value != '',
+    'Distance_to_water_reservoir': lambda value: int(value.replace(' ', '')),
+    'Link': extract_ad_id,
+    'Floor': int,
+}
+
+
+def _vectorized_conversions(pa: Any, pc: Any) -> Dict[str, Any]:
+    """
+    Returns the vectorized conversion of every column, done with Arrow compute kernels. Each takes
+    an Arrow array of strings and nulls and returns the converted values as a list and a boolean
+    array of the values it converted exactly like the per-record function.
+    """
+    def int_array(values):
+        ok = pc.fill_null(pc.match_substring_regex(values, _INT), False)
+        return pc.cast(pc.if_else(ok, pc.utf8_trim_whitespace(values), '0'), pa.int64()), ok
+
+    def to_int(values):
+        converted, ok = int_array(values)
+        return converted.to_pylist(), ok
+
+    def to_float(values):
+        ok = pc.fill_null(pc.match_substring_regex(values, _FLOAT), False)
+        return pc.cast(pc.if_else(ok, pc.utf8_trim_whitespace(values), '0'), pa.float64()).to_pylist(), ok
+
+    def to_date(pattern, iso=None):
+        def convert(values):
+            ok = pc.fill_null(pc.match_substring_regex(values, pattern), False)
+            if iso is not None:
+                values = pc.replace_substring_regex(values, pattern, iso)
+            try:
+                converted = pc.cast(pc.if_else(ok, values, '2000-01-01'), pa.timestamp('s'))
+            except pa.ArrowInvalid:
+                # a date that does not exist, such as 2023-02-30, fails the whole cast
+                return [None] * len(values), pc.and_(ok, False)
+            return converted.to_pylist(), ok
+        return convert
+
+    def first_part(values, separator):
+        return pc.list_element(pc.split_pattern(values, separator, max_splits=1), 0)
+
+    def price(values):
+        return to_int(pc.replace_substring(pc.replace_substring(values, ' €', ''), ' ', ''))
+
+    def area(values):
+        return to_float(pc.replace_substring(pc.replace_substring(values, ' m²', ''), ',', '.'))
+
+    def year(values):
+        single, single_ok = int_array(values)
+        pairs = pc.extract_regex(values, _TWO_YEARS)
+        # Python's \d also matches the digits of other scripts, those rows are left to the per-record conversion
+        pair_ok = pc.fill_null(pc.and_(pc.and_(pc.invert(single_ok), pairs.is_valid()), pc.string_is_ascii(values)),
+                               False)
+        converted = [
+            (single_year, None) if is_single else (int(first), int(second)) if is_pair else None
+            for single_year, is_single, first, second, is_pair
+            in zip(single.to_pylist(), single_ok.to_pylist(), pairs.field('first').to_pylist(),
+                   pairs.field('second').to_pylist(), pair_ok.to_pylist())
+        ]
+        return converted, pc.or_(single_ok, pair_ok)
+
+    def viewed(values):
+        return to_int(first_part(values, '/'))
+
+    def city(values):
+        return first_part(values, ',').to_pylist(), values.is_valid()
+
+    def reserved(values):
+        return pc.not_equal(values, '').to_pylist(), values.is_valid()
+
+    def distance(values):
+        return to_int(pc.replace_substring(values, ' ', ''))
+
+    def link(values):
+        ad_ids = pc.extract_regex(values, _AD_ID)
+        return ad_ids.field('ad_id').to_pylist(), pc.fill_null(pc.and_(ad_ids.is_valid(), pc.string_is_ascii(values)),
+                                                                False)
+
+    return {
+        'Price': price,
+        'Area': area,
+        'Number_of_floors': to_int,
+        'Number_of_rooms': to_int,
+        'Year': year,
+        'Viewed': viewed,
+        'Saved': to_int,
+        'Uploaded': to_date(_DATE),
+        'Edited': to_date(_DATE),
+        'Active_until': to_date(_DATE),
+        'Date_scraped': to_date(_DATE_SCRAPED, r'\3-\2-\1 \4'),
+        'Address': city,
+        'Reserved': reserved,
+        'Distance_to_water_reservoir': distance,
+        'Link': link,
+        'Floor': to_int,
+    }
+
+
+@timed()
+def preprocess_properties(properties: Iterable[Dict], as_frame: bool=False) -> Tuple[Any, List[Dict]]:
+    """
+    Preprocesses many raw properties at once, converting whole columns with Arrow compute kernels.
+
+    The values of a column go through the kernels in one call, and only the ones they do not cover,
+    such as None, numbers or unusual formats, through the per-record conversion. Returns the
+    preprocessed records (or a pandas DataFrame if `as_frame` is set) and a list of conversion errors,
+    one dictionary with the row, column, value and error per failed value. Where `preprocess_property`
+    would raise, the raw value is kept and the error reported instead; every other value is the same
+    as `preprocess_property` returns.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    records = [{RENAME_DICT[key] if key in RENAME_DICT else key: value for key, value in property.items()}
+               for property in properties]
+    errors = []
+    conversions = _vectorized_conversions(pa, pc)
+
+    for column, convert in conversions.items():
+        rows = [row for row, record in enumerate(records) if column in record]
+        if not rows:
+            continue
+        values = [records[row][column] for row in rows]
+        try:
+            results, ok = convert(pa.array(values, type=pa.string()))
+        except (pa.ArrowTypeError, pa.ArrowInvalid):
+            # values other than strings and None are left to the per-record conversion
+            results, ok_list = [None] * len(values), [False] * len(values)
+            strings = [i for i, value in enumerate(values) if isinstance(value, str)]
+            if strings:
+                converted, converted_ok = convert(pa.array([values[i] for i in strings], type=pa.string()))
+                for i, result, is_ok in zip(strings, converted, converted_ok.to_pylist()):
+                    results[i] = result
+                    ok_list[i] = is_ok
+            ok = pa.array(ok_list, type=pa.bool_())
+
+        failed = set()
+        scalar = _SCALAR_CONVERSIONS[column]
+        for i in pc.indices_nonzero(pc.invert(ok)).to_pylist():
+            try:
+                results[i] = scalar(values[i])
+            except Exception as e:
+                failed.add(i)
+                errors.append({'row': rows[i], 'column': column, 'value': values[i], 'error': repr(e)})
+                if column == 'Floor':
+                    logging.error(f'Error converting floor to int: {e!r}')
+
+        if column == 'Year':
+            for i, (row, result) in enumerate(zip(rows, results)):
+                if i not in failed:
+                    records[row]['Year'] = result[0]
+                    if result[1] is not None:
+                        records[row]['Renovation_year'] = result[1]
+            continue
+        target = {'Address': 'City', 'Link': '_id'}.get(column, column)
+        if failed:
+            for i, (row, result) in enumerate(zip(rows, results)):
+                if i not in failed:
+                    records[row][target] = result
+        else:
+            for row, result in zip(rows, results):
+                records[row][target] = result
+
+    if as_frame:
+        import pandas as pd
+
+        return pd.DataFrame.from_records(records), errors
+    return records, errors
@@ -0,0 +1,149 @@
+from queue import Queue
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+import logging
+import threading
+
+FETCH_WORKERS = 4
+PARSE_WORKERS = 2
+PERSIST_WORKERS = 1
+QUEUE_SIZE = 16
+
+# (property id, url, keyword arguments passed on to the parse stage)
+Task = Tuple[str, str, Dict[str, Any]]
+
+_STOP = object()
+
+
+class PropertyPipeline:
+    """
+    Fetches, parses and persists property pages concurrently.
+
+    Each stage runs its own pool of worker threads and the stages are connected by bounded
+    queues, so a slow stage blocks the stages before it instead of piling up pages in memory.
+    The first exception raised by any stage stops the pipeline and is re-raised by `run`, unless
+    `on_error(property_id, stage, exception)` returns True, in which case only that property is dropped.
+    """
+    def __init__(self,
+                 fetch: Callable[[str], str],
+                 parse: Callable[..., Dict],
+                 persist: Callable[[str, Dict], None],
+                 fetch_workers: int=FETCH_WORKERS,
+                 parse_workers: int=PARSE_WORKERS,
+                 persist_workers: int=PERSIST_WORKERS,
+                 queue_size: int=QUEUE_SIZE,
+                 on_error: Optional[Callable[[str, str, Exception], bool]]=None):
+        for name, workers in [('fetch', fetch_workers), ('parse', parse_workers), ('persist', persist_workers)]:
+            if workers < 1:
+                raise ValueError(f'Invalid number of {name} workers: {workers}')
+        self.fetch = fetch
+        self.parse = parse
+        self.persist = persist
+        self.fetch_workers = fetch_workers
+        self.parse_workers = parse_workers
+        self.persist_workers = persist_workers
+        self.queue_size = queue_size
+        self.on_error = on_error
+        self._stopped = threading.Event()
+        self._error: Optional[BaseException] = None
+        self._error_lock = threading.Lock()
+        self.processed = 0
+
+    def _fail(self, property_id: str, stage: str, e: BaseException) -> None:
+        if property_id is not None and self.on_error is not None and self.on_error(property_id, stage, e):
+            logging.warning(f'Skipping property {property_id} after an exception in {stage} stage: {e}')
+            return
+        logging.error(f'Exception in {stage} stage for property {property_id}: {e}')
+        with self._error_lock:
+            if self._error is None:
+                self._error = e
+        self._stopped.set()
+
+    def _fetch_worker(self, tasks: Queue, pages: Queue) -> None:
+        while True:
+            task = tasks.get()
+            if task is _STOP:
+                return
+            if self._stopped.is_set():
+                continue
+            property_id, url, kwargs = task
+            try:
+                logging.info(f'Scraping: {url}')
+                pages.put((property_id, self.fetch(url), kwargs))
+            except Exception as e:
+                self._fail(property_id, 'fetch', e)
+
+    def _parse_worker(self, pages: Queue, properties: Queue) -> None:
+        while True:
+            page = pages.get()
+            if page is _STOP:
+                return
+            if self._stopped.is_set():
+                continue
+            property_id, source, kwargs = page
+            try:
+                properties.put((property_id, self.parse(source, **kwargs)))
+            except Exception as e:
+                self._fail(property_id, 'parse', e)
+
+    def _persist_worker(self, properties: Queue) -> None:
+        while True:
+            item = properties.get()
+            if item is _STOP:
+                return
+            if self._stopped.is_set():
+                continue
+            property_id, property = item
+            try:
+                self.persist(property_id, property)
+                with self._error_lock:
+                    self.processed += 1
+            except Exception as e:
+                self._fail(property_id, 'persist', e)
+
+    @staticmethod
+    def _start(target: Callable, count: int, *args: Any) -> List[threading.Thread]:
+        threads = [threading.Thread(target=target, args=args, daemon=True) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    @staticmethod
+    def _stop(queue: Queue, threads: List[threading.Thread]) -> None:
+        for _ in threads:
+            queue.put(_STOP)
+        for thread in threads:
+            thread.join()
+
+    def run(self, tasks: Iterable[Task]) -> int:
+        """
+        Feeds the tasks through the pipeline and waits until all of them are persisted.
+        Returns the number of persisted properties.
+        """
+        self._stopped.clear()
+        self._error = None
+        self.processed = 0
+
+        task_queue = Queue(maxsize=self.queue_size)
+        page_queue = Queue(maxsize=self.queue_size)
+        property_queue = Queue(maxsize=self.queue_size)
+
+        fetchers = self._start(self._fetch_worker, self.fetch_workers, task_queue, page_queue)
+        parsers = self._start(self._parse_worker, self.parse_workers, page_queue, property_queue)
+        persisters = self._start(self._persist_worker, self.persist_workers, property_queue)
+
+        try:
+            for task in tasks:
+                if self._stopped.is_set():
+                    break
+                # blocks while the fetch stage is saturated
+                task_queue.put(task)
+        except Exception as e:
+            self._fail(None, 'task', e)
+        finally:
+            self._stop(task_queue, fetchers)
+            self._stop(page_queue, parsers)
+            self._stop(property_queue, persisters)
+
+        if self._error is not None:
+            raise self._error
+        return self.processed
@@ -0,0 +1,246 @@
+from datetime import datetime, timezone
+from time import sleep
+from typing import Any, Callable, Dict, Iterator, List, Optional
+import logging
+import os
+import socket
+import threading
+
+from db_tools import BufferedWriter, iter_scraped_ids
+from parsing_tools import parse_listing_page, parse_property, preprocess_property
+from pipeline import FETCH_WORKERS, PARSE_WORKERS, PERSIST_WORKERS, QUEUE_SIZE, PropertyPipeline, Task
+from scraper import BASE_URL, MAX_RETRIES
+from scraping_tools import get_html
+from seen_index import open_seen_index
+from utils import backoff_delay, retry
+from work_queue import DONE, FAILED, LEASE_SECONDS, LEASED, LISTING, PENDING, Job, listing_job, open_queue, property_job
+
+POLL_INTERVAL = 10
+LEASE_BATCH = 8
+REQUEUE_WAIT_TIME = 30
+REQUEUE_MAX_WAIT = 900
+
+
+def default_worker_id() -> str:
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+def default_round_id() -> str:
+    """Listing pages are crawled once per round; by default a round is a UTC day."""
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d')
+
+
+class QueueWorker:
+    """
+    Scrapes a category from a work queue shared with workers on other hosts.
+
+    Listing pages and properties are jobs: a leased listing page queues a property job for every
+    ad not scraped yet, and leased property jobs go through the fetch, parse and persist pipeline.
+    Property jobs are acknowledged once the writer has stored them and handed back to the queue
+    when the pipeline fails, so a crashed worker only delays its jobs until their leases expire.
+    """
+    def __init__(self, ad_type: str, queue_url: str, base_url: str=BASE_URL,
+                 worker_id: Optional[str]=None, round_id: Optional[str]=None, seed: bool=True,
+                 lease_seconds: float=LEASE_SECONDS, poll_interval: float=POLL_INTERVAL, wait: bool=False,
+                 fetch_workers: int=FETCH_WORKERS, parse_workers: int=PARSE_WORKERS,
+                 persist_workers: int=PERSIST_WORKERS, queue_size: int=QUEUE_SIZE,
+                 on_progress: Optional[Callable[[Dict], None]]=None, reconcile: bool=False,
+                 fetch_html: Optional[Callable[..., str]]=None,
+                 make_writer: Callable[..., Any]=BufferedWriter):
+        """
+        With `seed` the listing pages of round `round_id` are queued first; workers seeding the same
+        round queue the same jobs, so any number of them may seed. Without `wait` the worker stops
+        once the queue has no pending or leased jobs left.
+        """
+        self.base_url = base_url.rstrip('/')
+        self.ad_type = ad_type
+        self.queue = open_queue(queue_url, ad_type)
+        self.worker_id = worker_id or default_worker_id()
+        self.round_id = round_id or default_round_id()
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.wait = wait
+        self.fetch_html = fetch_html or get_html
+        self.on_progress = on_progress
+        self.stats = {'pages': 0, 'scraped': 0, 'skipped': 0, 'queued': 0, 'failed_attempts': 0}
+        self.max_page = 0
+        self.scraped_ids = open_seen_index(ad_type)
+        if reconcile or not self.scraped_ids.complete:
+            logging.info(f'Reconciling seen ids of {ad_type} with the database')
+            self.scraped_ids.reconcile(iter_scraped_ids(ad_type))
+        # property jobs leased by this worker and not acknowledged yet
+        self.leased: Dict[str, Job] = {}
+        self._ids_lock = threading.Lock()
+        self.writer = make_writer(on_saved=self.mark_saved)
+        self.pipeline = PropertyPipeline(
+            fetch=self.fetch_property,
+            parse=self.parse_property,
+            persist=self.persist_property,
+            fetch_workers=fetch_workers,
+            parse_workers=parse_workers,
+            persist_workers=persist_workers,
+            queue_size=queue_size,
+            on_error=self.handle_error,
+        )
+        if seed:
+            self.seed()
+
+    def page_url(self, page: int) -> str:
+        return f'{self.base_url}/{self.ad_type}/puslapis/{page}/'
+
+    def report_progress(self) -> None:
+        if self.on_progress is not None:
+            self.on_progress(dict(self.stats, page=self.stats['pages'], max_page=self.max_page))
+
+    def seed(self) -> int:
+        """Queues every listing page of this round and returns how many were not queued yet."""
+        self.max_page = parse_listing_page(self.fetch_html(self.page_url(1))).max_page
+        added = self.queue.enqueue(listing_job(self.round_id, page) for page in range(1, self.max_page + 1))
+        logging.info(f'Queued {added} of {self.max_page} listing pages of {self.ad_type}, round {self.round_id}')
+        return added
+
+    def requeue(self, job: Job, error: Exception) -> None:
+        delay = backoff_delay(job.attempts, REQUEUE_WAIT_TIME, REQUEUE_MAX_WAIT)
+        self.queue.requeue(job.id, self.worker_id, delay=delay, error=repr(error))
+
+    def process_listing(self, job: Job) -> None:
+        """Queues the unscraped ads of a leased listing page and acknowledges it."""
+        page = job.payload['page']
+        try:
+            listing = parse_listing_page(self.fetch_html(self.page_url(page)))
+        except Exception as e:
+            logging.error(f'Listing page {page} failed: {e}')
+            self.stats['failed_attempts'] += 1
+            self.requeue(job, e)
+            return
+        self.max_page = max(self.max_page, listing.max_page)
+
+        jobs = []
+        for property_id in listing.ad_ids:
+            if property_id in self.scraped_ids:
+                self.stats['skipped'] += 1
+                continue
+            kwargs = {}
+            if property_id in listing.thumbnails:
+                kwargs['Thumbnail'] = listing.thumbnails[property_id]
+            jobs.append(property_job(property_id, kwargs))
+        # ads another worker has queued or scraped already are ignored by the queue
+        queued = self.queue.enqueue(jobs)
+        self.queue.ack([job.id], self.worker_id)
+        logging.info(f'Page {page}: queued {queued} of {len(listing.ad_ids)} ads')
+        self.stats['queued'] += queued
+        self.stats['pages'] += 1
+        self.report_progress()
+
+    def fetch_property(self, url: str) -> str:
+        return self.fetch_html(url, save_html=True)
+
+    def parse_property(self, source: str, **kwargs: Any) -> Dict:
+        return preprocess_property(parse_property(source, **kwargs))
+
+    def persist_property(self, property_id: str, property: Dict) -> None:
+        if property.get('_id') is None:
+            property['_id'] = property_id
+        elif property['_id'] != property_id:
+            logging.warning(f'Property {property_id} links to {property["_id"]}')
+            self.acknowledge([property_id])
+        self.writer.save(property, self.ad_type)
+
+    def handle_error(self, property_id: str, stage: str, e: Exception) -> bool:
+        """
+        Hands a job whose page could not be parsed back to the queue, which fails it once it runs out of
+        attempts, and lets the pipeline go on. Errors of the other stages fail the pipeline as before.
+        """
+        if stage != 'parse':
+            return False
+        with self._ids_lock:
+            job = self.leased.pop(property_id, None)
+        if job is not None:
+            self.stats['failed_attempts'] += 1
+            self.requeue(job, e)
+        return True
+
+    def acknowledge(self, property_ids: List[str]) -> None:
+        with self._ids_lock:
+            for property_id in property_ids:
+                self.leased.pop(property_id, None)
+        self.queue.ack(property_ids, self.worker_id)
+
+    def mark_saved(self, ad_type: str, property_ids: List[str]) -> None:
+        """Called by the writer once properties are stored."""
+        with self._ids_lock:
+            for property_id in property_ids:
+                self.scraped_ids.add(property_id)
+            self.stats['scraped'] += len(property_ids)
+        self.acknowledge(property_ids)
+        self.report_progress()
+
+    def finished(self) -> bool:
+        if self.wait:
+            return False
+        counts = self.queue.counts()
+        return counts[PENDING] == 0 and counts[LEASED] == 0
+
+    def tasks(self) -> Iterator[Task]:
+        """
+        Leases jobs until the queue runs dry, processing listing pages on the spot
+        and yielding a task for every property job.
+        """
+        while True:
+            jobs = self.queue.lease(self.worker_id, limit=LEASE_BATCH, lease_seconds=self.lease_seconds)
+            if not jobs:
+                # jobs leased elsewhere, or by this worker and still in the pipeline, may yet come back
+                if self.finished():
+                    return
+                sleep(self.poll_interval)
+                continue
+            for job in jobs:
+                if job.kind == LISTING:
+                    self.process_listing(job)
+                elif job.id in self.scraped_ids:
+                    logging.info(f'Property {job.id} already scraped')
+                    self.queue.ack([job.id], self.worker_id)
+                    self.stats['skipped'] += 1
+                else:
+                    with self._ids_lock:
+                        self.leased[job.id] = job
+                    yield job.id, f'{self.base_url}/{job.id}/', job.payload
+
+    def _heartbeat(self, stopped: threading.Event) -> None:
+        while not stopped.wait(self.lease_seconds / 3):
+            with self._ids_lock:
+                job_ids = list(self.leased)
+            if job_ids:
+                try:
+                    self.queue.extend(job_ids, self.worker_id, self.lease_seconds)
+                except Exception as e:
+                    logging.error(f'Could not extend leases: {e}')
+
+    @retry(max_retries=MAX_RETRIES, wait_time=30, random_wait=True)
+    def scrape(self):
+        stopped = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(stopped,), daemon=True)
+        heartbeat.start()
+        try:
+            self.pipeline.run(self.tasks())
+            self.writer.flush()
+        except Exception as e:
+            self.stats['failed_attempts'] += 1
+            self.report_progress()
+            try:
+                self.writer.flush()
+            except Exception as flush_error:
+                logging.error(f'Could not flush buffered properties: {flush_error}')
+            with self._ids_lock:
+                unfinished, self.leased = list(self.leased.values()), {}
+            for job in unfinished:
+                self.requeue(job, e)
+            raise
+        finally:
+            stopped.set()
+            heartbeat.join()
+
+        self.scraped_ids.flush()
+        counts = self.queue.counts()
+        logging.info(f'Queue of {self.ad_type} drained: {counts[DONE]} done, {counts[FAILED]} failed')
+        return True
@@ -0,0 +1,153 @@
+from multiprocessing import Pool
+from time import time
+from typing import Any, Dict, List, Optional, Tuple
+import argparse
+import json
+import logging
+import os
+import traceback
+
+from html_archive import ARCHIVE_DIR, ArchiveRecord, HtmlArchive, import_html_files
+from parsing_tools import parse_property, preprocess_property
+from seen_index import open_seen_index, seen_index_path
+from utils import TYPES, choice_of
+
+CHUNK_SIZE = 64
+PROGRESS_EVERY = 1000
+ERRORS_PATH = 'reparse_errors.jsonl'
+DESCRIPTION = 'Parse archived property pages again and upsert the results'
+
+
+def reparse_record(job: Tuple[str, ArchiveRecord]) -> Tuple[ArchiveRecord, Optional[Dict], Optional[str]]:
+    """
+    Parses and preprocesses one archived page.
+    Returns the record with either the property or the formatted exception.
+    """
+    root, record = job
+    try:
+        source = HtmlArchive.read_segment(root, record)
+        property = parse_property(source, Date_scraped=record.fetched_at.strftime("%d/%m/%Y %H:%M:%S"))
+        property = preprocess_property(property)
+        # pages without a link to the ad still belong to the ad they were fetched for
+        property.setdefault('_id', record.ad_id)
+        return record, property, None
+    except Exception:
+        return record, None, traceback.format_exc()
+
+
+class CategoryResolver:
+    """
+    Finds the category of an ad id using the local seen-id indexes, opened read-only.
+    Categories without an index are skipped rather than given an empty one.
+    """
+    def __init__(self, ad_types: List[str]):
+        self.indexes = []
+        for ad_type in ad_types:
+            if not os.path.exists(seen_index_path(ad_type)):
+                logging.warning(f'No seen-id index for {ad_type}, its pages are not reparsed')
+                continue
+            index = open_seen_index(ad_type, read_only=True)
+            if not index.complete:
+                logging.warning(f'The seen-id index of {ad_type} is incomplete, run a crawl with --reconcile')
+            self.indexes.append((ad_type, index))
+
+    def __call__(self, ad_id: str) -> Optional[str]:
+        for ad_type, index in self.indexes:
+            if ad_id in index:
+                return ad_type
+        return None
+
+    def close(self) -> None:
+        for _, index in self.indexes:
+            index.close()
+
+
+def reparse(archive_dir: str=ARCHIVE_DIR, ad_types: List[str]=TYPES, processes: Optional[int]=None,
+            all_versions: bool=False, errors_path: str=ERRORS_PATH, dry_run: bool=False) -> Dict[str, Any]:
+    """
+    Runs every archived property page through the extraction and preprocessing again and upserts
+    the results, without fetching anything. Only the latest version of every ad is parsed unless
+    `all_versions` is set. Pages that fail are written to `errors_path` and do not stop the run.
+    """
+    archive = HtmlArchive(archive_dir)
+    records = archive.records() if all_versions else archive.latest_records()
+    records = [record for record in records if record.ad_id is not None]
+    archive.close()
+    logging.info(f'Reparsing {len(records)} pages with {processes or os.cpu_count()} processes')
+
+    resolve_category = CategoryResolver(ad_types)
+    writer = None
+    if not dry_run:
+        from db_tools import BufferedWriter
+        writer = BufferedWriter()
+    stats = {'pages': len(records), 'parsed': 0, 'errors': 0, 'unknown_category': 0}
+    started = time()
+    jobs = ((archive_dir, record) for record in records)
+    with Pool(processes) as pool, open(errors_path, 'w') as errors:
+        for done, (record, property, error) in enumerate(pool.imap_unordered(reparse_record, jobs, CHUNK_SIZE), 1):
+            if error is not None:
+                stats['errors'] += 1
+                errors.write(json.dumps({'ad_id': record.ad_id, 'url': record.url, 'segment': record.segment,
+                                        'offset': record.offset, 'error': error}) + '\n')
+            else:
+                ad_type = resolve_category(record.ad_id)
+                if ad_type is None:
+                    stats['unknown_category'] += 1
+                    logging.info(f'Property {record.ad_id} is not in any seen-id index, skipping')
+                else:
+                    stats['parsed'] += 1
+                    if writer is not None:
+                        writer.save(property, ad_type, merge=True)
+
+            if done % PROGRESS_EVERY == 0 or done == len(records):
+                elapsed = time() - started
+                logging.info(f'{done}/{len(records)} pages, {stats["errors"]} errors, '
+                             f'{done / elapsed * 60:.0f} pages/min')
+    resolve_category.close()
+    if writer is not None:
+        writer.close()
+    stats['duration'] = round(time() - started, 1)
+    return stats
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    from storage import DEFAULT_STORAGE
+
+    parser.add_argument('--archive-dir', default=ARCHIVE_DIR)
+    parser.add_argument('--ad-types', nargs='+', type=choice_of(TYPES), default=TYPES, metavar='AD_TYPE',
+                        help='categories to look ads up in, all of them by default')
+    parser.add_argument('--import-html', metavar='DIRECTORY',
+                        help='first move the .html files older versions saved, e.g. into the archive directory, '
+                             'into the archive')
+    parser.add_argument('--remove-imported', action='store_true', help='delete the .html files once imported')
+    parser.add_argument('--processes', type=int, default=None, help='number of worker processes, one per core by default')
+    parser.add_argument('--all-versions', action='store_true', help='parse every archived version, not only the latest')
+    parser.add_argument('--errors', default=ERRORS_PATH, help='where to write the pages that failed')
+    parser.add_argument('--dry-run', action='store_true', help='parse without writing the results')
+    parser.add_argument('--storage', default=DEFAULT_STORAGE, help="where properties are stored: 'mongo' or 'sqlite:<path>'")
+
+
+def main(args: argparse.Namespace) -> Dict[str, Any]:
+    """Reparses the archive as given on the command line and returns the stats."""
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+    if not args.dry_run:
+        from db_tools import configure_storage
+        configure_storage(args.storage)
+    imported = 0
+    if args.import_html:
+        archive = HtmlArchive(args.archive_dir)
+        try:
+            imported = import_html_files(archive, args.import_html, remove=args.remove_imported)
+        finally:
+            archive.close()
+        logging.info(f'Imported {imported} .html files from {args.import_html}')
+    stats = dict(reparse(args.archive_dir, args.ad_types, args.processes, args.all_versions, args.errors,
+                         args.dry_run), imported=imported)
+    logging.info(f'Reparse finished: {stats}')
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    add_arguments(parser)
+    main(parser.parse_args())
@@ -1,61 +1,326 @@
+from typing import Any, Callable, Dict, Iterator, List, Optional
+import argparse
 import logging
+import threading
 
-from db_tools import get_scraped_properties, save_property
-from parsing_tools import extract_ad_id, preprocess_property
-from scraping_tools import get_max_page, get_property_links, get_thumbnail_links, scrape_property
-from utils import retry
+from checkpoint import load_checkpoint
+from db_tools import BufferedWriter, iter_scraped_ids
+from listing_signals import open_listing_signals
+from parsing_tools import ListingPage, parse_listing_page, parse_property, preprocess_property
+from pipeline import FETCH_WORKERS, PARSE_WORKERS, PERSIST_WORKERS, QUEUE_SIZE, PropertyPipeline, Task
+from scraping_tools import FETCH_BACKENDS, get_html
+from seen_index import open_seen_index
+from utils import TYPES, choice_of, retry
 
-TYPES = ['butai', 'butu-nuoma', 'namai', 'namu-nuoma', 'patalpos', 'patalpu-nuoma']
 MAX_RETRIES = 10000
+# failed attempts at a single ad after which it is skipped for the rest of the crawl
+MAX_AD_ATTEMPTS = 3
+STOP_AFTER_KNOWN_PAGES = 3
+BASE_URL = 'https://www.aruodas.lt'
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+DESCRIPTION = 'Scrape aruodas.lt listings into the property storage'
 
 
 class Scraper:
-    def __init__(self, ad_type: str):
-        self.max_page = get_max_page(f'https://www.aruodas.lt/{ad_type}/')
+    def __init__(self, ad_type: str, base_url: str=BASE_URL,
+                 fetch_workers: int=FETCH_WORKERS, parse_workers: int=PARSE_WORKERS,
+                 persist_workers: int=PERSIST_WORKERS, queue_size: int=QUEUE_SIZE,
+                 on_progress: Optional[Callable[[Dict], None]]=None, reconcile: bool=False,
+                 incremental: bool=False, stop_after_known_pages: int=STOP_AFTER_KNOWN_PAGES,
+                 refresh_changed: bool=False, fetch_html: Optional[Callable[..., str]]=None,
+                 make_writer: Callable[..., Any]=BufferedWriter, max_ad_attempts: int=MAX_AD_ATTEMPTS):
+        """
+        Pages are fetched with `fetch_html`, `get_html` by default, and properties saved with the writer
+        `make_writer(on_saved=...)` returns, a `BufferedWriter` by default.
+        In incremental mode paging stops after `stop_after_known_pages` consecutive listing pages
+        without new or changed ads. With `refresh_changed` already scraped ads are scraped again and
+        replaced when their listing price differs from the one seen when they were last scraped.
+        An ad that fails `max_ad_attempts` times is given up on instead of failing the crawl again.
+        """
+        self.base_url = base_url.rstrip('/')
         self.ad_type = ad_type
-        self.page_on = 1
-        self.scraped_ids = get_scraped_properties(ad_type)
+        self.fetch_html = fetch_html or get_html
+        # the crawl position survives retries and restarts
+        self.checkpoint = load_checkpoint(ad_type)
+        self.page_on = self.checkpoint.page
+        if self.checkpoint.resumed:
+            logging.info(f'Resuming {ad_type} from page {self.page_on}, position {self.checkpoint.position}, '
+                         f'{len(self.checkpoint.in_flight)} properties in flight')
+        self.on_progress = on_progress
+        self.incremental = incremental
+        self.stop_after_known_pages = stop_after_known_pages
+        self.refresh_changed = refresh_changed
+        self.max_ad_attempts = max_ad_attempts
+        self.stats = {'pages': 0, 'scraped': 0, 'skipped': 0, 'refreshed': 0, 'failed': 0, 'failed_attempts': 0}
+        # the first listing page is kept so that it is not downloaded twice
+        self.first_page = self.fetch_listing(1)
+        self.max_page = self.first_page.max_page
+        self.scraped_ids = open_seen_index(ad_type)
+        if reconcile or not self.scraped_ids.complete:
+            logging.info(f'Reconciling seen ids of {ad_type} with the database')
+            self.scraped_ids.reconcile(iter_scraped_ids(ad_type))
+        self.listing_signals = open_listing_signals(ad_type)
+        # listing prices of dispatched ads, stored once the ads are saved
+        self.pending_signals: Dict[str, str] = {}
+        # known ads that are scraped again and replace the stored document
+        self.refresh_ids = set()
+        self._ids_lock = threading.Lock()
+        self.writer = make_writer(on_saved=self.mark_saved)
+        self.pipeline = PropertyPipeline(
+            fetch=self.fetch_property,
+            parse=self.parse_property,
+            persist=self.persist_property,
+            fetch_workers=fetch_workers,
+            parse_workers=parse_workers,
+            persist_workers=persist_workers,
+            queue_size=queue_size,
+            on_error=self.handle_error,
+        )
 
-    @retry(max_retries=MAX_RETRIES, wait_time=30, random_wait=True)
-    def scrape(self):
+    def page_url(self, page: int) -> str:
+        return f'{self.base_url}/{self.ad_type}/puslapis/{page}/'
+
+    def get_listing(self, page: int) -> ListingPage:
+        if page == 1 and self.first_page is not None:
+            listing, self.first_page = self.first_page, None
+            return listing
+        return self.fetch_listing(page)
+
+    def fetch_listing(self, page: int) -> ListingPage:
+        return parse_listing_page(self.fetch_html(self.page_url(page)))
+
+    def report_progress(self) -> None:
+        if self.on_progress is not None:
+            self.on_progress(dict(self.stats, page=self.page_on, max_page=self.max_page))
+
+    def fetch_property(self, url: str) -> str:
+        return self.fetch_html(url, save_html=True)
+
+    def parse_property(self, source: str, **kwargs: Any) -> Dict:
+        return preprocess_property(parse_property(source, **kwargs))
+
+    def persist_property(self, property_id: str, property: Dict) -> None:
+        if property.get('_id') is None:
+            property['_id'] = property_id
+        elif property['_id'] != property_id:
+            logging.warning(f'Property {property_id} links to {property["_id"]}')
+            with self._ids_lock:
+                self.checkpoint.in_flight.pop(property_id, None)
+                self.checkpoint.attempts.pop(property_id, None)
+        with self._ids_lock:
+            upsert = property_id in self.refresh_ids
+        self.writer.save(property, self.ad_type, upsert=upsert)
+
+    def mark_saved(self, ad_type: str, property_ids: List[str]) -> None:
+        """Called by the writer once properties are stored."""
+        with self._ids_lock:
+            for property_id in property_ids:
+                self.scraped_ids.add(property_id)
+                self.checkpoint.in_flight.pop(property_id, None)
+                self.checkpoint.attempts.pop(property_id, None)
+                self.refresh_ids.discard(property_id)
+                signal = self.pending_signals.pop(property_id, None)
+                if signal is not None:
+                    self.listing_signals.set(property_id, signal)
+            self.stats['scraped'] += len(property_ids)
+            self.checkpoint.save()
+        self.report_progress()
+
+    def handle_error(self, property_id: str, stage: str, e: Exception) -> bool:
+        """
+        Counts a failed attempt at a property in the checkpoint, so the count survives retries and restarts.
+        Returns True once the property has failed `max_ad_attempts` times, or at once if its page could not
+        be parsed or preprocessed: it is then marked failed and the crawl goes on without it. Otherwise the
+        crawl fails and the property is tried again first. Parse errors are the ad's own, e.g. a malformed
+        field, and would end the category for good if they failed the crawl as fatal errors like TypeError.
+        """
+        with self._ids_lock:
+            attempts = self.checkpoint.attempts.get(property_id, 0) + 1
+            if stage != 'parse' and attempts < self.max_ad_attempts:
+                self.checkpoint.attempts[property_id] = attempts
+                self.checkpoint.save()
+                return False
+            self.checkpoint.attempts.pop(property_id, None)
+            self.checkpoint.in_flight.pop(property_id, None)
+            self.checkpoint.failed[property_id] = f'{stage}: {e}'
+            self.refresh_ids.discard(property_id)
+            self.pending_signals.pop(property_id, None)
+            self.stats['failed'] += 1
+            self.checkpoint.save()
+        logging.error(f'Property {property_id} failed {attempts} times, last in the {stage} stage, skipping it')
+        self.report_progress()
+        return True
+
+    def dispatch(self, property_id: str, kwargs: Dict[str, Any], page: int, position: int,
+                 signal: Optional[str]=None) -> Task:
+        """Records the property as in flight and the crawl position after it in the checkpoint."""
+        with self._ids_lock:
+            if signal is not None:
+                self.pending_signals[property_id] = signal
+            self.checkpoint.in_flight[property_id] = kwargs
+            self.checkpoint.page = page
+            self.checkpoint.position = position
+            self.checkpoint.save()
+        return property_id, f'{self.base_url}/{property_id}/', kwargs
+
+    def tasks(self) -> Iterator[Task]:
+        """
+        Yields a task for every ad on the listing pages that is neither scraped, in flight nor failed,
+        starting with the ads left in flight and the position stored in the checkpoint.
+        """
+        with self._ids_lock:
+            resumed = [(property_id, kwargs) for property_id, kwargs in self.checkpoint.in_flight.items()
+                       if property_id not in self.scraped_ids]
+        for property_id, kwargs in resumed:
+            logging.info(f'Property {property_id}: resuming')
+            yield property_id, f'{self.base_url}/{property_id}/', kwargs
+
+        start_position = self.checkpoint.position
+        known_pages = 0
         for page in range(self.page_on, self.max_page + 1):
             logging.info(f'Page {page}/{self.max_page}')
-            page_url = f'https://www.aruodas.lt/{self.ad_type}/puslapis/{page}/'
-            property_ids = get_property_links(page_url)
-            property_ids = [extract_ad_id(link) for link in property_ids]
-            property_thumbs = get_thumbnail_links(page_url) # might be useful to combine into one function
-
-            thumbs_match = len(property_thumbs) == len(property_ids)
-            if not thumbs_match:
-                logging.info(f'Page {page}: Thumbs and ids do not match')
-
-            for i, property_id in enumerate(property_ids):                
-                if property_id in self.scraped_ids:
-                    logging.info(f'Property {property_id} already scraped')
-                    continue
-
-                url = f'https://www.aruodas.lt/{property_id}/'
-                logging.info(f'Scraping: {url}')
-                
-                if thumbs_match:
-                    property = scrape_property(url, Thumbnail=property_thumbs[i])
+            listing = self.get_listing(page)
+            dispatched = 0
+
+            for position in range(start_position, len(listing.ad_ids)):
+                property_id = listing.ad_ids[position]
+                signal = listing.prices.get(property_id)
+                with self._ids_lock:
+                    if property_id in self.checkpoint.in_flight or property_id in self.checkpoint.failed:
+                        continue
+                    if property_id in self.scraped_ids:
+                        refresh = self.refresh_changed and self.listing_signals.changed(property_id, signal)
+                        if not refresh:
+                            if signal is not None and self.listing_signals.get(property_id) is None:
+                                self.listing_signals.set(property_id, signal)
+                            logging.info(f'Property {property_id} already scraped')
+                            self.stats['skipped'] += 1
+                            continue
+                        logging.info(f'Property {property_id} changed on the listing, scraping again')
+                        self.refresh_ids.add(property_id)
+                        self.stats['refreshed'] += 1
+
+                kwargs = {}
+                if property_id in listing.thumbnails:
+                    kwargs['Thumbnail'] = listing.thumbnails[property_id]
                 else:
-                    property = scrape_property(url)
+                    logging.info(f'Property {property_id}: no thumbnail on page {page}')
+                dispatched += 1
+                yield self.dispatch(property_id, kwargs, page, position + 1, signal)
 
-                property = preprocess_property(property)
-                save_property(property, self.ad_type)
-                
-                
-                self.scraped_ids.add(property_id)
-        
+            start_position = 0
+            with self._ids_lock:
+                self.page_on = self.checkpoint.page = page + 1
+                self.checkpoint.position = 0
+                self.checkpoint.save()
+            self.stats['pages'] += 1
+            self.report_progress()
+
+            known_pages = known_pages + 1 if dispatched == 0 else 0
+            if self.incremental and known_pages >= self.stop_after_known_pages:
+                logging.info(f'{known_pages} consecutive pages without new ads, stopping at page {page}')
+                break
+
+    def crawl(self) -> bool:
+        """Makes one attempt at crawling the category, picking up where the checkpoint left off."""
+        try:
+            self.pipeline.run(self.tasks())
+            self.writer.flush()
+        except Exception:
+            self.stats['failed_attempts'] += 1
+            self.report_progress()
+            raise
+
+        self.scraped_ids.flush()
+        self.listing_signals.sync()
+        for property_id, error in self.checkpoint.failed.items():
+            logging.warning(f'Property {property_id} was skipped: {error}')
+        self.checkpoint.clear()
+        self.page_on = 1
         logging.info(f'Scraped {len(self.scraped_ids)} properties')
         return True
 
+    @retry(max_retries=MAX_RETRIES, wait_time=30, random_wait=True)
+    def scrape(self) -> bool:
+        """Crawls the category, retrying failed attempts."""
+        return self.crawl()
 
-if __name__ == '__main__':
-    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
-    logging.getLogger('undetected_chromedriver').setLevel(logging.WARNING)
 
-    for ad_type in TYPES:
-        scraper = Scraper(ad_type)
-        scraper.scrape()
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    from metrics import METRICS_DIR
+    from orchestrator import MAX_PARALLEL_CATEGORIES
+    from storage import DEFAULT_STORAGE
+
+    parser.add_argument('ad_types', nargs='*', type=choice_of(TYPES), default=TYPES, metavar='ad_type',
+                        help='categories to scrape, all of them by default')
+    parser.add_argument('--max-parallel', type=int, default=MAX_PARALLEL_CATEGORIES,
+                        help='maximum number of categories scraped at the same time')
+    parser.add_argument('--backend', choices=FETCH_BACKENDS, default='chrome',
+                        help='fetch pages with headless Chrome or plain HTTP with Chrome fallback')
+    parser.add_argument('--storage', default=DEFAULT_STORAGE,
+                        help="where properties are stored: 'mongo' or 'sqlite:<path>' for a local database")
+    parser.add_argument('--rate', type=float,
+                        help='maximum page loads per second to the site across all categories')
+    parser.add_argument('--base-url', default=BASE_URL, help='site to scrape, e.g. a local mirror')
+    parser.add_argument('--fetch-workers', type=int, default=FETCH_WORKERS)
+    parser.add_argument('--parse-workers', type=int, default=PARSE_WORKERS)
+    parser.add_argument('--persist-workers', type=int, default=PERSIST_WORKERS)
+    parser.add_argument('--reconcile', action='store_true',
+                        help='rebuild the local seen-id indexes from the database before scraping')
+    parser.add_argument('--incremental', action='store_true',
+                        help='stop paging after a number of consecutive pages without new ads')
+    parser.add_argument('--stop-after-known-pages', type=int, default=STOP_AFTER_KNOWN_PAGES)
+    parser.add_argument('--refresh-changed', action='store_true',
+                        help='scrape known ads again when their listing price has changed')
+    parser.add_argument('--max-ad-attempts', type=int, default=MAX_AD_ATTEMPTS,
+                        help='failed attempts after which an ad is skipped for the rest of the crawl')
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE,
+                        help='maximum number of items waiting between two pipeline stages')
+    parser.add_argument('--queue', dest='queue_url',
+                        help="scrape from a work queue shared with other hosts: 'mongo', 'sqlite:<path>' or 'memory'")
+    parser.add_argument('--worker-id', help='name of this worker in the queue, host and pid by default')
+    parser.add_argument('--round', dest='round_id', help='crawl round of the queued listing pages, the UTC date by default')
+    parser.add_argument('--no-seed', dest='seed', action='store_false',
+                        help='only work off the queue, without queueing the listing pages of this round')
+    parser.add_argument('--wait', action='store_true', help='keep polling the queue once it runs dry')
+    parser.add_argument('--dedup', help='flag reposts of already scraped ads using the dedup index at this path')
+    parser.add_argument('--metrics-dir', help=f'record per-stage metrics and dump them into this directory, '
+                                              f'{METRICS_DIR} with --metrics-port')
+    parser.add_argument('--metrics-port', type=int,
+                        help='also serve the metrics in the Prometheus text format on this local port')
+
+
+def main(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    """Scrapes the categories given on the command line and returns their summaries."""
+    from metrics import METRICS_DIR
+    from orchestrator import run_categories
+
+    logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+
+    scraper_kwargs = {
+        'base_url': args.base_url,
+        'fetch_workers': args.fetch_workers,
+        'parse_workers': args.parse_workers,
+        'persist_workers': args.persist_workers,
+        'queue_size': args.queue_size,
+        'reconcile': args.reconcile,
+    }
+    if args.queue_url:
+        if args.incremental or args.refresh_changed:
+            raise SystemExit('--incremental and --refresh-changed do not apply to queue workers')
+        scraper_kwargs.update(queue_url=args.queue_url, worker_id=args.worker_id, round_id=args.round_id,
+                              seed=args.seed, wait=args.wait)
+    else:
+        scraper_kwargs.update(incremental=args.incremental, stop_after_known_pages=args.stop_after_known_pages,
+                              refresh_changed=args.refresh_changed, max_ad_attempts=args.max_ad_attempts)
+    metrics_dir = args.metrics_dir or (METRICS_DIR if args.metrics_port is not None else None)
+    return run_categories(args.ad_types, max_parallel=args.max_parallel, backend=args.backend, rate=args.rate,
+                          storage=args.storage, metrics_dir=metrics_dir, metrics_port=args.metrics_port,
+                          dedup=args.dedup,
+                          **scraper_kwargs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    add_arguments(parser)
+    main(parser.parse_args())
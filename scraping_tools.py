@@ -1,50 +1,291 @@
-from typing import Any, Dict, List
-from datetime import datetime
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+from contextlib import contextmanager
+import atexit
+import logging
 import os
-import re
+import threading
 
-from bs4 import BeautifulSoup
 from lxml import html
-import undetected_chromedriver as uc
 
-from parsing_tools import (extract_element, text_strip_list, extract_photos, extract_table,
-                           extract_ad_stats, extract_address, extract_number, extract_coordinates,
-                           extract_price, filter_links, extract_by_id, extract_distance_stats,
-                           extract_heating_est, extract_pollution_stats, extract_crime_stat, 
-                           extract_is_new_project)
-from utils import retry
+from html_archive import ARCHIVE_DIR, HtmlArchive
+from metrics import timed, timer
+import metrics
+from parsing_tools import ListingPage, filter_links, parse_listing_page, parse_property
+from utils import CircuitBreaker, RetryBudget, TokenBucket, is_retryable, retry
+
+# Chrome tooling and requests are only imported once a page is fetched with them
+if TYPE_CHECKING:
+    import requests
+    import undetected_chromedriver as uc
 
 MAX_HTML_RETRIES = 10
-MAX_PROPERTY_RETRIES = 3
 RETRY_WAIT_TIME = 10
+MAX_RETRY_WAIT = 300
+# requests per second to the site from this process, None for no limit
+SITE_RATE: Optional[float] = None
+SITE_BURST = 2
+# pause every fetch for BREAKER_COOLDOWN seconds after BREAKER_THRESHOLD failures in BREAKER_WINDOW seconds
+BREAKER_THRESHOLD = 10
+BREAKER_WINDOW = 60
+BREAKER_COOLDOWN = 30
+# at most one retry per RETRY_BUDGET_RATIO ** -1 fetches, on top of RETRY_BUDGET_RESERVE
+RETRY_BUDGET_RATIO = 0.2
+RETRY_BUDGET_RESERVE = 20
+FATAL_STATUS_CODES = {400, 401, 404, 410}
+DRIVER_POOL_SIZE = 2
+MAX_PAGES_PER_DRIVER = 50
+FETCH_BACKENDS = ['chrome', 'http']
+FETCH_BACKEND = 'chrome'
+HTTP_TIMEOUT = 30
+HTTP_POOL_SIZE = 16
+HTTP_HEADERS = {
+    'User-Agent': ('Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 '
+                   '(KHTML, like Gecko) Chrome/118.0.0.0 Safari/537.36'),
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+    'Accept-Language': 'lt,en;q=0.8',
+    'Accept-Encoding': 'gzip, deflate',
+}
+CHALLENGE_STATUS_CODES = {403, 429, 503}
+CHALLENGE_MARKERS = ['cf-challenge', 'cf_chl_', 'challenge-platform', 'Just a moment...',
+                     'Attention Required!', 'g-recaptcha', 'hcaptcha']
 
 
+RATE_LIMITER = TokenBucket(SITE_RATE, SITE_BURST)
+FETCH_BREAKER = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_WINDOW, BREAKER_COOLDOWN)
+FETCH_RETRY_BUDGET = RetryBudget(RETRY_BUDGET_RATIO, RETRY_BUDGET_RESERVE)
+
+
+def configure_rate_limit(rate: Optional[float], burst: int=SITE_BURST) -> None:
+    """Limits this process to `rate` page loads per second, None for no limit."""
+    RATE_LIMITER.configure(rate, burst)
+
+
+def is_retryable_fetch(e: Exception) -> bool:
+    """Missing pages and rejected requests will not fetch any better on the next attempt."""
+    response = getattr(e, 'response', None)
+    if response is not None and getattr(response, 'status_code', None) is not None:
+        return response.status_code not in FATAL_STATUS_CODES
+    return is_retryable(e)
+
+
+@timed('chrome_start')
+def create_driver() -> 'uc.Chrome':
+    """Starts a new headless Chrome session."""
+    import undetected_chromedriver as uc
 
-@retry(max_retries=MAX_HTML_RETRIES, wait_time=RETRY_WAIT_TIME, random_wait=True)
-def get_html(url: str, save_html: bool=False) -> str:
-    """Returns the HTML content of the webpage with the given URL using headless Chrome."""
     options = uc.ChromeOptions()
     options.add_argument('--headless')
-    driver = uc.Chrome(options=options)
-    driver.get(url)
-    html_content = driver.page_source
-    driver.quit()
+    return uc.Chrome(options=options)
+
+
+class DriverPool:
+    """
+    A pool of long-lived headless Chrome sessions.
+
+    Drivers are started lazily, checked out with `driver()` and returned afterwards.
+    A driver is recycled after `max_pages` page loads or when a page load raises.
+    """
+    def __init__(self, size: int=DRIVER_POOL_SIZE, max_pages: int=MAX_PAGES_PER_DRIVER):
+        if size < 1:
+            raise ValueError(f'Invalid pool size: {size}')
+        self.size = size
+        self.max_pages = max_pages
+        self._idle = []
+        self._page_counts = {}
+        self._started = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def _acquire(self) -> 'uc.Chrome':
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise RuntimeError('Driver pool is closed')
+                if self._idle:
+                    return self._idle.pop()
+                if self._started < self.size:
+                    self._started += 1
+                    break
+                self._condition.wait()
+        try:
+            driver = create_driver()
+        except Exception:
+            with self._condition:
+                self._started -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self._page_counts[id(driver)] = 0
+        return driver
+
+    def _discard(self, driver: 'uc.Chrome') -> None:
+        with self._condition:
+            self._page_counts.pop(id(driver), None)
+            self._started -= 1
+            self._condition.notify()
+        try:
+            driver.quit()
+        except Exception as e:
+            logging.error(f'Exception while quitting driver: {e}')
+
+    def _release(self, driver: 'uc.Chrome') -> None:
+        with self._condition:
+            self._page_counts[id(driver)] += 1
+            recycle = self._closed or self._page_counts[id(driver)] >= self.max_pages
+            if not recycle:
+                self._idle.append(driver)
+                self._condition.notify()
+        if recycle:
+            logging.info('Recycling Chrome driver')
+            self._discard(driver)
+
+    @contextmanager
+    def driver(self):
+        """Checks out a driver for the duration of the `with` block."""
+        driver = self._acquire()
+        try:
+            yield driver
+        except Exception:
+            # a crashed session might be left in a broken state, start a fresh one next time
+            self._discard(driver)
+            raise
+        else:
+            self._release(driver)
+
+    def close(self) -> None:
+        """Quits all idle drivers, drivers still checked out are quit on return."""
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._condition.notify_all()
+        for driver in idle:
+            self._discard(driver)
+
+
+_driver_pool: Optional[DriverPool] = None
+_driver_pool_lock = threading.Lock()
+
+
+def get_driver_pool() -> DriverPool:
+    """Returns the shared driver pool, creating it on first use."""
+    global _driver_pool
+    with _driver_pool_lock:
+        if _driver_pool is None:
+            _driver_pool = DriverPool()
+            atexit.register(_driver_pool.close)
+        return _driver_pool
+
+
+def configure_driver_pool(size: int=DRIVER_POOL_SIZE, max_pages: int=MAX_PAGES_PER_DRIVER) -> DriverPool:
+    """Replaces the shared driver pool, closing the previous one."""
+    global _driver_pool
+    with _driver_pool_lock:
+        if _driver_pool is not None:
+            _driver_pool.close()
+        _driver_pool = DriverPool(size, max_pages)
+        atexit.register(_driver_pool.close)
+        return _driver_pool
+
+
+def set_fetch_backend(backend: str) -> None:
+    """Selects the backend used by `get_html`, either 'chrome' or 'http'."""
+    global FETCH_BACKEND
+    if backend not in FETCH_BACKENDS:
+        raise ValueError(f'Invalid fetch backend: {backend}')
+    FETCH_BACKEND = backend
+
+
+_http_session: Optional['requests.Session'] = None
+_http_session_lock = threading.Lock()
+
+
+def get_http_session() -> 'requests.Session':
+    """Returns the shared keep-alive HTTP session, creating it on first use."""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers.update(HTTP_HEADERS)
+            _http_session = session
+            atexit.register(session.close)
+        return _http_session
+
+
+def is_challenge_page(html_content: str, status_code: int=200) -> bool:
+    """Returns True if the response is empty or looks like a bot-challenge page."""
+    if status_code in CHALLENGE_STATUS_CODES:
+        return True
+    if not html_content or not html_content.strip():
+        return True
+    return any(marker in html_content for marker in CHALLENGE_MARKERS)
+
+
+@timed('fetch_chrome')
+def fetch_with_chrome(url: str) -> str:
+    """Returns the page source of the given URL using a pooled headless Chrome."""
+    with get_driver_pool().driver() as driver:
+        RATE_LIMITER.acquire()
+        driver.get(url)
+        return driver.page_source
+
+
+@timed('fetch_http')
+def fetch_with_http(url: str) -> Optional[str]:
+    """
+    Returns the HTML of the given URL using a plain HTTP GET.
+    Returns None if the response is empty or a bot-challenge page.
+    """
+    RATE_LIMITER.acquire()
+    response = get_http_session().get(url, timeout=HTTP_TIMEOUT)
+    if is_challenge_page(response.text, response.status_code):
+        return None
+    response.raise_for_status()
+    return response.text
+
+
+_archive: Optional[HtmlArchive] = None
+_archive_lock = threading.Lock()
+
+
+def get_archive() -> HtmlArchive:
+    """Returns this process' raw HTML archive, creating it on first use."""
+    global _archive
+    with _archive_lock:
+        # segments belong to a single process, so a forked worker opens its own
+        if _archive is None or _archive.pid != os.getpid():
+            _archive = HtmlArchive(ARCHIVE_DIR)
+            atexit.register(_archive.close)
+        return _archive
+
+
+@timed()
+@retry(max_retries=MAX_HTML_RETRIES, wait_time=RETRY_WAIT_TIME, random_wait=True, max_wait=MAX_RETRY_WAIT,
+       retryable=is_retryable_fetch, budget=FETCH_RETRY_BUDGET, breaker=FETCH_BREAKER)
+def get_html(url: str, save_html: bool=False) -> str:
+    """
+    Returns the HTML content of the webpage with the given URL.
+    With the 'http' backend only challenge or empty pages are fetched with headless Chrome.
+    """
+    if FETCH_BACKEND == 'http':
+        html_content = fetch_with_http(url)
+        if html_content is None:
+            logging.info(f'Challenge page for {url}, falling back to Chrome')
+            metrics.inc('scraper_challenge_pages_total')
+            html_content = fetch_with_chrome(url)
+    else:
+        html_content = fetch_with_chrome(url)
 
     if save_html:
-        # remove the protocol and www. from the url
-        base_filename = re.sub(r'https?://(www\.)?', '', url)
-        # remove the trailing slash
-        base_filename = base_filename.rstrip('/')
-        # replace slashes with underscores
-        base_filename = base_filename.replace('/', '_')
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"{base_filename}_{timestamp}.html"
-        filepath = os.path.join("raw_html/", filename)
-        with open(filepath, 'w') as file:
-            file.write(html_content)
+        with timer('archive_html'):
+            get_archive().append(url, html_content)
     return html_content
 
-@retry(max_retries=MAX_PROPERTY_RETRIES, wait_time=RETRY_WAIT_TIME, random_wait=True)
 def scrape_property(url: str, save_html: bool=True, **kwargs: Any) -> Dict[str, Any]:
     """
     Extracts information about a property from a property listing page on aruodas.lt.
@@ -56,69 +297,22 @@ def scrape_property(url: str, save_html: bool=True, **kwargs: Any) -> Dict[str,
         Dict[str, Any]: A dictionary of the property information.
     """
     source = get_html(url, save_html=save_html)
-    
-    tree = html.fromstring(source)
-    soup = BeautifulSoup(source, 'html.parser')
-
-    property_info = {
-        'Price': extract_price(tree),
-        'Address': extract_address(tree),
-        'Phone': extract_number(tree)[0],
-        'Broker': extract_number(tree)[1],
-        'Coordinates': extract_coordinates(tree),
-        'Reserved': extract_element(tree, 'reservation-strip__text'),
-        'Date_scraped': datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
-        'Description': extract_by_id(tree, 'collapsedText'),
-        'Misc': text_strip_list(tree.body.find_class('special-comma')),
-        'Photos': extract_photos(tree),
-        'Heating_est': extract_heating_est(soup),
-        'Crimes_last_month': extract_crime_stat(soup),
-        #'Is_new_project': extract_is_new_project(soup), # TODO: fix, always returns True
-    }
-
-    ad_table = extract_table(tree)
-    ad_stats = extract_ad_stats(tree)
-    dist_stats = extract_distance_stats(soup)
-    pollution_stats = extract_pollution_stats(soup)
-
-    for table in [ad_table, ad_stats, dist_stats, pollution_stats]:
-        if table:
-            property_info.update(table)
-
-    property_info.pop('Ypatybės:', None)
-    property_info.pop('Papildomos patalpos:', None)
-    property_info.pop('Papildoma įranga:', None)
-    property_info.pop('Apsauga:', None)
-    property_info = {key.replace(':', '').replace(' ', '_'): value for key, value in property_info.items()}
-
-    for key, value in kwargs.items():
-        property_info[key] = value
-    return property_info
+    return parse_property(source, **kwargs)
+
+def get_listing_page(url: str) -> ListingPage:
+    """Fetches a listing page once and returns its ad ids, thumbnails and max page."""
+    return parse_listing_page(get_html(url))
 
 def get_property_links(url: str) -> List[str]:
     html_text = get_html(url)
-    soup = BeautifulSoup(html_text, 'html.parser')
-    links = soup.find_all('a')
-    links = [link.get('href') for link in links]
-    links = [link for link in links if 'aruodas.lt' in str(link)]
+    tree = html.fromstring(html_text)
+    links = [link for link in tree.xpath('//a/@href') if 'aruodas.lt' in link]
     links = filter_links(links)
     links = list(set(links))
     return links
 
 def get_thumbnail_links(url: str) -> List[str]:
-    html = get_html(url)
-    soup = BeautifulSoup(html, 'html.parser')
-    thumbnails = soup.find_all('div', class_='list-photo-v2')
-    srcs = [thumbnail.find('img')['src'] for thumbnail in thumbnails]
-    return srcs
+    return list(get_listing_page(url).thumbnails.values())
 
 def get_max_page(url: str) -> int:
-    html = get_html(url)
-    soup = BeautifulSoup(html, 'html.parser')
-    buttons = soup.find_all('a', class_='page-bt')
-    button_texts = [button.text for button in buttons]
-    # filter with regex if contains number
-    button_texts = [button_text for button_text in button_texts if re.search(r'\d', button_text)]
-    # get max number
-    max_page = max([int(button_text) for button_text in button_texts])
-    return max_page
+    return get_listing_page(url).max_page
@@ -0,0 +1,144 @@
+from typing import Iterable
+import mmap
+import os
+import re
+import struct
+import threading
+
+# ad ids look like n-nnnnnnn, so they map onto integers below 10^8
+ID_SPACE = 10 ** 8
+MAGIC = b'ARSEEN01'
+# marks an index that has not been built completely yet, e.g. a new one awaiting its first reconcile
+PARTIAL_MAGIC = b'ARSEEN00'
+HEADER = struct.Struct('<8sQ')
+SEEN_INDEX_DIR = 'seen_index'
+_AD_ID = re.compile(r'(\d)-(\d{7})')
+
+
+def ad_id_to_int(ad_id: str) -> int:
+    match = _AD_ID.fullmatch(ad_id)
+    if match is None:
+        raise ValueError(f'Invalid ad id: {ad_id}')
+    return int(match.group(1)) * 10 ** 7 + int(match.group(2))
+
+
+def int_to_ad_id(number: int) -> str:
+    return f'{number // 10 ** 7}-{number % 10 ** 7:07d}'
+
+
+class SeenIndex:
+    """
+    A set of ad ids stored as a memory-mapped bitmap on disk.
+
+    Every possible ad id has one bit, so membership tests and inserts are O(1), the file is
+    12.5 MB regardless of how many ids it holds and opening it does not read it into memory.
+    Supports `in`, `add` and `len` so it can stand in for the set of scraped ids.
+    A new index is `complete` only after its first `reconcile`, which builds the bitmap in a
+    separate file and moves it into place, so an interrupted rebuild is redone on the next open.
+    A `read_only` index must exist already and cannot be changed.
+    """
+    def __init__(self, path: str, read_only: bool=False):
+        self.path = path
+        self.read_only = read_only
+        if not read_only and not os.path.exists(path):
+            _create(path)
+        self._lock = threading.Lock()
+        self._open()
+
+    def _open(self) -> None:
+        self._file = open(self.path, 'rb' if self.read_only else 'r+b')
+        access = mmap.ACCESS_READ if self.read_only else mmap.ACCESS_WRITE
+        self._map = mmap.mmap(self._file.fileno(), HEADER.size + ID_SPACE // 8, access=access)
+        magic, self._count = HEADER.unpack_from(self._map, 0)
+        if magic not in (MAGIC, PARTIAL_MAGIC):
+            self.close()
+            raise ValueError(f'Not a seen-id index: {self.path}')
+        self.complete = magic == MAGIC
+
+    def __contains__(self, ad_id: str) -> bool:
+        try:
+            number = ad_id_to_int(ad_id)
+        except (TypeError, ValueError):
+            return False
+        return bool(self._map[HEADER.size + (number >> 3)] & (1 << (number & 7)))
+
+    def __len__(self) -> int:
+        return self._count
+
+    def add(self, ad_id: str) -> bool:
+        """Adds an ad id, returns False if it was already in the index."""
+        number = ad_id_to_int(ad_id)
+        position = HEADER.size + (number >> 3)
+        bit = 1 << (number & 7)
+        with self._lock:
+            byte = self._map[position]
+            if byte & bit:
+                return False
+            self._map[position] = byte | bit
+            self._count += 1
+            HEADER.pack_into(self._map, 0, self._magic(), self._count)
+        return True
+
+    def update(self, ad_ids: Iterable[str]) -> int:
+        """Adds all given ad ids, returns the number of new ones."""
+        return sum(self.add(ad_id) for ad_id in ad_ids)
+
+    def _magic(self) -> bytes:
+        return MAGIC if self.complete else PARTIAL_MAGIC
+
+    def clear(self) -> None:
+        with self._lock:
+            self._map[HEADER.size:] = bytes(ID_SPACE // 8)
+            self._count = 0
+            HEADER.pack_into(self._map, 0, self._magic(), 0)
+
+    def reconcile(self, ad_ids: Iterable[str]) -> None:
+        """
+        Rebuilds the index from the given ad ids, e.g. every `_id` stored in the database.
+        The new bitmap is written to a temporary file that replaces the index only once it is
+        complete, so a crash midway leaves the previous index as it was.
+        """
+        tmp_path = f'{self.path}.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        _create(tmp_path)
+        rebuilt = SeenIndex(tmp_path)
+        try:
+            rebuilt.update(ad_id for ad_id in ad_ids if ad_id is not None)
+            # the header is marked complete last, after every bit is on disk
+            rebuilt.flush()
+            HEADER.pack_into(rebuilt._map, 0, MAGIC, rebuilt._count)
+        finally:
+            rebuilt.close()
+        with self._lock:
+            self.close()
+            os.replace(tmp_path, self.path)
+            self._open()
+
+    def flush(self) -> None:
+        self._map.flush()
+
+    def close(self) -> None:
+        if not self._map.closed:
+            if not self.read_only:
+                self._map.flush()
+            self._map.close()
+        self._file.close()
+
+
+def _create(path: str) -> None:
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(PARTIAL_MAGIC, 0))
+        # the rest of the bitmap is left sparse
+        f.truncate(HEADER.size + ID_SPACE // 8)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def seen_index_path(ad_type: str, directory: str=SEEN_INDEX_DIR) -> str:
+    return os.path.join(directory, f'{ad_type}.bin')
+
+
+def open_seen_index(ad_type: str, directory: str=SEEN_INDEX_DIR, read_only: bool=False) -> SeenIndex:
+    return SeenIndex(seen_index_path(ad_type, directory), read_only)
@@ -0,0 +1,277 @@
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from math import cos, radians
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import argparse
+import logging
+import os
+import sqlite3
+import threading
+
+from db_tools import WRITE_LAG
+from utils import TYPES, batches, choice_of
+
+SPATIAL_PATH = os.path.join('spatial', 'spatial.db')
+# side of a grid cell in metres
+CELL_SIZE = 250
+# the grid is laid out on an equirectangular projection around this latitude, which keeps
+# cells over Lithuania within a few percent of square
+REFERENCE_LATITUDE = 55.2
+EARTH_RADIUS = 6371000
+METRES_PER_DEGREE = radians(1) * EARTH_RADIUS
+COMPARABLE_RADIUS = 500
+MAX_NEAREST_RADIUS = 50000
+UPDATE_BATCH_SIZE = 1000
+UPDATE_LAG = WRITE_LAG
+DESCRIPTION = 'Build a spatial grid index of the stored properties and per-cell price aggregates'
+
+
+@dataclass
+class Neighbour:
+    ad_type: str
+    ad_id: str
+    latitude: float
+    longitude: float
+    distance: float
+
+
+def coordinates(property: Dict) -> Optional[Tuple[float, float]]:
+    """Returns the (lat, lon) of a property, stored as a tuple or, in MongoDB, as a list."""
+    value = property.get('Coordinates')
+    if not value or len(value) != 2 or value[0] is None or value[1] is None:
+        return None
+    return float(value[0]), float(value[1])
+
+
+def _number(value: Any) -> Optional[float]:
+    return float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+
+
+def haversine(latitude: float, longitude: float, latitudes: Any, longitudes: Any) -> Any:
+    """Distances in metres from one point to arrays of points."""
+    import numpy as np
+
+    lat1, lon1 = np.radians(latitude), np.radians(longitude)
+    lat2, lon2 = np.radians(latitudes), np.radians(longitudes)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+class SpatialIndex:
+    """
+    The coordinates of every stored property bucketed into a grid of `cell_size` metre cells,
+    together with the price, area and crime count the aggregates are computed from.
+
+    The points live in a SQLite database indexed by cell, so a radius query reads only the cells
+    the circle overlaps and computes exact distances for those points in one vectorized pass.
+    Properties are upserted as they arrive, so the index never has to be rebuilt.
+    """
+    def __init__(self, path: str=SPATIAL_PATH, cell_size: float=CELL_SIZE):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript('''
+            CREATE TABLE IF NOT EXISTS points (
+                ad_type TEXT NOT NULL, ad_id TEXT NOT NULL, latitude REAL NOT NULL, longitude REAL NOT NULL,
+                cell_x INTEGER NOT NULL, cell_y INTEGER NOT NULL, price REAL, area REAL, crimes REAL,
+                PRIMARY KEY (ad_type, ad_id));
+            CREATE INDEX IF NOT EXISTS points_cell ON points (cell_x, cell_y);
+            CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS updated (ad_type TEXT PRIMARY KEY, until TEXT NOT NULL);
+        ''')
+        self._connection.execute("INSERT OR IGNORE INTO settings (name, value) VALUES ('cell_size', ?)", (str(cell_size),))
+        stored = float(self._connection.execute("SELECT value FROM settings WHERE name = 'cell_size'").fetchone()[0])
+        if stored != cell_size:
+            raise ValueError(f'Spatial index {path} has {stored} m cells, not {cell_size} m')
+        self.cell_size = cell_size
+        self._x_scale = METRES_PER_DEGREE * cos(radians(REFERENCE_LATITUDE))
+
+    def cell(self, latitude: float, longitude: float) -> Tuple[int, int]:
+        return int(longitude * self._x_scale // self.cell_size), int(latitude * METRES_PER_DEGREE // self.cell_size)
+
+    def cell_center(self, cell_x: Any, cell_y: Any) -> Tuple[Any, Any]:
+        """The (lat, lon) of the centres of cells, works on arrays as well."""
+        return (cell_y + 0.5) * self.cell_size / METRES_PER_DEGREE, (cell_x + 0.5) * self.cell_size / self._x_scale
+
+    def _row(self, ad_type: str, property: Dict) -> Optional[Tuple]:
+        point = coordinates(property)
+        if point is None:
+            return None
+        return (ad_type, property['_id'], *point, *self.cell(*point), _number(property.get('Price')),
+                _number(property.get('Area')), _number(property.get('Crimes_last_month')))
+
+    def update(self, ad_type: str, properties: Iterable[Dict]) -> int:
+        """Adds or moves the given properties in one transaction. Returns how many had coordinates."""
+        rows = [row for row in (self._row(ad_type, property) for property in properties) if row is not None]
+        with self._lock:
+            cursor = self._connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                cursor.executemany('INSERT OR REPLACE INTO points (ad_type, ad_id, latitude, longitude, cell_x, '
+                                   'cell_y, price, area, crimes) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            except BaseException:
+                cursor.execute('ROLLBACK')
+                raise
+            cursor.execute('COMMIT')
+        return len(rows)
+
+    def remove(self, ad_type: str, ad_ids: Iterable[str]) -> None:
+        with self._lock:
+            self._connection.executemany('DELETE FROM points WHERE ad_type = ? AND ad_id = ?',
+                                         [(ad_type, ad_id) for ad_id in ad_ids])
+
+    def updated_until(self, ad_type: str) -> Optional[datetime]:
+        with self._lock:
+            row = self._connection.execute('SELECT until FROM updated WHERE ad_type = ?', (ad_type,)).fetchone()
+        return datetime.fromisoformat(row[0]) if row is not None else None
+
+    def set_updated_until(self, ad_type: str, until: datetime) -> None:
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO updated (ad_type, until) VALUES (?, ?)',
+                                     (ad_type, until.isoformat()))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM points').fetchone()[0]
+
+    def within(self, latitude: float, longitude: float, radius: float,
+               ad_type: Optional[str]=None) -> List[Neighbour]:
+        """Returns the properties within `radius` metres of a point, the nearest first."""
+        import numpy as np
+
+        latitude_delta = radius / METRES_PER_DEGREE
+        # a degree of longitude is shortest at the box edge furthest from the equator, so the box
+        # is widened for that latitude rather than for the grid's reference latitude
+        widest_latitude = min(max(abs(latitude - latitude_delta), abs(latitude + latitude_delta)), 89.9)
+        longitude_delta = radius / (METRES_PER_DEGREE * cos(radians(widest_latitude)))
+        min_x, min_y = self.cell(latitude - latitude_delta, longitude - longitude_delta)
+        max_x, max_y = self.cell(latitude + latitude_delta, longitude + longitude_delta)
+        sql = ('SELECT ad_type, ad_id, latitude, longitude FROM points '
+               'WHERE cell_x BETWEEN ? AND ? AND cell_y BETWEEN ? AND ?')
+        # one cell of padding against rounding at the cell borders
+        parameters: List[Any] = [min_x - 1, max_x + 1, min_y - 1, max_y + 1]
+        if ad_type is not None:
+            sql += ' AND ad_type = ?'
+            parameters.append(ad_type)
+        with self._lock:
+            rows = self._connection.execute(sql, parameters).fetchall()
+        if not rows:
+            return []
+        points = np.array([(row[2], row[3]) for row in rows])
+        distances = haversine(latitude, longitude, points[:, 0], points[:, 1])
+        inside = np.flatnonzero(distances <= radius)
+        inside = inside[np.argsort(distances[inside], kind='stable')]
+        return [Neighbour(rows[i][0], rows[i][1], rows[i][2], rows[i][3], float(distances[i])) for i in inside.tolist()]
+
+    def nearest(self, latitude: float, longitude: float, k: int=10, ad_type: Optional[str]=None,
+                max_radius: float=MAX_NEAREST_RADIUS) -> List[Neighbour]:
+        """Returns the `k` properties nearest to a point, searching a radius that doubles until it holds `k`."""
+        radius = self.cell_size
+        while True:
+            found = self.within(latitude, longitude, radius, ad_type)
+            if len(found) >= k or radius >= max_radius:
+                return found[:k]
+            radius = min(radius * 2, max_radius)
+
+    def comparables(self, ad_type: str, ad_id: str, radius: float=COMPARABLE_RADIUS) -> List[Neighbour]:
+        """Returns the other properties of the same category within `radius` metres of a property."""
+        with self._lock:
+            row = self._connection.execute('SELECT latitude, longitude FROM points WHERE ad_type = ? AND ad_id = ?',
+                                           (ad_type, ad_id)).fetchone()
+        if row is None:
+            raise KeyError(f'Property {ad_id} is not in the spatial index of {ad_type}')
+        return [neighbour for neighbour in self.within(row[0], row[1], radius, ad_type) if neighbour.ad_id != ad_id]
+
+    def aggregates(self, ad_type: Optional[str]=None, min_count: int=1) -> Any:
+        """
+        Returns a pandas DataFrame with one row per grid cell holding at least `min_count` properties:
+        the cell, its centre, the number of properties, the median price per m² and the mean of
+        `Crimes_last_month`.
+        """
+        import pandas as pd
+
+        sql = 'SELECT cell_x, cell_y, price, area, crimes FROM points'
+        parameters: List[Any] = []
+        if ad_type is not None:
+            sql += ' WHERE ad_type = ?'
+            parameters.append(ad_type)
+        with self._lock:
+            points = pd.read_sql_query(sql, self._connection, params=parameters)
+        points['price_per_m2'] = points['price'] / points['area'].where(points['area'] > 0)
+        cells = points.groupby(['cell_x', 'cell_y']).agg(
+            count=('price', 'size'),
+            median_price_per_m2=('price_per_m2', 'median'),
+            mean_crimes=('crimes', 'mean'),
+        ).reset_index()
+        cells = cells[cells['count'] >= min_count].reset_index(drop=True)
+        cells['latitude'], cells['longitude'] = self.cell_center(cells['cell_x'], cells['cell_y'])
+        return cells
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+def update_category(ad_type: str, index: SpatialIndex, full: bool=False, lag: timedelta=UPDATE_LAG) -> int:
+    """
+    Adds the properties of a category scraped since the last update, or all of them with `full`,
+    to the index. Returns the number of properties that were added or moved.
+    """
+    from db_tools import ensure_index, iter_properties
+
+    cutoff = datetime.now() - lag
+    query: Dict[str, Any] = {'Date_scraped': {'$lte': cutoff}}
+    since = None if full else index.updated_until(ad_type)
+    if since is not None:
+        query['Date_scraped']['$gt'] = since
+    ensure_index(ad_type, 'Date_scraped')
+
+    updated = 0
+    for batch in batches(iter_properties(ad_type, query), UPDATE_BATCH_SIZE):
+        updated += index.update(ad_type, batch)
+    index.set_updated_until(ad_type, cutoff)
+    return updated
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    from storage import DEFAULT_STORAGE
+
+    parser.add_argument('ad_types', nargs='*', type=choice_of(TYPES), default=TYPES, metavar='ad_type')
+    parser.add_argument('--index', dest='index_path', default=SPATIAL_PATH, help='spatial index database')
+    parser.add_argument('--cell-size', type=float, default=CELL_SIZE, help='side of a grid cell in metres')
+    parser.add_argument('--full', action='store_true', help='index every property, not only the ones new since the last run')
+    parser.add_argument('--aggregates', help='write the per-cell aggregates of every category to this CSV file')
+    parser.add_argument('--min-count', type=int, default=1, help='leave out cells with fewer properties')
+    parser.add_argument('--storage', default=DEFAULT_STORAGE, help="where properties are stored: 'mongo' or 'sqlite:<path>'")
+
+
+def main(args: argparse.Namespace) -> Dict[str, int]:
+    """Updates the spatial index with the categories given on the command line."""
+    from db_tools import configure_storage
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+    configure_storage(args.storage)
+    index = SpatialIndex(args.index_path, args.cell_size)
+    updated = {}
+    try:
+        for ad_type in args.ad_types:
+            updated[ad_type] = update_category(ad_type, index, args.full)
+            logging.info(f'{ad_type}: indexed {updated[ad_type]} properties')
+        if args.aggregates:
+            import pandas as pd
+
+            frames = [index.aggregates(ad_type, args.min_count).assign(ad_type=ad_type) for ad_type in args.ad_types]
+            pd.concat(frames, ignore_index=True).to_csv(args.aggregates, index=False)
+            logging.info(f'Wrote cell aggregates to {args.aggregates}')
+    finally:
+        index.close()
+    return updated
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    add_arguments(parser)
+    main(parser.parse_args())
@@ -0,0 +1,282 @@
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+import atexit
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+
+from utils import dumps_document, loads_document
+
+STORAGE_BACKENDS = ['mongo', 'sqlite']
+DEFAULT_STORAGE = os.environ.get('SCRAPER_STORAGE', 'mongo')
+PATH_TO_CREDENTIALS = os.environ.get('MONGO_CREDENTIALS',
+                                     '/Users/mariusarlauskas/Desktop/GitHub/Super-Secrets/Personal/scraping_mongo')
+DATABASE = 'Scraping'
+DUPLICATE_KEY_ERROR = 11000
+
+# write modes: insert and keep an existing document, replace it, or update its fields
+INSERT = 'insert'
+REPLACE = 'replace'
+MERGE = 'merge'
+
+# (property id, write mode, property)
+WriteItem = Tuple[str, str, Dict[str, Any]]
+# set on every document a write stores, so exports can pick up updates as well as new properties
+MODIFIED_FIELD = 'Date_modified'
+
+
+class WriteError(Exception):
+    """Raised when some properties of a batch could not be written; `errors` maps their ids to the reason."""
+    def __init__(self, errors: Dict[str, str]):
+        super().__init__(f'{len(errors)} properties could not be written: {errors}')
+        self.errors = errors
+
+
+class Storage:
+    """A store of scraped properties with one collection per category, keyed by `_id`."""
+    def write(self, ad_type: str, items: List[WriteItem]) -> Tuple[List[str], Dict[str, str]]:
+        """
+        Writes a batch of properties and returns the ids that are stored and the errors of the others.
+        Inserting a property that already exists keeps the stored one and counts as stored.
+        Every stored document gets the time of the write as its `MODIFIED_FIELD`.
+        """
+        raise NotImplementedError
+
+    def iter_ids(self, ad_type: str) -> Iterator[str]:
+        raise NotImplementedError
+
+    def iter_properties(self, ad_type: str, query: Optional[Dict]=None, batch_size: int=1000) -> Iterator[Dict]:
+        """Streams the properties matching a Mongo-style `query`."""
+        raise NotImplementedError
+
+    def ensure_index(self, ad_type: str, field: str) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+def _stamp_modified(items: List[WriteItem]) -> List[WriteItem]:
+    modified = datetime.now()
+    return [(property_id, mode, {**property, MODIFIED_FIELD: modified}) for property_id, mode, property in items]
+
+
+def get_uri() -> str:
+    """Returns the MongoDB URI from $MONGO_URI or the pickled credentials file."""
+    uri = os.environ.get('MONGO_URI')
+    if uri:
+        return uri
+    try:
+        with open(PATH_TO_CREDENTIALS, 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        raise RuntimeError(f'No MongoDB credentials: set MONGO_URI or MONGO_CREDENTIALS '
+                           f'({PATH_TO_CREDENTIALS} does not exist)') from None
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> Any:
+    """Returns the shared MongoDB client, connecting on first use."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            from pymongo.mongo_client import MongoClient
+            from pymongo.server_api import ServerApi
+            _client = MongoClient(get_uri(), server_api=ServerApi('1'))
+            atexit.register(_client.close)
+        return _client
+
+
+class MongoStorage(Storage):
+    """Properties in the `aruodas/<ad_type>` collections of the shared MongoDB cluster."""
+    def collection(self, ad_type: str) -> Any:
+        return get_client()[DATABASE][f'aruodas/{ad_type}']
+
+    def write(self, ad_type: str, items: List[WriteItem]) -> Tuple[List[str], Dict[str, str]]:
+        from pymongo import InsertOne, ReplaceOne, UpdateOne
+        from pymongo.errors import BulkWriteError
+
+        operations = []
+        for property_id, mode, property in _stamp_modified(items):
+            if mode == MERGE:
+                operations.append(UpdateOne({'_id': property_id}, {'$set': property}, upsert=True))
+            elif mode == REPLACE:
+                operations.append(ReplaceOne({'_id': property_id}, property, upsert=True))
+            else:
+                operations.append(InsertOne(property))
+        collection = self.collection(ad_type)
+        failed = {}
+        try:
+            collection.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details['writeErrors']:
+                failed[error['index']] = error
+
+        saved_ids, errors = [], {}
+        for i, (property_id, _, _) in enumerate(items):
+            error = failed.get(i)
+            if error is None:
+                saved_ids.append(property_id)
+            elif error['code'] == DUPLICATE_KEY_ERROR:
+                logging.info(f'Property {property_id} already in {collection.name}')
+                saved_ids.append(property_id)
+            else:
+                errors[property_id] = error['errmsg']
+        return saved_ids, errors
+
+    def iter_ids(self, ad_type: str) -> Iterator[str]:
+        for property in self.collection(ad_type).find({}, {'_id': 1}):
+            yield property['_id']
+
+    def iter_properties(self, ad_type: str, query: Optional[Dict]=None, batch_size: int=1000) -> Iterator[Dict]:
+        yield from self.collection(ad_type).find(query or {}, batch_size=batch_size)
+
+    def ensure_index(self, ad_type: str, field: str) -> None:
+        self.collection(ad_type).create_index(field)
+
+
+# fields copied out of the document into indexed columns
+SQLITE_COLUMNS = ['City', 'Price', 'Uploaded', 'Date_scraped']
+_OPERATORS = {'$eq': '=', '$ne': '!=', '$gt': '>', '$gte': '>=', '$lt': '<', '$lte': '<='}
+
+
+def _sql_value(value: Any) -> Any:
+    # datetimes are stored as ISO strings, which sort like the datetimes they encode
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def iter_rows(connect: Callable[[], sqlite3.Connection], sql: str, parameters: List[Any],
+              batch_size: int=1000) -> Iterator[Tuple]:
+    """Streams the rows of a query `batch_size` at a time over a connection of its own from `connect`."""
+    # a separate connection reads a consistent snapshot without holding up the writers
+    connection = connect()
+    try:
+        cursor = connection.execute(sql, parameters)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield from rows
+    finally:
+        connection.close()
+
+
+class SQLiteStorage(Storage):
+    """
+    Properties in one local SQLite database: a JSON document per property plus indexed copies of
+    `SQLITE_COLUMNS`. The database runs in WAL mode, so worker processes can write concurrently
+    and reads never block writes.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = self._connect()
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.executescript('''
+            CREATE TABLE IF NOT EXISTS properties (
+                ad_type TEXT NOT NULL, _id TEXT NOT NULL, City TEXT, Price REAL, Uploaded TEXT,
+                Date_scraped TEXT, document TEXT NOT NULL, PRIMARY KEY (ad_type, _id));
+            CREATE INDEX IF NOT EXISTS properties_city ON properties (ad_type, City);
+            CREATE INDEX IF NOT EXISTS properties_price ON properties (ad_type, Price);
+            CREATE INDEX IF NOT EXISTS properties_uploaded ON properties (ad_type, Uploaded);
+            CREATE INDEX IF NOT EXISTS properties_date_scraped ON properties (ad_type, Date_scraped);
+        ''')
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def _row(self, ad_type: str, property: Dict) -> Tuple:
+        return (ad_type, property['_id'], *(_sql_value(property.get(column)) for column in SQLITE_COLUMNS),
+                dumps_document(property))
+
+    def write(self, ad_type: str, items: List[WriteItem]) -> Tuple[List[str], Dict[str, str]]:
+        saved_ids, errors = [], {}
+        placeholders = ', '.join('?' * (len(SQLITE_COLUMNS) + 3))
+        columns = ', '.join(['ad_type', '_id', *SQLITE_COLUMNS, 'document'])
+        with self._lock:
+            cursor = self._connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                for property_id, mode, property in _stamp_modified(items):
+                    if property.get('_id') != property_id:
+                        errors[property_id] = f'_id {property.get("_id")} does not match'
+                        continue
+                    if mode == MERGE:
+                        stored = cursor.execute('SELECT document FROM properties WHERE ad_type = ? AND _id = ?',
+                                                (ad_type, property_id)).fetchone()
+                        if stored is not None:
+                            property = {**loads_document(stored[0]), **property}
+                    verb = 'INSERT OR IGNORE' if mode == INSERT else 'INSERT OR REPLACE'
+                    cursor.execute(f'{verb} INTO properties ({columns}) VALUES ({placeholders})',
+                                   self._row(ad_type, property))
+                    saved_ids.append(property_id)
+            except BaseException:
+                cursor.execute('ROLLBACK')
+                raise
+            cursor.execute('COMMIT')
+        return saved_ids, errors
+
+    def _select(self, ad_type: str, query: Optional[Dict]) -> Tuple[str, List[Any]]:
+        """Translates a Mongo-style query of top-level fields, comparison operators and $exists into SQL."""
+        conditions, parameters = ['ad_type = ?'], [ad_type]
+        for field, condition in (query or {}).items():
+            if not isinstance(condition, dict):
+                condition = {'$eq': condition}
+            for operator, value in condition.items():
+                if field == '_id' or field in SQLITE_COLUMNS:
+                    expression = field
+                elif isinstance(value, datetime):
+                    expression = f"json_extract(document, '$.\"{field}\".\"$date\"')"
+                else:
+                    expression = f"json_extract(document, '$.\"{field}\"')"
+                if operator == '$exists':
+                    conditions.append(f'{expression} IS {"NOT " if value else ""}NULL')
+                elif operator == '$in':
+                    conditions.append(f'{expression} IN ({", ".join("?" * len(value))})')
+                    parameters.extend(_sql_value(item) for item in value)
+                elif operator in _OPERATORS:
+                    conditions.append(f'{expression} {_OPERATORS[operator]} ?')
+                    parameters.append(_sql_value(value))
+                else:
+                    raise ValueError(f'Unsupported query operator: {operator}')
+        return ' AND '.join(conditions), parameters
+
+    def iter_ids(self, ad_type: str) -> Iterator[str]:
+        for row in iter_rows(self._connect, 'SELECT _id FROM properties WHERE ad_type = ?', [ad_type]):
+            yield row[0]
+
+    def iter_properties(self, ad_type: str, query: Optional[Dict]=None, batch_size: int=1000) -> Iterator[Dict]:
+        where, parameters = self._select(ad_type, query)
+        for row in iter_rows(self._connect, f'SELECT document FROM properties WHERE {where}', parameters, batch_size):
+            yield loads_document(row[0])
+
+    def ensure_index(self, ad_type: str, field: str) -> None:
+        if field == '_id' or field in SQLITE_COLUMNS:
+            return
+        name = 'properties_' + ''.join(c if c.isalnum() else '_' for c in field)
+        with self._lock:
+            self._connection.execute(f'CREATE INDEX IF NOT EXISTS "{name}" '
+                                     f"ON properties (ad_type, json_extract(document, '$.\"{field}\"'))")
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+def open_storage(url: str) -> Storage:
+    """Opens the storage at `url`: 'mongo' or 'sqlite:<path>'."""
+    backend, _, path = url.partition(':')
+    if backend == 'mongo':
+        return MongoStorage()
+    if backend == 'sqlite':
+        if not path:
+            raise ValueError(f'Missing database path in storage URL: {url}')
+        return SQLiteStorage(path)
+    raise ValueError(f'Invalid storage URL: {url}, expected one of {STORAGE_BACKENDS}')
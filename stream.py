@@ -0,0 +1,185 @@
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
+import argparse
+import bz2
+import gzip
+import json
+import logging
+import lzma
+import os
+
+from utils import TYPES, batches, dumps_document, loads_document
+
+LOAD_BATCH_SIZE = 1000
+COMPRESSION_LEVEL = 6
+# openers of compressed files by extension, with the name of their compression level argument
+_OPENERS = {'.gz': (gzip.open, 'compresslevel'), '.bz2': (bz2.open, 'compresslevel'), '.xz': (lzma.open, 'preset')}
+DESCRIPTION = 'Stream properties between the property storage and newline-delimited JSON files'
+
+
+def open_ndjson(path: str, mode: str='rb') -> Any:
+    """Opens a binary NDJSON file, compressed with gzip, bzip2 or xz if its extension says so."""
+    extension = os.path.splitext(path)[1]
+    if extension not in _OPENERS:
+        return open(path, mode)
+    opener, level_argument = _OPENERS[extension]
+    if 'r' in mode:
+        return opener(path, mode)
+    return opener(path, mode, **{level_argument: COMPRESSION_LEVEL})
+
+
+def _restore(record: Dict) -> Dict:
+    # dumps that did not come from dumps_document, e.g. from MongoDB, hold the coordinates as a list
+    if isinstance(record.get('Coordinates'), list):
+        record['Coordinates'] = tuple(record['Coordinates'])
+    return record
+
+
+def read_ndjson(path: str, offset: int=0) -> Iterator[Tuple[int, Dict]]:
+    """
+    Streams the records of an NDJSON file starting at byte `offset` of the uncompressed stream.
+    Yields every record with the offset of the line after it, where reading can resume later.
+    """
+    with open_ndjson(path, 'rb') as f:
+        if offset:
+            f.seek(offset)
+        for line in f:
+            offset += len(line)
+            if line.strip():
+                yield offset, _restore(loads_document(line))
+
+
+def iter_ndjson(path: str) -> Iterator[Dict]:
+    for _, record in read_ndjson(path):
+        yield record
+
+
+def write_ndjson(records: Iterable[Dict], path: str, append: bool=False) -> int:
+    """
+    Writes records one per line, keeping datetimes and tuples as {"$date": iso} and {"$tuple": [...]}.
+    A new file is written next to `path` and moved into place at the end, so readers never see half
+    of it. Returns the number of records written.
+    """
+    root, extension = os.path.splitext(path)
+    target = path if append else f'{root}.tmp{extension}'
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    written = 0
+    with open_ndjson(target, 'ab' if append else 'wb') as f:
+        for record in records:
+            f.write(dumps_document(record).encode())
+            f.write(b'\n')
+            written += 1
+    if not append:
+        os.replace(target, path)
+    return written
+
+
+def preprocess(records: Iterable[Dict], batch_size: int=LOAD_BATCH_SIZE) -> Iterator[Dict]:
+    """Preprocesses raw scraped records `batch_size` at a time with the column-wise `preprocess_properties`."""
+    from parsing_tools import preprocess_properties
+
+    for batch in batches(records, batch_size):
+        processed, errors = preprocess_properties(batch)
+        for error in errors:
+            logging.error(f'Could not convert {error["column"]} of record {error["row"]}: {error["error"]}')
+        yield from processed
+
+
+def _offset_path(path: str, ad_type: str) -> str:
+    return f'{path}.{ad_type}.offset'
+
+
+def load_offset(path: str, ad_type: str) -> int:
+    """Returns where an interrupted load of `path` into `ad_type` stopped, 0 if none did."""
+    try:
+        with open(_offset_path(path, ad_type)) as f:
+            return json.load(f)['offset']
+    except FileNotFoundError:
+        return 0
+
+
+def _save_offset(path: str, ad_type: str, offset: int) -> None:
+    state_path = _offset_path(path, ad_type)
+    tmp_path = f'{state_path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'ad_type': ad_type, 'offset': offset}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, state_path)
+
+
+def load_ndjson(path: str, ad_type: str, batch_size: int=LOAD_BATCH_SIZE, mode: Optional[str]=None,
+                raw: bool=False, resume: bool=True) -> Dict[str, int]:
+    """
+    Loads an NDJSON file into the storage of a category `batch_size` records at a time, so only one
+    batch is in memory. Records are inserted by default, `mode` can be 'replace' or 'merge' instead,
+    and `raw` records are preprocessed first. The offset after every stored batch is saved next to
+    the file, and with `resume` a load picks up from there; it is removed once the file is loaded.
+    Records that cannot be written are logged and counted in the returned `errors`.
+    """
+    from db_tools import get_storage
+    from storage import INSERT
+
+    if ad_type not in TYPES:
+        raise ValueError(f'Invalid ad_type: {ad_type}')
+    mode = mode or INSERT
+    offset = load_offset(path, ad_type) if resume else 0
+    if offset:
+        logging.info(f'Resuming the load of {path} at byte {offset}')
+    stats = {'loaded': 0, 'errors': 0}
+    for batch in batches(read_ndjson(path, offset), batch_size):
+        records = [record for _, record in batch]
+        if raw:
+            records = list(preprocess(records, batch_size))
+        saved_ids, errors = get_storage().write(ad_type, [(record['_id'], mode, record) for record in records])
+        for property_id, error in errors.items():
+            logging.error(f'Failed to write property {property_id}: {error}')
+        stats['loaded'] += len(saved_ids)
+        stats['errors'] += len(errors)
+        _save_offset(path, ad_type, batch[-1][0])
+        logging.info(f'Loaded {stats["loaded"]} {ad_type} properties from {path}')
+    if os.path.exists(_offset_path(path, ad_type)):
+        os.remove(_offset_path(path, ad_type))
+    return stats
+
+
+def export_ndjson(ad_type: str, path: str, query: Optional[Dict]=None, batch_size: int=LOAD_BATCH_SIZE) -> int:
+    """Streams the properties of a category matching `query` into an NDJSON file. Returns how many were written."""
+    from db_tools import iter_properties
+
+    return write_ndjson(iter_properties(ad_type, query, batch_size), path)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    from storage import DEFAULT_STORAGE, INSERT, MERGE, REPLACE
+
+    parser.add_argument('action', choices=['export', 'load'])
+    parser.add_argument('ad_type', choices=TYPES)
+    parser.add_argument('path', help='NDJSON file, compressed if it ends with .gz, .bz2 or .xz')
+    parser.add_argument('--batch-size', type=int, default=LOAD_BATCH_SIZE)
+    parser.add_argument('--mode', choices=[INSERT, REPLACE, MERGE], default=INSERT,
+                        help='what a load does with properties that are stored already')
+    parser.add_argument('--raw', action='store_true', help='preprocess the loaded records first')
+    parser.add_argument('--restart', dest='resume', action='store_false',
+                        help='load from the start even if an earlier load was interrupted')
+    parser.add_argument('--storage', default=DEFAULT_STORAGE, help="where properties are stored: 'mongo' or 'sqlite:<path>'")
+
+
+def main(args: argparse.Namespace) -> Any:
+    """Exports or loads the NDJSON file given on the command line."""
+    from db_tools import configure_storage
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+    configure_storage(args.storage)
+    if args.action == 'export':
+        written = export_ndjson(args.ad_type, args.path, batch_size=args.batch_size)
+        logging.info(f'{args.ad_type}: exported {written} properties to {args.path}')
+        return written
+    stats = load_ndjson(args.path, args.ad_type, args.batch_size, args.mode, args.raw, args.resume)
+    logging.info(f'{args.ad_type}: {stats}')
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    add_arguments(parser)
+    main(parser.parse_args())
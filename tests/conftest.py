@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+# the modules live at the top of the repository rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+@pytest.fixture
+def sqlite_storage(tmp_path):
+    """Points db_tools at a fresh SQLite database for the duration of a test."""
+    from db_tools import configure_storage, get_storage
+    from storage import DEFAULT_STORAGE
+
+    configure_storage(f'sqlite:{tmp_path / "properties.db"}')
+    yield get_storage()
+    configure_storage(DEFAULT_STORAGE)
@@ -0,0 +1,24 @@
+from bench import FIXTURE_CORPUS_DIR, compare, load_corpus, run_benchmarks, run_offline_pipeline
+
+BROKEN_PAGE = '<html><body></body></html>'
+
+
+def test_offline_pipeline_over_fixtures():
+    listings, properties = load_corpus(FIXTURE_CORPUS_DIR)
+    assert listings and properties
+    assert run_offline_pipeline(listings, properties) == 3
+
+
+def test_offline_pipeline_skips_broken_pages():
+    listings, _ = load_corpus(FIXTURE_CORPUS_DIR)
+    # pages without a price fail preprocessing, and with a single attempt they are skipped at once
+    assert run_offline_pipeline(listings, [BROKEN_PAGE], max_ad_attempts=1) == 0
+
+
+def test_compare_reports_regressions():
+    listings, properties = load_corpus(FIXTURE_CORPUS_DIR)
+    results = run_benchmarks(listings, properties, repeat=1)
+    assert results['offline_pipeline']['pages'] == 3
+    assert compare(results, results) == []
+    faster = {name: dict(result, pages_per_second=result['pages_per_second'] * 2) for name, result in results.items()}
+    assert len(compare(results, faster)) == len(results)
@@ -0,0 +1,107 @@
+import pytest
+
+from dedup import DedupIndex, MinHasher, _band_keys
+
+DESCRIPTION = ('Parduodamas šviesus trijų kambarių butas renovuotame name, šalia parkas, mokykla ir '
+               'parduotuvės. Butas su balkonu, naujais langais ir šarvuotomis durimis.')
+
+
+def _ad(ad_id, description=DESCRIPTION, photos=('a', 'b', 'c'), address='Vilnius, Antakalnis, Testo g.'):
+    return {'_id': ad_id, 'Description': description, 'Address': address,
+            'Photos': [f'https://img.dgn.lt/big_1/{photo}.jpg' for photo in photos]}
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = DedupIndex(str(tmp_path / 'dedup.db'))
+    yield index
+    index.close()
+
+
+def test_repost_is_found(index):
+    assert index.add('butai', _ad('1-0000001')) == []
+    assert index.add('butai', _ad('1-0000002', description='Kitas namas kaime prie ežero su pirtimi ir sodu',
+                                  photos=('x', 'y'), address='Kaunas, Centras')) == []
+    repost = _ad('1-0000003', description=DESCRIPTION + ' Skambinkite.')
+    duplicates = index.add('butai', repost)
+    assert [duplicate.duplicate_of for duplicate in duplicates] == ['1-0000001']
+    assert duplicates[0].similarity >= index.threshold
+    assert [duplicate.ad_id for duplicate in index.duplicates('butai', '1-0000001')] == ['1-0000003']
+
+
+def test_query_does_not_index(index):
+    index.add('butai', _ad('1-0000001'))
+    assert [duplicate.duplicate_of for duplicate in index.query('butai', _ad('1-0000002'))] == ['1-0000001']
+    assert index.query('namai', _ad('1-0000002')) == []
+    assert list(index.duplicates('butai')) == []
+
+
+def test_ads_with_little_text_are_ignored(index):
+    assert index.add('butai', {'_id': '1-0000001', 'Description': 'Butas'}) == []
+
+
+def test_adding_an_ad_again_does_not_flag_it_as_a_duplicate_of_its_reposts(index):
+    index.add('butai', _ad('1-0000001'))
+    index.add('butai', _ad('1-0000003', description=DESCRIPTION + ' Skambinkite.'))
+    assert index.add('butai', _ad('1-0000001')) == []
+    assert [duplicate.duplicate_of for duplicate in index.add('butai', _ad('1-0000003'))] == ['1-0000001']
+    assert [(duplicate.ad_id, duplicate.duplicate_of) for duplicate in index.duplicates('butai')] == \
+        [('1-0000003', '1-0000001')]
+
+
+def test_similar_ads_share_a_band():
+    # 70 shared features out of 100 make a Jaccard similarity of 0.7
+    hasher = MinHasher()
+    collisions = 0
+    for pair in range(200):
+        shared = [f'{pair}-shared-{i}' for i in range(70)]
+        first = _band_keys(hasher.signature(shared + [f'{pair}-first-{i}' for i in range(15)]))
+        second = _band_keys(hasher.signature(shared + [f'{pair}-second-{i}' for i in range(15)]))
+        collisions += any(key == other for key, other in zip(first, second))
+    assert collisions >= 198
+
+
+@pytest.fixture
+def dedup_index(tmp_path):
+    import db_tools
+
+    db_tools.configure_dedup(str(tmp_path / 'dedup.db'))
+    yield db_tools._dedup_index
+    db_tools.configure_dedup(None)
+
+
+class RejectingStorage:
+    """Fails the writes of the given ids and passes the others on to `storage`."""
+    def __init__(self, storage, rejected):
+        self.storage = storage
+        self.rejected = set(rejected)
+
+    def write(self, ad_type, items):
+        saved_ids, errors = self.storage.write(ad_type, [item for item in items if item[0] not in self.rejected])
+        return saved_ids, {**errors, **{item[0]: 'rejected' for item in items if item[0] in self.rejected}}
+
+
+def test_properties_are_indexed_once_stored(sqlite_storage, dedup_index):
+    from db_tools import BufferedWriter, save_property
+    from storage import WriteError
+
+    writer = BufferedWriter(storage=RejectingStorage(sqlite_storage, ['1-0000001']))
+    writer.save(_ad('1-0000001'), 'butai')
+    writer.save(_ad('1-0000002', description='Kitas namas kaime prie ežero su pirtimi ir sodu, didelis kiemas '
+                                             'ir garažas dviem automobiliams', photos=('x', 'y')), 'butai')
+    with pytest.raises(WriteError):
+        writer.flush()
+    writer.close()
+    # the ad that could not be stored is no original to its reposts
+    repost = _ad('1-0000003', description=DESCRIPTION + ' Skambinkite.')
+    save_property(repost, 'butai')
+    assert 'Possible_duplicates' not in repost
+
+    repost_of_repost = _ad('1-0000004')
+    save_property(repost_of_repost, 'butai')
+    assert repost_of_repost['Possible_duplicates'] == ['1-0000003']
+    # saving an ad again does not flag it as a repost of the ads indexed after it
+    writer = BufferedWriter(storage=sqlite_storage)
+    writer.save(repost, 'butai', upsert=True)
+    writer.close()
+    assert 'Possible_duplicates' not in repost
@@ -0,0 +1,51 @@
+from datetime import datetime, timedelta
+
+from export import export_category, read_dataset
+from storage import INSERT, MERGE
+
+
+def _property(property_id, price):
+    return {'_id': property_id, 'Price': price, 'Date_scraped': datetime(2023, 5, 1, 12, 0)}
+
+
+def test_incremental_export_picks_up_merged_updates(sqlite_storage, tmp_path):
+    root = str(tmp_path / 'analytics')
+    sqlite_storage.write('butai', [('1-0000001', INSERT, _property('1-0000001', 100000)),
+                                   ('1-0000002', INSERT, _property('1-0000002', 200000))])
+    assert export_category('butai', root, lag=timedelta(0)) == 2
+    assert export_category('butai', root, lag=timedelta(0)) == 0
+
+    sqlite_storage.write('butai', [('1-0000001', MERGE, {'_id': '1-0000001', 'Photo_hashes': ['abc']})])
+    assert export_category('butai', root, lag=timedelta(0)) == 1
+
+    rows = read_dataset(root).sort_values('Date_modified').drop_duplicates('_id', keep='last')
+    updated = rows.set_index('_id').loc['1-0000001']
+    assert updated['Price'] == 100000
+    assert 'Photo_hashes' in updated['Extra']
+
+
+def test_full_export_replaces_the_partition(sqlite_storage, tmp_path):
+    root = str(tmp_path / 'analytics')
+    sqlite_storage.write('butai', [('1-0000001', INSERT, _property('1-0000001', 100000))])
+    sqlite_storage.write('namai', [('2-0000001', INSERT, _property('2-0000001', 300000))])
+    export_category('namai', root, lag=timedelta(0))
+    for _ in range(2):
+        assert export_category('butai', root, full=True, lag=timedelta(0)) == 1
+
+    rows = read_dataset(root)
+    assert sorted(rows['_id']) == ['1-0000001', '2-0000001']
+
+
+def test_full_export_stops_at_the_cutoff(sqlite_storage, tmp_path):
+    root = str(tmp_path / 'analytics')
+    # stored before writes were stamped with Date_modified
+    legacy = _property('1-0000001', 100000)
+    sqlite_storage._connection.execute('INSERT INTO properties VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                       sqlite_storage._row('butai', legacy))
+    sqlite_storage.write('butai', [('1-0000002', INSERT, _property('1-0000002', 200000))])
+
+    # 1-0000002 was written within the lag, after the cutoff
+    assert export_category('butai', root, full=True, lag=timedelta(hours=1)) == 1
+    assert export_category('butai', root, lag=timedelta(0)) == 1
+    assert export_category('butai', root, lag=timedelta(0)) == 0
+    assert sorted(read_dataset(root)['_id']) == ['1-0000001', '1-0000002']
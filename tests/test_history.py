@@ -0,0 +1,103 @@
+from datetime import datetime, timedelta
+import os
+
+import pytest
+
+from conftest import FIXTURES_DIR
+from history import HistoryStore, revisit, seed
+from parsing_tools import parse_property, preprocess_property
+from storage import INSERT
+
+START = datetime(2023, 5, 1, 12, 0)
+
+
+@pytest.fixture
+def history(tmp_path):
+    history = HistoryStore(str(tmp_path / 'history.db'), keyframe_interval=3)
+    yield history
+    history.close()
+
+
+def _visit(day, **fields):
+    return {'_id': '1-0000001', 'Address': 'Vilnius, Antakalnis', 'Date_scraped': START + timedelta(days=day),
+            **fields}
+
+
+def _snapshot_kinds(history):
+    rows = history._connection.execute('SELECT taken_at, keyframe FROM snapshots ORDER BY taken_at')
+    return rows.fetchall()
+
+
+def test_state_at_rebuilds_every_visit(history):
+    visits = [
+        _visit(0, Price=100000, Viewed=10),
+        _visit(1, Price=100000, Viewed=10),
+        _visit(2, Price=95000, Viewed=25),
+        _visit(3, Price=95000, Viewed=40, Reserved=True),
+        _visit(4, Price=90000, Viewed=41),
+        _visit(5, Price=90000, Viewed=60),
+    ]
+    for day, visit in enumerate(visits):
+        changes = history.record('butai', visit, START + timedelta(days=day))
+        if day == 1:
+            assert changes is None
+        if day == 4:
+            assert changes == {'Price': 90000, 'Viewed': 41, 'Reserved': None}
+
+    untracked = {'Date_scraped'}
+    for day, visit in enumerate(visits):
+        expected = {key: value for key, value in visit.items() if key not in untracked}
+        state = history.state_at('butai', '1-0000001', START + timedelta(days=day, hours=1))
+        assert {key: value for key, value in state.items() if key not in untracked} == expected
+    assert history.state_at('butai', '1-0000001', START - timedelta(days=1)) is None
+    # a keyframe is written after every few deltas, so old states do not need the whole history
+    assert sum(keyframe for _, keyframe in _snapshot_kinds(history)) == 2
+
+
+def test_price_changes_and_scheduling(history):
+    history.record('butai', _visit(0, Price=100000), START, timedelta(days=1))
+    history.record('butai', _visit(1, Price=95000), START + timedelta(days=1), timedelta(days=1))
+    changes = list(history.price_changes(START, START + timedelta(days=2)))
+    assert [(change.old_price, change.new_price) for change in changes] == [(100000, 95000)]
+
+    assert history.due('butai', START + timedelta(days=1, hours=12)) == []
+    assert history.due('butai', START + timedelta(days=2)) == ['1-0000001']
+    history.end('butai', '1-0000001')
+    assert history.due('butai', START + timedelta(days=3)) == []
+
+
+def test_revisit_ends_removed_and_redirected_ads(history):
+    pages = {}
+    for ad_id in ['1-0000001', '2-0000002']:
+        with open(os.path.join(FIXTURES_DIR, 'property', f'{ad_id}.html'), encoding='utf-8') as f:
+            pages[ad_id] = f.read()
+    served = {
+        '1-0000001': pages['1-0000001'],
+        # removed ads render an error page with a 200 through Chrome
+        '1-0000002': '<html><body><h1>Skelbimas nerastas</h1></body></html>',
+        # the site redirected this ad to another one
+        '1-0000003': pages['2-0000002'],
+    }
+    for ad_id in served:
+        history.record('butai', _visit(0, _id=ad_id, Price=100000), START, timedelta(days=1))
+
+    stats = revisit('butai', history, fetch_html=lambda url: served[url.rstrip('/').rsplit('/', 1)[1]], workers=1)
+    assert stats == {'visited': 3, 'changed': 1, 'unchanged': 0, 'gone': 2, 'failed': 0}
+    assert history.due('butai', datetime.now() + timedelta(days=2)) == ['1-0000001']
+    assert history.state_at('butai', '1-0000001')['Price'] == 123000
+    assert history.state_at('butai', '1-0000003')['Price'] == 100000
+    assert history.tracked('butai', ['2-0000002']) == []
+
+
+def test_revisit_after_seeding_from_storage(history, sqlite_storage):
+    with open(os.path.join(FIXTURES_DIR, 'property', '1-0000001.html'), encoding='utf-8') as f:
+        page = f.read()
+    stored = preprocess_property(parse_property(page))
+    # as read back from Mongo, which has no tuples
+    stored['Coordinates'] = list(stored['Coordinates'])
+    sqlite_storage.write('butai', [(stored['_id'], INSERT, stored)])
+
+    assert seed('butai', history, lag=timedelta(0), revisit_interval=timedelta(0)) == 1
+    stats = revisit('butai', history, fetch_html=lambda url: page, workers=1)
+    assert stats == {'visited': 1, 'changed': 0, 'unchanged': 1, 'gone': 0, 'failed': 0}
+    assert len(list(history.snapshots('butai', '1-0000001'))) == 1
@@ -0,0 +1,106 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import threading
+
+import pytest
+
+from bench import MemoryWriter
+from images import ImageDownloader, ImageStore, download_category, sniff_image_type
+from storage import INSERT
+import utils
+
+JPEG = b'\xff\xd8\xff\xe0' + b'photo' * 100
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    # path -> (status, content type, body)
+    routes = {
+        '/a.jpg': (200, 'image/jpeg', JPEG),
+        '/copy-of-a.jpg': (200, 'image/jpeg', JPEG),
+        '/other.png': (200, 'image/png', b'\x89PNG' + b'other' * 10),
+        '/gone.jpg': (404, 'text/html', b'not found'),
+        '/page.jpg': (200, 'text/html', b'<html></html>'),
+        '/untyped.jpg': (200, 'application/octet-stream', JPEG),
+        '/untyped-page.jpg': (200, 'application/octet-stream', b'<html></html>'),
+        '/flaky.jpg': (503, 'text/html', b'try later'),
+    }
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        status, content_type, body = self.routes[self.path]
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ImageHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    ImageHandler.requests = []
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def downloader(tmp_path, monkeypatch):
+    # retries of failed downloads do not wait
+    monkeypatch.setattr(utils, 'sleep', lambda seconds: None)
+    store = ImageStore(str(tmp_path / 'images'))
+    downloader = ImageDownloader(store, workers=4, per_host=2)
+    yield downloader
+    downloader.close()
+    store.close()
+
+
+def test_download(server, downloader):
+    urls = [f'{server}{path}' for path in ['/a.jpg', '/copy-of-a.jpg', '/other.png', '/untyped.jpg', '/gone.jpg',
+                                            '/flaky.jpg', '/page.jpg', '/untyped-page.jpg']]
+    hashes = downloader.download(urls)
+
+    assert hashes[urls[0]] == hashes[urls[1]] == hashes[urls[3]] is not None
+    assert hashes[urls[2]] not in (None, hashes[urls[0]])
+    # dead links resolve to None, failures that may pass, like error pages served as images, are left out
+    assert hashes[urls[4]] is None
+    assert not set(urls[5:]) & set(hashes)
+    stored = [name for _, _, names in os.walk(downloader.store.root) for name in names
+              if not name.startswith('index.db')]
+    assert sorted(os.path.splitext(name)[1] for name in stored) == ['.jpg', '.png']
+
+    ImageHandler.requests = []
+    again = downloader.download(urls)
+    assert {url: again[url] for url in urls[:5]} == {url: hashes[url] for url in urls[:5]}
+    # only the failed URLs are fetched again, dead links need retry_dead
+    assert set(ImageHandler.requests) == {'/flaky.jpg', '/page.jpg', '/untyped-page.jpg'}
+    downloader.download(urls, retry_dead=True)
+    assert '/gone.jpg' in ImageHandler.requests
+
+
+def test_download_category_defers_properties_with_failed_images(server, downloader, sqlite_storage):
+    sqlite_storage.write('butai', [
+        ('1-0000001', INSERT, {'_id': '1-0000001', 'Photos': [f'{server}/a.jpg', f'{server}/gone.jpg'],
+                               'Thumbnail': f'{server}/other.png'}),
+        ('1-0000002', INSERT, {'_id': '1-0000002', 'Photos': [f'{server}/a.jpg', f'{server}/flaky.jpg']}),
+    ])
+    writer = MemoryWriter()
+    stats = download_category('butai', downloader, writer)
+    assert stats['deferred'] == 1
+    assert set(writer.properties) == {('butai', '1-0000001')}
+    update = writer.properties[('butai', '1-0000001')]
+    assert update['Photo_hashes'][0] is not None and update['Photo_hashes'][1] is None
+    assert update['Thumbnail_hash'] is not None
+
+
+def test_sniff_image_type():
+    assert sniff_image_type(JPEG) == 'image/jpeg'
+    assert sniff_image_type(b'RIFF\x00\x00\x00\x00WEBPVP8 ') == 'image/webp'
+    assert sniff_image_type(b'<html></html>') is None
+    assert sniff_image_type(b'') is None
@@ -0,0 +1,62 @@
+import glob
+import json
+import os
+
+import pytest
+from lxml import html
+
+from conftest import FIXTURES_DIR
+from parsing_tools import extract_crime_stat, extract_element, parse_listing_page, parse_property
+import metrics
+
+PROPERTY_PAGES = sorted(glob.glob(os.path.join(FIXTURES_DIR, 'property', '*.html')))
+
+
+def _read(path):
+    with open(path, encoding='utf-8') as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('path', PROPERTY_PAGES, ids=os.path.basename)
+def test_parse_property_matches_beautifulsoup_output(path):
+    # the .json next to every page was produced by the BeautifulSoup-based parser of the first release
+    expected = json.loads(_read(path[:-len('.html')] + '.json'))
+    parsed = parse_property(_read(path))
+    assert parsed.pop('Date_scraped')
+    parsed['Coordinates'] = list(parsed['Coordinates'])
+    # the old parser collected photos in a set, so only their membership is comparable
+    parsed['Photos'] = sorted(parsed['Photos'])
+    assert parsed == expected
+
+
+def test_extract_element_ignores_head():
+    tree = html.fromstring(_read(os.path.join(FIXTURES_DIR, 'property', '1-0000001.html')))
+    assert extract_element(tree, 'price-eur') == '123 000 €'
+    assert extract_element(tree, 'reservation-strip__text') == 'Rezervuotas iki 2023-06-01'
+
+
+def test_parse_listing_page():
+    page = parse_listing_page(_read(os.path.join(FIXTURES_DIR, 'listing', '1.html')))
+    assert page.ad_ids == ['1-0000001', '1-0000003', '1-0000004']
+    assert page.thumbnails == {
+        '1-0000001': 'https://img.dgn.lt/small_1/0000001_a.jpg',
+        '1-0000003': 'https://img.dgn.lt/small_1/0000003_a.jpg',
+        '1-0000004': 'https://img.dgn.lt/small_1/0000004_a.jpg',
+    }
+    assert page.prices['1-0000001'] == '123 000 €'
+    assert page.max_page == 2
+
+
+def test_extractor_failures_count_as_stage_errors():
+    enabled = metrics.is_enabled()
+    metrics.enable()
+    metrics.REGISTRY.clear()
+    try:
+        assert extract_crime_stat(html.fromstring('<html><body><p>No statistics</p></body></html>')) is None
+        counters = {(counter['name'], tuple(counter['labels'].items())): counter['value']
+                    for counter in metrics.REGISTRY.snapshot()['counters']}
+    finally:
+        metrics.enable(enabled)
+        metrics.REGISTRY.clear()
+    assert counters[(metrics.STAGE_ERRORS, (('stage', 'extract_crime_stat'),))] == 1
+    assert counters[('scraper_handled_exceptions_total', (('function', 'extract_crime_stat'),))] == 1
@@ -0,0 +1,118 @@
+import glob
+import random
+import os
+
+import pytest
+
+from conftest import FIXTURES_DIR
+from parsing_tools import parse_property, preprocess_properties, preprocess_property
+import parsing_tools
+
+RAW_PROPERTIES = [
+    {'Price': '123 000 €', 'Plotas': '65,5 m²', 'Kambarių_sk.': '3', 'Aukštas': '4', 'Aukštų_sk.': '9',
+     'Metai': '1985 statyba, 2015 renovacija', 'Peržiūrėjo': '340/25 (šiandien)', 'Įsiminė': '12',
+     'Įdėtas': '2023-05-01', 'Date_scraped': '01/06/2023 12:30:00', 'Address': 'Vilnius, Antakalnis',
+     'Reserved': '', 'Nuoroda': 'www.aruodas.lt/1-0000001'},
+    {'Price': '89 000 €', 'Metai': '2005', 'Aukštas': 'Cokolinis', 'Reserved': 'Rezervuotas',
+     'Iki_vandens_telkinio_(m)': '1 200', 'Nuoroda': 'www.aruodas.lt/1-0000002'},
+    {'Price': '89 000 €', 'Metai': ' 2005 ', 'Aktyvus_iki': '2023-06-10', 'Redaguotas': '2023-05-10'},
+    {'Įsiminė': 5},
+    {'Metai': 1990},
+    {'Aukštas': None},
+]
+
+
+def _expected(property):
+    try:
+        return preprocess_property(dict(property))
+    except Exception:
+        return None
+
+
+def _assert_matches_preprocess_property(properties):
+    records, errors = preprocess_properties(properties)
+    failed_rows = {error['row'] for error in errors}
+    assert len(records) == len(properties)
+    for row, (property, record) in enumerate(zip(properties, records)):
+        expected = _expected(property)
+        if expected is None:
+            assert row in failed_rows
+        else:
+            assert record == expected
+
+
+def test_preprocess_properties_matches_preprocess_property():
+    _assert_matches_preprocess_property(RAW_PROPERTIES)
+
+
+@pytest.mark.parametrize('properties', [
+    [{'Įsiminė': 5}],
+    [{'Metai': 1990}],
+    [{'Price': 5}, {'Price': None}],
+], ids=['int saved', 'int year', 'int and None price'])
+def test_columns_without_strings(properties):
+    _assert_matches_preprocess_property(properties)
+
+
+def test_none_is_kept_for_failed_values():
+    records, errors = preprocess_properties([{'Price': None}, {'Price': '5 €'}])
+    assert records == [{'Price': None}, {'Price': 5}]
+    assert [error['row'] for error in errors] == [0]
+
+
+def test_fixture_pages():
+    paths = sorted(glob.glob(os.path.join(FIXTURES_DIR, 'property', '*.html')))
+    parsed = []
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            parsed.append(parse_property(f.read()))
+    records, errors = preprocess_properties(parsed)
+    assert records == [preprocess_property(dict(property)) for property in parsed]
+    assert errors == []
+
+
+def _same(a, b):
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(_same(a[key], b[key]) for key in a)
+    return type(a) is type(b) and (a == b or a != a and b != b)
+
+
+def test_random_values_match_preprocess_property():
+    # values the vectorized conversions take, and look-alikes they must leave to the per-record ones
+    choices = {
+        'Price': ['123 000 €', '5 €', '+5 €', '1_000 €', '€', '12.5 €', '٣ €', '9' * 20 + ' €', None],
+        'Plotas': ['65,5 m²', '40 m²', '1e3 m²', 'nan m²', ' 7 m²', '-0,0 m²', 'm²'],
+        'Kambarių_sk.': ['3', ' 3 ', '-1', '03', '3.0', '', '\x1c3'],
+        'Metai': ['1985', '1985 statyba, 2015 renovacija', '1985_2015', '19852015', '٢٠١٠ 1990 2000',
+                  '1990-2000', 'x 1990 2000', '1990', 1990],
+        'Peržiūrėjo': ['340/25 (šiandien)', '12', '/3', '1_2/3'],
+        'Įdėtas': ['2023-05-01', '2023-02-30', '2023-2-1', '0999-01-01', '2023-05-01 ', None],
+        'Date_scraped': ['01/06/2023 12:30:00', '31/06/2023 12:30:00', '01/06/2023 24:00:00', '1/6/2023 12:30:00'],
+        'Address': ['Vilnius, Antakalnis', 'Kaunas', '', ', x', None],
+        'Reserved': ['', 'Rezervuotas', None],
+        'Iki_vandens_telkinio_(m)': ['1 200', '300', 'x'],
+        'Nuoroda': ['www.aruodas.lt/1-0000001', 'www.aruodas.lt/', '١-١٢٣٤٥٦٧ 1-1234567', None],
+        'Aukštas': ['4', 'Cokolinis', None, 4],
+    }
+    generator = random.Random(13)
+    properties = [{key: generator.choice(values) for key, values in choices.items() if generator.random() < 0.8}
+                  for _ in range(2000)]
+    records, errors = preprocess_properties(properties)
+    failed_rows = {error['row'] for error in errors}
+    for row, (property, record) in enumerate(zip(properties, records)):
+        expected = _expected(property)
+        if expected is None:
+            assert row in failed_rows
+        else:
+            assert _same(record, expected), (property, record, expected)
+
+
+def test_usual_values_are_converted_column_wise(monkeypatch):
+    def per_record(value):
+        raise AssertionError(f'{value!r} was converted on its own')
+
+    expected = preprocess_property(dict(RAW_PROPERTIES[0]))
+    monkeypatch.setattr(parsing_tools, '_SCALAR_CONVERSIONS', dict.fromkeys(parsing_tools._SCALAR_CONVERSIONS, per_record))
+    records, errors = preprocess_properties([RAW_PROPERTIES[0]] * 3)
+    assert errors == []
+    assert records == [expected] * 3
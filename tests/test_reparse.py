@@ -0,0 +1,43 @@
+import argparse
+import os
+import shutil
+
+import pytest
+
+from cli import main
+from conftest import FIXTURES_DIR
+from html_archive import HtmlArchive
+import reparse
+
+
+def test_reparse_imports_saved_html_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    legacy = tmp_path / 'raw_html'
+    legacy.mkdir()
+    # the file name older versions of get_html gave https://www.aruodas.lt/1-0000001/
+    shutil.copy(os.path.join(FIXTURES_DIR, 'property', '1-0000001.html'),
+                legacy / 'aruodas.lt_1-0000001_20240101_120000.html')
+
+    stats = main(['reparse', '--archive-dir', str(tmp_path / 'archive'), '--import-html', str(legacy),
+                  '--remove-imported', '--dry-run', '--processes', '1', '--errors', str(tmp_path / 'errors.jsonl')])
+
+    assert stats['imported'] == 1
+    assert stats['pages'] == 1 and stats['errors'] == 0
+    assert os.listdir(legacy) == []
+    archive = HtmlArchive(str(tmp_path / 'archive'))
+    record = archive.find(ad_id='1-0000001')
+    assert record.url == 'https://www.aruodas.lt/1-0000001/'
+    assert record.fetched_at.isoformat() == '2024-01-01T12:00:00'
+    with open(os.path.join(FIXTURES_DIR, 'property', '1-0000001.html')) as f:
+        assert archive.read_record(record) == f.read()
+    archive.close()
+
+
+def test_ad_types_default_to_every_category():
+    parser = argparse.ArgumentParser()
+    reparse.add_arguments(parser)
+    assert parser.parse_args([]).ad_types == reparse.TYPES
+    assert parser.parse_args(['--ad-types', 'namai', 'butai']).ad_types == ['namai', 'butai']
+    for argv in (['--ad-types'], ['--ad-types', 'pilys']):
+        with pytest.raises(SystemExit):
+            parser.parse_args(argv)
@@ -0,0 +1,102 @@
+import glob
+import os
+
+import pytest
+
+from bench import FakeSite, MemoryWriter
+from conftest import FIXTURES_DIR
+from scraper import Scraper
+from seen_index import open_seen_index
+
+BROKEN_AD = '1-0000003'
+
+
+def _pages(kind):
+    pages = []
+    for path in sorted(glob.glob(os.path.join(FIXTURES_DIR, kind, '*.html'))):
+        with open(path, encoding='utf-8') as f:
+            pages.append(f.read())
+    return pages
+
+
+@pytest.fixture
+def fake_site(tmp_path, monkeypatch):
+    # the checkpoint and the local indexes are kept in the working directory
+    monkeypatch.chdir(tmp_path)
+    index = open_seen_index('butai')
+    index.reconcile([])
+    index.close()
+    return FakeSite(_pages('listing'), _pages('property'))
+
+
+@pytest.fixture
+def site(fake_site):
+    def fetch_html(url, save_html=False):
+        if BROKEN_AD in url:
+            raise ValueError('page never loads')
+        return fake_site(url, save_html)
+    return fetch_html
+
+
+@pytest.fixture
+def scrapers():
+    scrapers = []
+    yield scrapers
+    for scraper in scrapers:
+        scraper.scraped_ids.close()
+        scraper.listing_signals.close()
+
+
+def _scraper(site, writers, scrapers, **kwargs):
+    def make_writer(on_saved):
+        writers.append(MemoryWriter(on_saved))
+        return writers[-1]
+    scraper = Scraper('butai', fetch_html=site, make_writer=make_writer, fetch_workers=1, **kwargs)
+    scraper.max_page = 1
+    scrapers.append(scraper)
+    return scraper
+
+
+def test_failing_ad_is_skipped_after_max_attempts(site, scrapers):
+    writers = []
+    scraper = _scraper(site, writers, scrapers, max_ad_attempts=3)
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            scraper.crawl()
+        assert BROKEN_AD in scraper.checkpoint.in_flight
+    assert scraper.checkpoint.attempts[BROKEN_AD] == 2
+
+    assert scraper.crawl()
+    assert scraper.stats['failed'] == 1
+    saved = {property_id for _, property_id in writers[0].properties}
+    assert saved == {'1-0000001', '1-0000004'}
+    assert not scraper.checkpoint.resumed
+
+
+def test_attempts_survive_restarts(site, scrapers):
+    writers = []
+    scraper = _scraper(site, writers, scrapers, max_ad_attempts=2)
+    with pytest.raises(ValueError):
+        scraper.crawl()
+
+    restarted = _scraper(site, writers, scrapers, max_ad_attempts=2)
+    assert restarted.checkpoint.attempts == {BROKEN_AD: 1}
+    assert restarted.crawl()
+    assert restarted.stats['failed'] == 1
+
+
+def test_parse_errors_skip_the_ad(fake_site, scrapers, monkeypatch):
+    parse_property = Scraper.parse_property
+
+    def parse_or_fail(self, source, **kwargs):
+        if '1-0000004' in source:
+            raise TypeError('malformed field')
+        return parse_property(self, source, **kwargs)
+    monkeypatch.setattr(Scraper, 'parse_property', parse_or_fail)
+
+    writers = []
+    scraper = _scraper(fake_site, writers, scrapers)
+    assert scraper.crawl()
+    assert scraper.stats['failed'] == 1
+    saved = {property_id for _, property_id in writers[0].properties}
+    assert saved == {'1-0000001', '1-0000003'}
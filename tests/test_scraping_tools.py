@@ -0,0 +1,79 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import threading
+
+import pytest
+
+from conftest import FIXTURES_DIR
+import scraping_tools
+
+with open(os.path.join(FIXTURES_DIR, 'property', '1-0000001.html'), 'rb') as f:
+    PAGE = f.read()
+CHALLENGE_PAGE = b'<html><head><title>Just a moment...</title></head><body class="cf-challenge"></body></html>'
+
+
+class PageHandler(BaseHTTPRequestHandler):
+    # path -> (status, body)
+    routes = {
+        '/1-0000001/': (200, PAGE),
+        '/challenge/': (200, CHALLENGE_PAGE),
+        '/forbidden/': (403, PAGE),
+        '/too-many/': (429, b'slow down'),
+        '/unavailable/': (503, b''),
+        '/empty/': (200, b' \n'),
+    }
+
+    def do_GET(self):
+        status, body = self.routes[self.path]
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), PageHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def chrome(monkeypatch):
+    """Replaces the Chrome backend, recording the URLs it is asked for."""
+    urls = []
+
+    def fetch_with_chrome(url):
+        urls.append(url)
+        return '<html><body>rendered by Chrome</body></html>'
+
+    monkeypatch.setattr(scraping_tools, 'fetch_with_chrome', fetch_with_chrome)
+    scraping_tools.set_fetch_backend('http')
+    yield urls
+    scraping_tools.set_fetch_backend('chrome')
+
+
+def test_is_challenge_page():
+    assert not scraping_tools.is_challenge_page(PAGE.decode())
+    assert scraping_tools.is_challenge_page(CHALLENGE_PAGE.decode())
+    assert scraping_tools.is_challenge_page('  ')
+    assert scraping_tools.is_challenge_page(PAGE.decode(), status_code=429)
+
+
+def test_http_backend_fetches_pages(server, chrome):
+    assert scraping_tools.get_html(f'{server}/1-0000001/') == PAGE.decode()
+    assert chrome == []
+
+
+@pytest.mark.parametrize('path', ['/challenge/', '/forbidden/', '/too-many/', '/unavailable/', '/empty/'])
+def test_http_backend_falls_back_to_chrome(server, chrome, path):
+    assert scraping_tools.fetch_with_http(f'{server}{path}') is None
+    assert scraping_tools.get_html(f'{server}{path}') == '<html><body>rendered by Chrome</body></html>'
+    assert chrome == [f'{server}{path}']
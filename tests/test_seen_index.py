@@ -0,0 +1,58 @@
+import pytest
+
+from reparse import CategoryResolver
+from seen_index import SeenIndex, open_seen_index
+
+
+def test_new_index_is_incomplete_until_reconciled(tmp_path):
+    path = str(tmp_path / 'butai.bin')
+    index = SeenIndex(path)
+    assert not index.complete
+    index.add('1-0000001')
+    index.close()
+
+    index = SeenIndex(path)
+    assert not index.complete
+    index.reconcile(['1-0000002', '1-0000003', None])
+    assert index.complete
+    assert '1-0000002' in index and '1-0000001' not in index
+    assert len(index) == 2
+    index.add('1-0000004')
+    index.close()
+
+    index = SeenIndex(path)
+    assert index.complete
+    assert len(index) == 3
+    index.close()
+
+
+def test_interrupted_reconcile_keeps_previous_index(tmp_path):
+    path = str(tmp_path / 'butai.bin')
+    index = SeenIndex(path)
+    index.reconcile(['1-0000001'])
+
+    def failing_ids():
+        yield '1-0000002'
+        raise RuntimeError('database went away')
+
+    with pytest.raises(RuntimeError):
+        index.reconcile(failing_ids())
+    index.close()
+
+    index = SeenIndex(path)
+    assert index.complete
+    assert '1-0000001' in index and '1-0000002' not in index
+    index.close()
+
+
+def test_category_resolver_skips_missing_indexes(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    index = open_seen_index('namai')
+    index.reconcile(['1-0000001'])
+    index.close()
+
+    resolve_category = CategoryResolver(['butai', 'namai'])
+    assert resolve_category('1-0000001') == 'namai'
+    assert resolve_category('1-0000002') is None
+    resolve_category.close()
+    assert not (tmp_path / 'seen_index' / 'butai.bin').exists()
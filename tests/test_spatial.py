@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from spatial import METRES_PER_DEGREE, SpatialIndex, haversine
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = SpatialIndex(str(tmp_path / 'spatial.db'))
+    yield index
+    index.close()
+
+
+def _points(count, latitude, longitude, spread, seed=1):
+    generator = np.random.default_rng(seed)
+    latitudes = latitude + generator.uniform(-spread, spread, count)
+    longitudes = longitude + generator.uniform(-spread, spread, count)
+    return latitudes, longitudes
+
+
+@pytest.mark.parametrize('latitude, longitude', [(54.687, 25.279), (56.4, 21.0)], ids=['Vilnius', 'north coast'])
+@pytest.mark.parametrize('radius', [100, 700, 3000])
+def test_within_matches_brute_force(index, latitude, longitude, radius):
+    latitudes, longitudes = _points(3000, latitude, longitude, 0.06)
+    index.update('butai', [{'_id': f'1-{i:07d}', 'Coordinates': (lat, lon), 'Price': 100000}
+                           for i, (lat, lon) in enumerate(zip(latitudes, longitudes))])
+    found = index.within(latitude, longitude, radius)
+
+    distances = haversine(latitude, longitude, latitudes, longitudes)
+    expected = {f'1-{i:07d}' for i in np.flatnonzero(distances <= radius)}
+    assert {neighbour.ad_id for neighbour in found} == expected
+    assert [neighbour.distance for neighbour in found] == sorted(neighbour.distance for neighbour in found)
+
+
+def test_nearest_and_comparables(index):
+    index.update('butai', [
+        {'_id': '1-0000001', 'Coordinates': (54.687, 25.279)},
+        {'_id': '1-0000002', 'Coordinates': (54.688, 25.279)},
+        {'_id': '1-0000003', 'Coordinates': (54.700, 25.279)},
+        {'_id': '1-0000004', 'Coordinates': None},
+    ])
+    index.update('namai', [{'_id': '2-0000001', 'Coordinates': [54.6871, 25.279]}])
+    assert [neighbour.ad_id for neighbour in index.nearest(54.687, 25.279, k=2)] == ['1-0000001', '2-0000001']
+    assert [neighbour.ad_id for neighbour in index.comparables('butai', '1-0000001')] == ['1-0000002']
+
+
+def test_within_north_of_the_reference_latitude(index):
+    # a point due east at exactly the radius, where the grid's scale is a few percent off
+    latitude, longitude, radius = 56.4, 21.0, 20000
+    east = longitude + radius / (METRES_PER_DEGREE * np.cos(np.radians(latitude))) * 0.999
+    index.update('butai', [{'_id': '1-0000001', 'Coordinates': (latitude, east)}])
+    assert [neighbour.ad_id for neighbour in index.within(latitude, longitude, radius)] == ['1-0000001']
@@ -0,0 +1,57 @@
+from datetime import datetime
+
+import pytest
+
+from stream import export_ndjson, iter_ndjson, load_ndjson, load_offset, write_ndjson
+
+
+def _record(index):
+    return {'_id': f'1-{index:07d}', 'Price': 100000 + index, 'Coordinates': (54.7, 25.3 + index / 1000),
+            'Date_scraped': datetime(2023, 5, 1, 12, 0, index % 60), 'Misc': ['Balkonas']}
+
+
+@pytest.mark.parametrize('name', ['properties.ndjson', 'properties.ndjson.gz'])
+def test_round_trip(tmp_path, name):
+    path = str(tmp_path / name)
+    records = [_record(index) for index in range(5)]
+    assert write_ndjson(records, path) == 5
+    assert list(iter_ndjson(path)) == records
+    assert isinstance(next(iter_ndjson(path))['Coordinates'], tuple)
+
+
+@pytest.mark.parametrize('name', ['properties.ndjson', 'properties.ndjson.gz'])
+def test_export_and_load(sqlite_storage, tmp_path, name):
+    path = str(tmp_path / name)
+    write_ndjson([_record(index) for index in range(5)], path)
+    assert load_ndjson(path, 'butai', batch_size=2) == {'loaded': 5, 'errors': 0}
+
+    exported = str(tmp_path / f'exported-{name}')
+    assert export_ndjson('butai', exported) == 5
+    stored = sorted(iter_ndjson(exported), key=lambda record: record['_id'])
+    assert [{key: record[key] for key in _record(0)} for record in stored] == [_record(index) for index in range(5)]
+
+
+@pytest.mark.parametrize('name', ['properties.ndjson', 'properties.ndjson.gz'])
+def test_interrupted_load_resumes_at_the_saved_offset(sqlite_storage, monkeypatch, tmp_path, name):
+    path = str(tmp_path / name)
+    write_ndjson([_record(index) for index in range(5)], path)
+    write = sqlite_storage.write
+    batches = []
+
+    def interrupted_write(ad_type, items):
+        batches.append([item[0] for item in items])
+        if len(batches) == 2:
+            raise ConnectionError('lost the database')
+        return write(ad_type, items)
+
+    monkeypatch.setattr(sqlite_storage, 'write', interrupted_write)
+    with pytest.raises(ConnectionError):
+        load_ndjson(path, 'butai', batch_size=2)
+    assert load_offset(path, 'butai') > 0
+    assert sorted(sqlite_storage.iter_ids('butai')) == ['1-0000000', '1-0000001']
+
+    assert load_ndjson(path, 'butai', batch_size=2) == {'loaded': 3, 'errors': 0}
+    # the interrupted batch is written again, the one stored before it is not
+    assert batches[2:] == [['1-0000002', '1-0000003'], ['1-0000004']]
+    assert load_offset(path, 'butai') == 0
+    assert len(list(sqlite_storage.iter_ids('butai'))) == 5
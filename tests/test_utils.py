@@ -0,0 +1,160 @@
+import pytest
+
+from utils import CircuitBreaker, FatalError, RetryBudget, TokenBucket, batches, retry
+import utils
+
+
+class FakeClock:
+    """Stands in for monotonic() and sleep() in utils, sleeping by moving the time forward."""
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(utils, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(utils, 'sleep', clock.sleep)
+    return clock
+
+
+def test_batches():
+    assert list(batches(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(batches(iter([]), 3)) == []
+
+
+def test_token_bucket_allows_a_burst_then_the_rate(clock):
+    bucket = TokenBucket(rate=2, burst=3)
+    assert [bucket.acquire() for _ in range(3)] == [0, 0, 0]
+    assert bucket.acquire() == pytest.approx(0.5)
+    assert bucket.acquire() == pytest.approx(0.5)
+    # tokens pile up to the burst while idle, not beyond it
+    clock.now += 60
+    assert [bucket.acquire() for _ in range(3)] == [0, 0, 0]
+    assert bucket.acquire() == pytest.approx(0.5)
+
+
+def test_token_bucket_without_rate_does_not_wait(clock):
+    bucket = TokenBucket()
+    assert [bucket.acquire() for _ in range(100)] == [0] * 100
+    assert clock.sleeps == []
+    with pytest.raises(ValueError):
+        bucket.configure(0)
+
+
+def test_circuit_breaker_opens_cools_down_and_closes(clock):
+    breaker = CircuitBreaker(failure_threshold=3, window=60, cooldown=30, max_cooldown=100)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert not breaker.is_open
+    breaker.record_failure()
+    assert breaker.is_open
+    # failures while open do not count towards the next trip
+    breaker.record_failure()
+
+    assert breaker.wait() == pytest.approx(30)
+    assert not breaker.is_open
+    assert breaker.wait() == 0
+
+
+def test_circuit_breaker_forgets_failures_outside_the_window(clock):
+    breaker = CircuitBreaker(failure_threshold=3, window=60, cooldown=30)
+    for _ in range(5):
+        breaker.record_failure()
+        clock.now += 31
+    assert not breaker.is_open
+
+
+def test_circuit_breaker_backs_off_when_it_trips_again_after_the_cooldown(clock):
+    breaker = CircuitBreaker(failure_threshold=2, window=60, cooldown=30, max_cooldown=100)
+
+    def trip():
+        breaker.record_failure()
+        breaker.record_failure()
+        return breaker.wait()
+
+    # the calls let through after a cooldown fail again, so every cooldown doubles up to the maximum
+    assert [trip() for _ in range(4)] == [30, 60, 100, 100]
+    # a call that succeeds closes the breaker for good and resets the cooldown
+    breaker.record_success()
+    assert trip() == 30
+
+
+def test_retry_budget_is_spent_and_earned_back():
+    budget = RetryBudget(ratio=0.5, min_retries=1)
+    assert budget.try_spend()
+    assert not budget.try_spend()
+    budget.record_call()
+    assert not budget.try_spend()
+    budget.record_call()
+    assert budget.try_spend()
+
+
+def test_retry_stops_once_the_budget_is_spent(clock):
+    budget = RetryBudget(ratio=0, min_retries=2)
+    calls = []
+
+    @retry(max_retries=10, wait_time=1, random_wait=False, budget=budget)
+    def fetch():
+        calls.append(clock.now)
+        raise ConnectionError('refused')
+
+    with pytest.raises(ConnectionError):
+        fetch()
+    assert len(calls) == 3
+    # the next call gets no retries at all
+    with pytest.raises(ConnectionError):
+        fetch()
+    assert len(calls) == 4
+
+
+def test_retry_backs_off_exponentially(clock):
+    attempts = []
+
+    @retry(max_retries=4, wait_time=1, random_wait=False, max_wait=3)
+    def fetch():
+        attempts.append(clock.now)
+        if len(attempts) < 4:
+            raise ConnectionError('refused')
+        return 'page'
+
+    assert fetch() == 'page'
+    assert clock.sleeps == [1, 2, 3]
+
+
+def test_retry_does_not_retry_fatal_errors(clock):
+    calls = []
+
+    @retry(max_retries=5, wait_time=1)
+    def fetch():
+        calls.append(1)
+        raise FatalError('no')
+
+    with pytest.raises(FatalError):
+        fetch()
+    assert len(calls) == 1 and clock.sleeps == []
+
+
+def test_retry_waits_for_the_breaker(clock):
+    breaker = CircuitBreaker(failure_threshold=2, window=60, cooldown=30)
+    attempts = []
+
+    @retry(max_retries=5, wait_time=1, random_wait=False, breaker=breaker)
+    def fetch():
+        attempts.append(clock.now)
+        if len(attempts) < 3:
+            raise ConnectionError('refused')
+        return 'page'
+
+    assert fetch() == 'page'
+    # two failures open the breaker, so the third attempt waits out what the backoff left of the cooldown
+    assert clock.sleeps == [1, 2, 28]
+    assert not breaker.is_open and breaker.cooldown == 30
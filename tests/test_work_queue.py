@@ -0,0 +1,91 @@
+import pytest
+
+from work_queue import DONE, FAILED, LEASED, PENDING, listing_job, open_queue, property_job
+import work_queue
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(work_queue, 'time', clock)
+    return clock
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def queue(request, tmp_path, clock):
+    url = 'memory' if request.param == 'memory' else f'sqlite:{tmp_path / "queue.db"}'
+    queue = open_queue(url, f'butai-{request.node.name}', max_attempts=2)
+    yield queue
+    queue.close()
+    work_queue._memory_queues.clear()
+
+
+def test_enqueue_ignores_queued_jobs(queue):
+    assert queue.enqueue([property_job('1-0000001', {}), listing_job('round', 1)]) == 2
+    assert queue.enqueue([property_job('1-0000001', {'changed': True})]) == 0
+    # only finished jobs are reset
+    assert queue.enqueue([property_job('1-0000001', {})], reset=True) == 0
+    assert queue.counts()[PENDING] == 2
+
+
+def test_lease_hands_out_properties_first(queue):
+    queue.enqueue([listing_job('round', 1), property_job('1-0000001', {'url': 'a'})])
+    first, second = queue.lease('worker-1', limit=2)
+    assert (first.id, first.payload, first.state, first.attempts) == ('1-0000001', {'url': 'a'}, LEASED, 1)
+    assert second.id == 'listing:round:1'
+    assert queue.lease('worker-2') == []
+    assert queue.counts()[LEASED] == 2
+
+
+def test_expired_leases_go_back_to_the_queue(queue, clock):
+    queue.enqueue([property_job('1-0000001', {})])
+    queue.lease('worker-1', lease_seconds=60)
+    clock.now += 30
+    queue.extend(['1-0000001'], 'worker-1', lease_seconds=60)
+    clock.now += 59
+    assert queue.lease('worker-2') == []
+
+    clock.now += 1
+    [job] = queue.lease('worker-2')
+    assert (job.lease_owner, job.attempts) == ('worker-2', 2)
+    # the first worker lost the lease, so its ack is ignored
+    queue.ack(['1-0000001'], worker_id='worker-1')
+    assert queue.counts()[LEASED] == 1
+    # out of attempts, the job fails once its last lease expires
+    clock.now += 600
+    assert queue.lease('worker-3') == []
+    assert queue.counts()[FAILED] == 1
+
+
+def test_ack_finishes_jobs(queue):
+    queue.enqueue([property_job('1-0000001', {})])
+    queue.lease('worker-1')
+    queue.ack(['1-0000001'], worker_id='worker-1')
+    assert queue.counts()[DONE] == 1
+    assert queue.lease('worker-1') == []
+    assert queue.enqueue([property_job('1-0000001', {})]) == 0
+    assert queue.enqueue([property_job('1-0000001', {})], reset=True) == 1
+    assert queue.counts()[PENDING] == 1
+
+
+def test_requeue_fails_jobs_out_of_attempts(queue, clock):
+    queue.enqueue([property_job('1-0000001', {})])
+    queue.lease('worker-1')
+    queue.requeue('1-0000001', worker_id='worker-1', delay=30, error='timeout')
+    assert queue.counts()[PENDING] == 1
+    assert queue.lease('worker-1') == []
+
+    clock.now += 30
+    [job] = queue.lease('worker-1')
+    assert job.attempts == 2
+    queue.requeue('1-0000001', worker_id='worker-1', error='timeout')
+    assert queue.counts()[FAILED] == 1
+    assert queue.lease('worker-1') == []
@@ -1,8 +1,20 @@
+from datetime import datetime
+from functools import wraps
+import argparse
+import json
 import logging
-from typing import Callable
-from time import sleep
+import threading
+from collections import deque
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Type
+from time import monotonic, sleep
 from random import random
 
+import metrics
+
+# the categories of ads on the site, one collection each
+TYPES = ['butai', 'butu-nuoma', 'namai', 'namu-nuoma', 'patalpos', 'patalpu-nuoma']
+
+
 class CountCalls: 
     def __init__(self, func: Callable): 
         self._count = 0 
@@ -19,30 +31,252 @@ class CountCalls:
         return self._count
     
 
+def _encode_value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return {'$date': value.isoformat()}
+    if isinstance(value, tuple):
+        return {'$tuple': [_encode_value(item) for item in value]}
+    if isinstance(value, list):
+        return [_encode_value(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _encode_value(item) for key, item in value.items()}
+    return value
+
+
+def _decode_object(obj: Dict[str, Any]) -> Any:
+    if len(obj) == 1:
+        if '$date' in obj:
+            return datetime.fromisoformat(obj['$date'])
+        if '$tuple' in obj:
+            return tuple(obj['$tuple'])
+    return obj
+
+
+def dumps_document(document: Any) -> str:
+    """
+    Serializes a property to JSON, keeping datetimes and tuples as {"$date": iso} and {"$tuple": [...]}
+    so that `loads_document` gives back the same types.
+    """
+    return json.dumps(_encode_value(document), ensure_ascii=False, separators=(',', ':'))
+
+
+def loads_document(string: str) -> Any:
+    return json.loads(string, object_hook=_decode_object)
+
+
+def batches(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    """Yields lists of `size` items, the last one shorter if the items run out."""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def choice_of(choices: List[str]) -> Callable[[str], str]:
+    """
+    An argparse `type` accepting one of `choices`. Unlike `choices=`, it leaves the default of a
+    nargs='*' positional alone, which Python 3.11 would otherwise reject as an invalid choice.
+    """
+    def check(value: str) -> str:
+        if value not in choices:
+            raise argparse.ArgumentTypeError(f'invalid choice: {value!r} (choose from {", ".join(choices)})')
+        return value
+    return check
+
+
 def exception_handler(func: Callable):
+    @wraps(func)
     def inner(*args, **kwargs):
         try:
             return func(*args, **kwargs)
         except Exception as e:
             logging.error(f'Exception in {func.__name__}: {e}')
+            metrics.inc('scraper_handled_exceptions_total', function=func.__name__)
             return None
     return inner
 
-def retry(max_retries: int=3, wait_time: int=30, random_wait: bool=True):
-    if random_wait:
-        wait_time = random() * wait_time
+class FatalError(Exception):
+    """Raised for errors that no amount of retrying will fix."""
+
+
+# per-ad parse errors never get here, the scrapers skip the ad instead of failing its category
+FATAL_EXCEPTIONS: Tuple[Type[BaseException], ...] = (FatalError, TypeError, NameError, NotImplementedError)
+
+
+def is_retryable(e: Exception) -> bool:
+    """Default error classification: programming errors and FatalError are not retried."""
+    return not isinstance(e, FATAL_EXCEPTIONS)
+
+
+def backoff_delay(attempt: int, wait_time: float, max_wait: float, random_wait: bool=True) -> float:
+    """
+    Delay before retry number `attempt` (1-based): `wait_time` doubled on every attempt up to `max_wait`.
+    With `random_wait` the delay is drawn uniformly from [0, delay] ("full jitter"),
+    so callers failing together do not retry together.
+    """
+    delay = min(max_wait, wait_time * 2 ** (attempt - 1))
+    return random() * delay if random_wait else delay
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket allowing `rate` acquisitions per second on average and bursts of `burst`.
+    A rate of None disables limiting.
+    """
+    def __init__(self, rate: Optional[float]=None, burst: int=1):
+        self._lock = threading.Lock()
+        self.configure(rate, burst)
+
+    def configure(self, rate: Optional[float], burst: int=1) -> None:
+        if rate is not None and rate <= 0:
+            raise ValueError(f'Invalid rate: {rate}')
+        with self._lock:
+            self.rate = rate
+            self.burst = max(1, burst)
+            self._tokens = float(self.burst)
+            self._updated = monotonic()
+
+    def acquire(self) -> float:
+        """Blocks until a token is available and returns the time spent waiting."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                if self.rate is None:
+                    return waited
+                now = monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    if waited:
+                        metrics.observe('scraper_rate_limit_wait_seconds', waited)
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            sleep(delay)
+            waited += delay
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` failures within `window` seconds, making every caller of `wait()`
+    pause for `cooldown` seconds. After the cooldown calls go through again;
+    the cooldown doubles, up to `max_cooldown`, each time the breaker trips again right away.
+    """
+    def __init__(self, failure_threshold: int=10, window: float=60, cooldown: float=30, max_cooldown: float=600):
+        self.failure_threshold = failure_threshold
+        self.window = window
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._failures = deque()
+        self._open_until = 0.0
+
+    @property
+    def is_open(self) -> bool:
+        return monotonic() < self._open_until
+
+    def wait(self) -> float:
+        """Blocks while the breaker is open and returns the time spent waiting."""
+        waited = 0.0
+        while True:
+            remaining = self._open_until - monotonic()
+            if remaining <= 0:
+                return waited
+            sleep(remaining)
+            waited += remaining
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._failures or self.cooldown != self.base_cooldown:
+                self._failures.clear()
+                self.cooldown = self.base_cooldown
+
+    def record_failure(self) -> None:
+        with self._lock:
+            now = monotonic()
+            if now < self._open_until:
+                return
+            self._failures.append(now)
+            while self._failures and self._failures[0] < now - self.window:
+                self._failures.popleft()
+            if len(self._failures) < self.failure_threshold:
+                return
+            self._failures.clear()
+            self._open_until = now + self.cooldown
+            logging.warning(f'{self.failure_threshold} failures within {self.window} s, pausing for {self.cooldown} s')
+            metrics.inc('scraper_circuit_breaker_trips_total')
+            self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+
+
+class RetryBudget:
+    """
+    Caps retries at `ratio` of the calls made, plus a reserve of `min_retries`,
+    so a failing dependency is not hit with retries of retries.
+    """
+    def __init__(self, ratio: float=0.2, min_retries: int=10):
+        self.ratio = ratio
+        self._lock = threading.Lock()
+        self._balance = float(min_retries)
+
+    def record_call(self) -> None:
+        with self._lock:
+            self._balance += self.ratio
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            if self._balance < 1:
+                return False
+            self._balance -= 1
+            return True
+
+
+def retry(max_retries: int=3, wait_time: float=30, random_wait: bool=True, max_wait: float=300,
+          retryable: Callable[[Exception], bool]=is_retryable, budget: Optional[RetryBudget]=None,
+          breaker: Optional[CircuitBreaker]=None):
+    """
+    Calls the function up to `max_retries` times, backing off exponentially with jitter between attempts.
+    Errors for which `retryable` returns False are raised right away, and so is the last error
+    once the optional retry `budget` is spent. Every attempt waits for the optional circuit `breaker`
+    to close and reports its outcome to it.
+    """
     def decorator(func):
+        @wraps(func)
         def wrapper(*args, **kwargs):
             retry_count = 0
-            while retry_count < max_retries:
+            if budget is not None:
+                budget.record_call()
+            while True:
+                if breaker is not None:
+                    breaker.wait()
                 try:
                     result = func(*args, **kwargs)
+                    if breaker is not None:
+                        breaker.record_success()
                     return result
                 except Exception as e:
+                    if not retryable(e):
+                        logging.error(f'Fatal exception in {func.__name__}: {e}')
+                        metrics.inc('scraper_fatal_errors_total', function=func.__name__)
+                        raise
+                    if breaker is not None:
+                        breaker.record_failure()
                     retry_count += 1
-                    logging.error(f'Exception in {func.__name__}: {e}, retrying in {round(wait_time)} seconds ({retry_count}/{max_retries})')
-                    if retry_count == max_retries:
-                        raise e 
-                    sleep(wait_time)
+                    if retry_count >= max_retries:
+                        logging.error(f'Exception in {func.__name__}: {e}, giving up after {retry_count} attempts')
+                        metrics.inc('scraper_retries_exhausted_total', function=func.__name__)
+                        raise
+                    if budget is not None and not budget.try_spend():
+                        logging.error(f'Exception in {func.__name__}: {e}, retry budget spent')
+                        metrics.inc('scraper_retry_budget_exhausted_total', function=func.__name__)
+                        raise
+                    delay = backoff_delay(retry_count, wait_time, max_wait, random_wait)
+                    logging.error(f'Exception in {func.__name__}: {e}, retrying in {round(delay)} seconds ({retry_count}/{max_retries})')
+                    metrics.inc('scraper_retries_total', function=func.__name__)
+                    sleep(delay)
         return wrapper
-    return decorator
\ No newline at end of file
+    return decorator
@@ -0,0 +1,360 @@
+from dataclasses import asdict, dataclass, field
+from time import time
+from typing import Any, Dict, Iterable, List, Optional
+import json
+import sqlite3
+import threading
+
+LEASE_SECONDS = 600
+MAX_ATTEMPTS = 5
+QUEUE_BACKENDS = ['memory', 'sqlite', 'mongo']
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+STATES = [PENDING, LEASED, DONE, FAILED]
+
+LISTING = 'listing'
+PROPERTY = 'property'
+# lower runs first: drain known properties before paging further
+PRIORITIES = {PROPERTY: 0, LISTING: 1}
+
+
+@dataclass
+class Job:
+    """
+    A unit of crawl work. Property jobs use the ad id, the `_id` of the stored property, as their id,
+    so an ad is only ever queued once per category; finished jobs stay behind to keep it that way.
+    """
+    id: str
+    kind: str
+    payload: Dict[str, Any] = field(default_factory=dict)
+    state: str = PENDING
+    priority: int = 0
+    attempts: int = 0
+    available_at: float = 0.0
+    lease_owner: Optional[str] = None
+    lease_expires: Optional[float] = None
+    error: Optional[str] = None
+
+
+def listing_job(round_id: str, page: int) -> Job:
+    return Job(id=f'listing:{round_id}:{page}', kind=LISTING, payload={'page': page}, priority=PRIORITIES[LISTING])
+
+
+def property_job(property_id: str, kwargs: Dict[str, Any]) -> Job:
+    return Job(id=property_id, kind=PROPERTY, payload=kwargs, priority=PRIORITIES[PROPERTY])
+
+
+class WorkQueue:
+    """
+    A queue of crawl jobs for one category that several workers, possibly on different hosts, lease from.
+
+    `lease` hands out pending jobs, and jobs whose lease expired, to a worker until `lease_expires`.
+    The worker then either `ack`s them or `requeue`s them; a job leased `max_attempts` times fails.
+    `enqueue` ignores jobs whose id is already queued, unless `reset` is set and the job is finished.
+    """
+    def __init__(self, name: str, max_attempts: int=MAX_ATTEMPTS):
+        self.name = name
+        self.max_attempts = max_attempts
+
+    def enqueue(self, jobs: Iterable[Job], reset: bool=False) -> int:
+        """Adds the jobs and returns how many were added or reset."""
+        raise NotImplementedError
+
+    def lease(self, worker_id: str, limit: int=1, lease_seconds: float=LEASE_SECONDS,
+              kinds: Optional[List[str]]=None) -> List[Job]:
+        raise NotImplementedError
+
+    def extend(self, job_ids: List[str], worker_id: str, lease_seconds: float=LEASE_SECONDS) -> None:
+        """Extends the leases `worker_id` holds on the given jobs."""
+        raise NotImplementedError
+
+    def ack(self, job_ids: List[str], worker_id: Optional[str]=None) -> None:
+        """Marks the jobs done; with `worker_id` only while that worker still holds the lease."""
+        raise NotImplementedError
+
+    def requeue(self, job_id: str, worker_id: Optional[str]=None, delay: float=0, error: Optional[str]=None) -> None:
+        """Hands the job back for another attempt after `delay` seconds, or fails it when out of attempts."""
+        raise NotImplementedError
+
+    def counts(self) -> Dict[str, int]:
+        """Returns the number of jobs in each state."""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryQueue(WorkQueue):
+    """In-process queue for tests and single-process runs."""
+    def __init__(self, name: str='default', max_attempts: int=MAX_ATTEMPTS):
+        super().__init__(name, max_attempts)
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, Job] = {}
+
+    def enqueue(self, jobs: Iterable[Job], reset: bool=False) -> int:
+        added = 0
+        with self._lock:
+            for job in jobs:
+                existing = self._jobs.get(job.id)
+                if existing is None or (reset and existing.state in (DONE, FAILED)):
+                    self._jobs[job.id] = Job(job.id, job.kind, dict(job.payload), priority=job.priority,
+                                             available_at=job.available_at)
+                    added += 1
+        return added
+
+    def _available(self, job: Job, now: float, kinds: Optional[List[str]]) -> bool:
+        if kinds is not None and job.kind not in kinds:
+            return False
+        if job.state == PENDING:
+            return job.available_at <= now
+        return job.state == LEASED and job.lease_expires <= now
+
+    def lease(self, worker_id: str, limit: int=1, lease_seconds: float=LEASE_SECONDS,
+              kinds: Optional[List[str]]=None) -> List[Job]:
+        now = time()
+        leased = []
+        with self._lock:
+            candidates = sorted((job for job in self._jobs.values() if self._available(job, now, kinds)),
+                                key=lambda job: (job.priority, job.available_at))
+            for job in candidates:
+                if job.attempts >= self.max_attempts:
+                    job.state, job.error = FAILED, job.error or 'lease expired'
+                    continue
+                job.state, job.lease_owner, job.lease_expires = LEASED, worker_id, now + lease_seconds
+                job.attempts += 1
+                leased.append(Job(**asdict(job)))
+                if len(leased) == limit:
+                    break
+        return leased
+
+    def extend(self, job_ids: List[str], worker_id: str, lease_seconds: float=LEASE_SECONDS) -> None:
+        expires = time() + lease_seconds
+        with self._lock:
+            for job_id in job_ids:
+                job = self._jobs.get(job_id)
+                if job is not None and job.state == LEASED and job.lease_owner == worker_id:
+                    job.lease_expires = expires
+
+    def ack(self, job_ids: List[str], worker_id: Optional[str]=None) -> None:
+        with self._lock:
+            for job_id in job_ids:
+                job = self._jobs.get(job_id)
+                if job is not None and (worker_id is None or job.lease_owner == worker_id):
+                    job.state, job.lease_owner, job.lease_expires = DONE, None, None
+
+    def requeue(self, job_id: str, worker_id: Optional[str]=None, delay: float=0, error: Optional[str]=None) -> None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or (worker_id is not None and job.lease_owner != worker_id):
+                return
+            job.state = FAILED if job.attempts >= self.max_attempts else PENDING
+            job.available_at = time() + delay
+            job.lease_owner, job.lease_expires, job.error = None, None, error
+
+    def counts(self) -> Dict[str, int]:
+        counts = dict.fromkeys(STATES, 0)
+        with self._lock:
+            for job in self._jobs.values():
+                counts[job.state] += 1
+        return counts
+
+
+class SQLiteQueue(WorkQueue):
+    """
+    Queue in a local SQLite database, shared by the processes of one host.
+    Every category is a separate queue in the same `jobs` table.
+    """
+    def __init__(self, path: str, name: str, max_attempts: int=MAX_ATTEMPTS):
+        super().__init__(name, max_attempts)
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('''CREATE TABLE IF NOT EXISTS jobs (
+            queue TEXT NOT NULL, id TEXT NOT NULL, kind TEXT NOT NULL, payload TEXT NOT NULL,
+            state TEXT NOT NULL, priority INTEGER NOT NULL, attempts INTEGER NOT NULL,
+            available_at REAL NOT NULL, lease_owner TEXT, lease_expires REAL, error TEXT,
+            PRIMARY KEY (queue, id))''')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS jobs_lease '
+                                 'ON jobs (queue, state, priority, available_at)')
+
+    def _transaction(self, statements) -> Any:
+        with self._lock:
+            cursor = self._connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                result = statements(cursor)
+            except BaseException:
+                cursor.execute('ROLLBACK')
+                raise
+            cursor.execute('COMMIT')
+            return result
+
+    def enqueue(self, jobs: Iterable[Job], reset: bool=False) -> int:
+        rows = [(self.name, job.id, job.kind, json.dumps(job.payload), PENDING, job.priority, 0, job.available_at)
+                for job in jobs]
+
+        def statements(cursor: sqlite3.Cursor) -> int:
+            before = self._connection.total_changes
+            cursor.executemany('INSERT OR IGNORE INTO jobs (queue, id, kind, payload, state, priority, attempts, '
+                               'available_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            if reset:
+                cursor.executemany(
+                    'UPDATE jobs SET payload = ?, state = ?, attempts = 0, available_at = ?, lease_owner = NULL, '
+                    'lease_expires = NULL, error = NULL WHERE queue = ? AND id = ? AND state IN (?, ?)',
+                    [(payload, PENDING, available_at, queue, job_id, DONE, FAILED)
+                     for queue, job_id, _, payload, _, _, _, available_at in rows])
+            return self._connection.total_changes - before
+        return self._transaction(statements)
+
+    def lease(self, worker_id: str, limit: int=1, lease_seconds: float=LEASE_SECONDS,
+              kinds: Optional[List[str]]=None) -> List[Job]:
+        now = time()
+        kind_filter = f'AND kind IN ({",".join("?" * len(kinds))})' if kinds else ''
+
+        def statements(cursor: sqlite3.Cursor) -> List[Job]:
+            cursor.execute('UPDATE jobs SET state = ?, error = COALESCE(error, ?) WHERE queue = ? AND state = ? '
+                           'AND lease_expires <= ? AND attempts >= ?',
+                           (FAILED, 'lease expired', self.name, LEASED, now, self.max_attempts))
+            rows = cursor.execute(
+                'SELECT id, kind, payload, priority, attempts, available_at FROM jobs WHERE queue = ? AND '
+                f'((state = ? AND available_at <= ?) OR (state = ? AND lease_expires <= ?)) {kind_filter} '
+                'ORDER BY priority, available_at LIMIT ?',
+                (self.name, PENDING, now, LEASED, now, *(kinds or []), limit)).fetchall()
+            cursor.executemany('UPDATE jobs SET state = ?, lease_owner = ?, lease_expires = ?, '
+                               'attempts = attempts + 1 WHERE queue = ? AND id = ?',
+                               [(LEASED, worker_id, now + lease_seconds, self.name, row[0]) for row in rows])
+            return [Job(job_id, kind, json.loads(payload), LEASED, priority, attempts + 1, available_at,
+                        worker_id, now + lease_seconds)
+                    for job_id, kind, payload, priority, attempts, available_at in rows]
+        return self._transaction(statements)
+
+    def extend(self, job_ids: List[str], worker_id: str, lease_seconds: float=LEASE_SECONDS) -> None:
+        expires = time() + lease_seconds
+        self._transaction(lambda cursor: cursor.executemany(
+            'UPDATE jobs SET lease_expires = ? WHERE queue = ? AND id = ? AND state = ? AND lease_owner = ?',
+            [(expires, self.name, job_id, LEASED, worker_id) for job_id in job_ids]))
+
+    def ack(self, job_ids: List[str], worker_id: Optional[str]=None) -> None:
+        owner_filter = 'AND lease_owner = ?' if worker_id is not None else ''
+        self._transaction(lambda cursor: cursor.executemany(
+            f'UPDATE jobs SET state = ?, lease_owner = NULL, lease_expires = NULL WHERE queue = ? AND id = ? {owner_filter}',
+            [(DONE, self.name, job_id, *([worker_id] if worker_id is not None else [])) for job_id in job_ids]))
+
+    def requeue(self, job_id: str, worker_id: Optional[str]=None, delay: float=0, error: Optional[str]=None) -> None:
+        owner_filter = 'AND lease_owner = ?' if worker_id is not None else ''
+        self._transaction(lambda cursor: cursor.execute(
+            'UPDATE jobs SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, available_at = ?, '
+            f'lease_owner = NULL, lease_expires = NULL, error = ? WHERE queue = ? AND id = ? {owner_filter}',
+            (self.max_attempts, FAILED, PENDING, time() + delay, error, self.name, job_id,
+             *([worker_id] if worker_id is not None else []))))
+
+    def counts(self) -> Dict[str, int]:
+        counts = dict.fromkeys(STATES, 0)
+        with self._lock:
+            rows = self._connection.execute('SELECT state, COUNT(*) FROM jobs WHERE queue = ? GROUP BY state',
+                                            (self.name,)).fetchall()
+        counts.update(rows)
+        return counts
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+class MongoQueue(WorkQueue):
+    """Queue in the `queue/<ad_type>` collection next to the scraped properties, shared by every host."""
+    def __init__(self, name: str, max_attempts: int=MAX_ATTEMPTS):
+        super().__init__(name, max_attempts)
+        from storage import get_client
+        self.collection = get_client()['Scraping'][f'queue/{name}']
+        self.collection.create_index([('state', 1), ('priority', 1), ('available_at', 1)])
+
+    def enqueue(self, jobs: Iterable[Job], reset: bool=False) -> int:
+        from pymongo import UpdateOne
+        operations = []
+        for job in jobs:
+            fields = {'kind': job.kind, 'payload': job.payload, 'state': PENDING, 'priority': job.priority,
+                      'attempts': 0, 'available_at': job.available_at, 'lease_owner': None,
+                      'lease_expires': None, 'error': None}
+            operations.append(UpdateOne({'_id': job.id}, {'$setOnInsert': fields}, upsert=True))
+            if reset:
+                operations.append(UpdateOne({'_id': job.id, 'state': {'$in': [DONE, FAILED]}}, {'$set': fields}))
+        if not operations:
+            return 0
+        result = self.collection.bulk_write(operations, ordered=True)
+        return result.upserted_count + result.modified_count
+
+    def lease(self, worker_id: str, limit: int=1, lease_seconds: float=LEASE_SECONDS,
+              kinds: Optional[List[str]]=None) -> List[Job]:
+        from pymongo import ReturnDocument
+        now = time()
+        self.collection.update_many(
+            {'state': LEASED, 'lease_expires': {'$lte': now}, 'attempts': {'$gte': self.max_attempts}},
+            {'$set': {'state': FAILED, 'error': 'lease expired'}})
+        query = {'$or': [{'state': PENDING, 'available_at': {'$lte': now}},
+                         {'state': LEASED, 'lease_expires': {'$lte': now}}]}
+        if kinds:
+            query['kind'] = {'$in': kinds}
+        leased = []
+        # one document at a time: find_one_and_update is atomic, so no two workers get the same job
+        while len(leased) < limit:
+            document = self.collection.find_one_and_update(
+                query,
+                {'$set': {'state': LEASED, 'lease_owner': worker_id, 'lease_expires': now + lease_seconds},
+                 '$inc': {'attempts': 1}},
+                sort=[('priority', 1), ('available_at', 1)],
+                return_document=ReturnDocument.AFTER)
+            if document is None:
+                break
+            leased.append(Job(id=document.pop('_id'), **document))
+        return leased
+
+    def extend(self, job_ids: List[str], worker_id: str, lease_seconds: float=LEASE_SECONDS) -> None:
+        self.collection.update_many({'_id': {'$in': job_ids}, 'state': LEASED, 'lease_owner': worker_id},
+                                    {'$set': {'lease_expires': time() + lease_seconds}})
+
+    def ack(self, job_ids: List[str], worker_id: Optional[str]=None) -> None:
+        query = {'_id': {'$in': job_ids}}
+        if worker_id is not None:
+            query['lease_owner'] = worker_id
+        self.collection.update_many(query, {'$set': {'state': DONE, 'lease_owner': None, 'lease_expires': None}})
+
+    def requeue(self, job_id: str, worker_id: Optional[str]=None, delay: float=0, error: Optional[str]=None) -> None:
+        query = {'_id': job_id}
+        if worker_id is not None:
+            query['lease_owner'] = worker_id
+        self.collection.update_one(query, [{'$set': {
+            'state': {'$cond': [{'$gte': ['$attempts', self.max_attempts]}, FAILED, PENDING]},
+            'available_at': time() + delay, 'lease_owner': None, 'lease_expires': None, 'error': error}}])
+
+    def counts(self) -> Dict[str, int]:
+        counts = dict.fromkeys(STATES, 0)
+        for row in self.collection.aggregate([{'$group': {'_id': '$state', 'count': {'$sum': 1}}}]):
+            counts[row['_id']] = row['count']
+        return counts
+
+
+_memory_queues: Dict[str, MemoryQueue] = {}
+
+
+def open_queue(url: str, name: str, max_attempts: int=MAX_ATTEMPTS) -> WorkQueue:
+    """
+    Opens the queue of category `name` at `url`: 'memory', 'mongo' or 'sqlite:<path>'.
+    Memory queues are shared by everything in the process that opens the same name.
+    """
+    backend, _, path = url.partition(':')
+    if backend == 'memory':
+        if name not in _memory_queues:
+            _memory_queues[name] = MemoryQueue(name, max_attempts)
+        return _memory_queues[name]
+    if backend == 'sqlite':
+        if not path:
+            raise ValueError(f'Missing database path in queue URL: {url}')
+        return SQLiteQueue(path, name, max_attempts)
+    if backend == 'mongo':
+        return MongoQueue(name, max_attempts)
+    raise ValueError(f'Invalid queue URL: {url}, expected one of {QUEUE_BACKENDS}')